@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark the array based TrueSkill engine against elo_helper.train_elos
+# Run from glue_jobs/glue_helper_libraries: python benchmarks/benchmark_train_elos.py --rows 10000
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import trueskill
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elo_utils import logger
+import elo_utils.elo_helper as elo_helper
+import elo_utils.race_preprocessing as preproc
+import elo_utils.trueskill_engine as engine
+from synthetic import generate_race_history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--riders', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    cli_args = parser.parse_args()
+    logger.setLevel('WARNING')
+    
+    df_train = preproc.remove_one_rider_races(generate_race_history(cli_args.rows, cli_args.riders, cli_args.seed))
+    riders = df_train.results_uciid.drop_duplicates().tolist()
+    ts = trueskill.TrueSkill(draw_probability=0)
+    
+    start_time = time.time()
+    df_current_elos, elos_trajectory = elo_helper.init_elos(riders, df_train, ts)
+    df_current_elos, _ = elo_helper.train_elos(df_train, df_current_elos, elos_trajectory, ts)
+    loop_time = time.time() - start_time
+    
+    start_time = time.time()
+    df_current_elos_engine, _ = engine.train_elos(df_train, ts, riders, chronological=False)
+    engine_time = time.time() - start_time
+    
+    max_diff = np.abs(df_current_elos[['elo_mean', 'elo_std']].values.astype(float) - df_current_elos_engine[['elo_mean', 'elo_std']].values).max()
+    print(f"heats: {elos_trajectory.heat_keys.shape[0]}, rows: {df_train.shape[0]}, riders: {len(riders)}")
+    print(f"elo_helper.train_elos: {loop_time:.2f}s, trueskill_engine.train_elos: {engine_time:.2f}s, speed-up: {loop_time/engine_time:.1f}x")
+    print(f"max abs difference of elo_mean/elo_std: {max_diff:.2e}")
+    if max_diff > 1e-6:
+        sys.exit('trueskill_engine.train_elos does not reproduce elo_helper.train_elos')
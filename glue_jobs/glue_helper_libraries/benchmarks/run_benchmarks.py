@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmark suite of elo_utils on synthetic race histories
+# Measures wall time and peak memory per function and result row count, fully offline.
+# Run from glue_jobs/glue_helper_libraries:
+#   python benchmarks/run_benchmarks.py --sizes 10000,100000 --save-baseline benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --sizes 10000,100000 --baseline benchmarks/baseline.json --threshold 0.25
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+import trueskill
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elo_utils import logger
+import elo_utils.elo_helper as elo_helper
+import elo_utils.race_preprocessing as preproc
+import elo_utils.trueskill_engine as engine
+import elo_utils.race_index as race_index
+from synthetic import generate_race_history
+
+ts = trueskill.TrueSkill(draw_probability=0)
+
+
+def _setup_clean(df: pd.DataFrame):
+    return preproc.remove_one_rider_races(df.copy())
+
+
+def _setup_init_elos(df: pd.DataFrame):
+    df_clean = _setup_clean(df)
+    return df_clean.results_uciid.drop_duplicates().tolist(), df_clean
+
+
+def _setup_train_elos(df: pd.DataFrame):
+    riders, df_clean = _setup_init_elos(df)
+    current_elos, elos_trajectory = elo_helper.init_elos(riders, df_clean, ts)
+    return df_clean, current_elos, elos_trajectory
+
+
+def _setup_predict_elos(df: pd.DataFrame):
+    df_clean = _setup_clean(df)
+    test_idx = df_clean.seasonid == df_clean.seasonid.max()
+    df_train, df_test = df_clean[~test_idx], df_clean[test_idx]
+    df_current_elos, _ = engine.train_elos(df_train, ts)
+    return df_current_elos, df_clean, df_train, df_test
+
+
+# name -> (setup building the arguments outside of the measurement, function, maximal number of result rows)
+# the legacy race by race calibration is limited to 100k rows, it takes hours on 1M rows
+BENCHMARKS = {
+    'remove_one_rider_races': (lambda df: (df.copy(),), preproc.remove_one_rider_races, None),
+    'check_heat_stats': (lambda df: (_setup_clean(df),), preproc.check_heat_stats, None),
+    'build_race_index': (lambda df: (_setup_clean(df),), race_index.build_race_index, None),
+    'init_elos': (lambda df: _setup_init_elos(df) + (ts,), elo_helper.init_elos, None),
+    'train_elos': (lambda df: _setup_train_elos(df) + (ts,), elo_helper.train_elos, 100000),
+    'trueskill_engine.train_elos': (lambda df: (_setup_clean(df), ts), engine.train_elos, None),
+    'predict_elos': (_setup_predict_elos, elo_helper.predict_elos, None),
+}
+
+
+def measure(name: str, df: pd.DataFrame, trace_memory: bool = True):
+    """
+    Wall time and peak memory of one benchmark. The wall time is measured without tracemalloc, which slows down
+    the allocations, the peak memory in a second run with fresh arguments.
+
+    Arguments:
+        name (str) - name of the benchmark in BENCHMARKS
+        df (pd.DataFrame) - synthetic race history
+        trace_memory (bool) - measure the peak memory (True) or only the wall time (False)
+    """
+    setup, function, _ = BENCHMARKS[name]
+    args = setup(df)
+    gc.collect()
+    start_time = time.perf_counter()
+    function(*args)
+    wall_time = time.perf_counter() - start_time
+    peak_memory_mb = None
+    if trace_memory:
+        args = setup(df)
+        gc.collect()
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_memory_mb = peak / 2**20
+    return {'wall_time': wall_time, 'peak_memory_mb': peak_memory_mb}
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float):
+    """
+    Benchmarks whose wall time or peak memory exceed the baseline by more than the threshold.
+
+    Arguments:
+        results (dict) - measurements per benchmark key, see run_benchmarks
+        baseline (dict) - measurements of an earlier run in the same format
+        threshold (float) - allowed relative increase, e.g. 0.25 for 25%
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ['wall_time', 'peak_memory_mb']:
+            if result.get(metric) is None or baseline[key].get(metric) is None:
+                continue
+            if result[metric] > baseline[key][metric] * (1 + threshold):
+                regressions.append(f"{key} {metric}: {result[metric]:.3f} > {baseline[key][metric]:.3f} (+{100*threshold:.0f}%)")
+    return regressions
+
+
+def run_benchmarks(sizes: list, names: list, seed: int = 42, trace_memory: bool = True, no_limits: bool = False):
+    """
+    Run the benchmarks on synthetic race histories of every size. The result key is '<name>@<rows>'.
+
+    Arguments:
+        sizes (list) - numbers of result rows
+        names (list) - names of the benchmarks in BENCHMARKS
+        seed (int) - seed of the synthetic race history
+        trace_memory (bool) - measure the peak memory
+        no_limits (bool) - ignore the maximal number of rows of slow benchmarks
+    """
+    results = {}
+    for n_rows in sizes:
+        df = generate_race_history(n_rows, seed=seed)
+        for name in names:
+            max_rows = BENCHMARKS[name][2]
+            if max_rows is not None and n_rows > max_rows and not no_limits:
+                print(f"{name:<30}{n_rows:>10}  skipped, more than {max_rows} rows")
+                continue
+            result = measure(name, df, trace_memory)
+            results[f'{name}@{n_rows}'] = result
+            peak_memory = f"{result['peak_memory_mb']:10.1f} MB" if result['peak_memory_mb'] is not None else ''
+            print(f"{name:<30}{n_rows:>10}{result['wall_time']:10.3f} s{peak_memory}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='10000,100000,1000000', help='comma separated numbers of result rows')
+    parser.add_argument('--functions', type=str, default=','.join(BENCHMARKS), help='comma separated benchmark names')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-memory', action='store_true', help='only measure the wall time')
+    parser.add_argument('--no-limits', action='store_true', help='run slow benchmarks on all sizes')
+    parser.add_argument('--baseline', type=str, help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression against the baseline')
+    parser.add_argument('--save-baseline', type=str, help='write the results as JSON file')
+    cli_args = parser.parse_args()
+    logger.setLevel('ERROR')
+
+    names = cli_args.functions.split(',')
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {unknown}, expected some of {list(BENCHMARKS)}")
+    sizes = [int(size) for size in cli_args.sizes.split(',')]
+
+    print(f"{'function':<30}{'rows':>10}{'wall time':>12}{'peak memory':>13}")
+    results = run_benchmarks(sizes, names, cli_args.seed, not cli_args.no_memory, cli_args.no_limits)
+    if cli_args.save_baseline:
+        with open(cli_args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if cli_args.baseline:
+        with open(cli_args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, cli_args.threshold)
+        if regressions:
+            sys.exit('Benchmark regressions:\n' + '\n'.join(regressions))
+        print(f"No regressions against {cli_args.baseline}")
@@ -0,0 +1,74 @@
+# # Seeded synthetic race histories in the staging schema of the race results
+# Used by the benchmarks instead of the Athena tables, the same seed always generates the same race history.
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elo_utils import GROUPBY_COLS, RACE_LEAGUES
+
+RACE_TYPE_LEAGUE = {race_type: league for league, race_types in RACE_LEAGUES.items() for race_type in race_types}
+
+
+def generate_race_history(n_rows: int, n_riders: int = None, seed: int = 42, race_types: list = None,
+                          heats_per_event: int = 200, events_per_season: int = 10, one_rider_heat_share: float = 0.01):
+    """
+    Generate a race history of heats with 2 to 8 riders, ranked by a noisy latent skill per rider.
+    Events alternate between the race types and genders, every race has up to 4 heats and 3 rounds.
+    A small share of heats has only one rider, like in the raw data before remove_one_rider_races.
+
+    Arguments:
+        n_rows (int) - number of result rows
+        n_riders (int) - size of the rider pool, defaults to one rider per 50 result rows (at least 100)
+        seed (int) - seed of the random generator
+        race_types (list) - race types of the events, defaults to all race types of RACE_LEAGUES
+        heats_per_event (int) - number of heats per event
+        events_per_season (int) - number of events per season
+        one_rider_heat_share (float) - share of heats with only one rider
+    """
+    rng = np.random.RandomState(seed)
+    n_riders = n_riders or max(100, n_rows // 50)
+    race_types = np.array(race_types or list(RACE_TYPE_LEAGUE))
+
+    # heat sizes until n_rows is reached, the last heat is cut to fit
+    heat_sizes = rng.randint(2, 9, n_rows // 2 + 1)
+    heat_sizes[rng.rand(len(heat_sizes)) < one_rider_heat_share] = 1
+    heat_ends = np.cumsum(heat_sizes)
+    n_heats = int(np.searchsorted(heat_ends, n_rows)) + 1
+    heat_sizes = heat_sizes[:n_heats]
+    heat_sizes[-1] -= heat_ends[n_heats - 1] - n_rows
+    heat_per_row = np.repeat(np.arange(n_heats), heat_sizes)
+    position = np.arange(n_rows) - np.repeat(np.cumsum(heat_sizes) - heat_sizes, heat_sizes)
+
+    # distinct riders per heat: a random start and a step coprime to the pool size never repeat within a heat
+    steps = np.arange(1, n_riders)
+    steps = steps[np.gcd(steps, n_riders) == 1]
+    start = rng.randint(n_riders, size=n_heats)
+    step = steps[rng.randint(len(steps), size=n_heats)]
+    riders = (start[heat_per_row] + position * step[heat_per_row]) % n_riders
+
+    # rank 1 for the best performance per heat
+    skill = rng.normal(0, 1, n_riders)
+    performance = skill[riders] + rng.normal(0, 1, n_rows)
+    ranks = np.empty(n_rows, dtype=np.int64)
+    ranks[np.lexsort((-performance, heat_per_row))] = position + 1
+
+    event = heat_per_row // heats_per_event
+    race_type = race_types[event % len(race_types)]
+    df = pd.DataFrame({
+        'eventid': 1000 + event,
+        'raceid': heat_per_row // 4,
+        'racetype': race_type,
+        'gender': np.where((event // len(race_types)) % 2 == 0, 'M', 'W'),
+        'heat': heat_per_row % 4 + 1,
+        'round': (heat_per_row // 4) % 3 + 1,
+        'seasonid': 2000 + event // events_per_season,
+        'timestamp': pd.Timestamp('2000-01-01') + pd.to_timedelta(event * 7 * 24 * 60 + heat_per_row % heats_per_event, unit='m'),
+        'results_uciid': 100000 + riders,
+        'results_rank': ranks,
+        'results_status': None,
+    })
+    df['league'] = df.racetype.map(RACE_TYPE_LEAGUE)
+    return df[GROUPBY_COLS + ['seasonid', 'timestamp', 'results_uciid', 'results_rank', 'results_status', 'league']]
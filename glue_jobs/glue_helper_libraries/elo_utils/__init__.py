@@ -1,9 +1,11 @@
 # GLOBAL VARIABLES file
 import logging
 import sys
-global GROUPBY_COLS, logger
+global GROUPBY_COLS, RACE_LEAGUES, logger
 
 GROUPBY_COLS = ['eventid', 'raceid', 'racetype', 'gender', 'heat', 'round']
+# race types per league, every league has its own elo scores
+RACE_LEAGUES = {'sprint': ['Sprint', 'Keirin'], 'endurance': ['Scratch', 'Elimination Race']}
 
 stdout_handler = logging.StreamHandler(sys.stdout)
 logging.basicConfig(
@@ -0,0 +1,86 @@
+import glob
+import hashlib
+import os
+import time
+import pandas as pd
+import boto3
+import awswrangler as wr
+from elo_utils import logger
+from elo_utils.s3 import split_s3_path
+
+
+def table_fingerprint(database: str, table: str, session: boto3.Session):
+    """
+    Fingerprint of the content of a table: hash of the key, size and ETag of every object under the table location.
+    New partitions and changed or replaced files change the fingerprint without repairing the table first.
+
+    Arguments:
+        database (str) - Glue database of the table
+        table (str) - table name
+        session (boto3.Session) - boto3 session
+    """
+    location = wr.catalog.get_table_location(database=database, table=table, boto3_session=session)
+    bucket, prefix = split_s3_path(location)
+    fingerprint = hashlib.sha256()
+    paginator = session.client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        # keys are returned in ascending order, the hash is independent of the listing pagination
+        for obj in page.get('Contents', []):
+            fingerprint.update(f"{obj['Key']}|{obj['Size']}|{obj['ETag']}\n".encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def _cache_entries(cache_prefix: str, session: boto3.Session):
+    if cache_prefix.startswith('s3://'):
+        return wr.s3.list_objects(cache_prefix, boto3_session=session)
+    return glob.glob(cache_prefix + '*')
+
+
+def read_table_cached(sql: str, database: str, table: str, cache_path: str, session: boto3.Session):
+    """
+    Read-through cache of an Athena query on a table. The query result is stored as Parquet file on S3 or the local disk,
+    keyed by the query and the table fingerprint. A cache hit skips the MSCK repair of the table and the Athena query,
+    a miss runs both and replaces the outdated cache entries of the query.
+
+    Arguments:
+        sql (str) - Athena query reading from the table
+        database (str) - Glue database of the table
+        table (str) - table name
+        cache_path (str) - s3://bucket/prefix/ or local directory of the cache
+        session (boto3.Session) - boto3 session
+    """
+    start_time = time.time()
+    try:
+        fingerprint = table_fingerprint(database, table, session)
+    except Exception as e:
+        # without fingerprint the cache cannot be validated, read from Athena
+        logger.warning(f"Could not fingerprint {database}.{table}, reading without cache: {e}")
+        wr.athena.repair_table(table=table, database=database, boto3_session=session)
+        return wr.athena.read_sql_query(sql, database=database, boto3_session=session)
+
+    query_hash = hashlib.sha256(f"{database}|{table}|{sql}".encode()).hexdigest()[:16]
+    cache_prefix = os.path.join(cache_path, f"{database}.{table}.{query_hash}-")
+    cache_file = f"{cache_prefix}{fingerprint}.parquet"
+    if cache_path.startswith('s3://'):
+        is_hit = wr.s3.does_object_exist(cache_file, boto3_session=session)
+    else:
+        is_hit = os.path.exists(cache_file)
+    if is_hit:
+        df = wr.s3.read_parquet(cache_file, boto3_session=session) if cache_path.startswith('s3://') else pd.read_parquet(cache_file)
+        logger.info(f"Read {df.shape[0]} rows of {database}.{table} from cache {cache_file} in {time.time()-start_time:.2f}s")
+        return df
+
+    wr.athena.repair_table(table=table, database=database, boto3_session=session)
+    df = wr.athena.read_sql_query(sql, database=database, boto3_session=session)
+    outdated = [entry for entry in _cache_entries(cache_prefix, session) if entry != cache_file]
+    if cache_path.startswith('s3://'):
+        wr.s3.to_parquet(df, cache_file, index=False, boto3_session=session)
+        if outdated:
+            wr.s3.delete_objects(outdated, boto3_session=session)
+    else:
+        os.makedirs(cache_path, exist_ok=True)
+        df.to_parquet(cache_file, index=False)
+        for entry in outdated:
+            os.remove(entry)
+    logger.info(f"Read {df.shape[0]} rows of {database}.{table} from Athena and cached them in {cache_file} in {time.time()-start_time:.2f}s")
+    return df
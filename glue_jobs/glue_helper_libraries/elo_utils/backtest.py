@@ -0,0 +1,89 @@
+import time
+import numpy as np
+import pandas as pd
+from elo_utils import logger
+import elo_utils.elo_helper as elo_helper
+import elo_utils.trueskill_engine as engine
+from elo_utils.evaluation import evaluate_predictions
+from elo_utils.race_index import HEAT_ID_COL, build_race_index
+
+
+def _league_state(df_league: pd.DataFrame, ts):
+    # encoded heats of one league with their season and the rating state of the walk forward
+    races = engine.encode_races(df_league)
+    return {
+        'races': races,
+        # the encoded heats are in heat id order, the chronological order starting with the heat level season
+        'heat_seasons': df_league.groupby(HEAT_ID_COL).seasonid.min().values,
+        'mu': np.full(races.n_riders, ts.mu, dtype=np.float64),
+        'sigma': np.full(races.n_riders, ts.sigma, dtype=np.float64),
+        # riders who took part in a calibrated heat, the others have no elo score yet
+        'is_rated': np.zeros(races.n_riders, dtype=bool),
+        'n_calibrated_heats': 0,
+    }
+
+
+def _calibrate_until(state: dict, season, ts):
+    # continue the calibration with the heats of the seasons before season
+    races = state['races']
+    start_heat, end_heat = state['n_calibrated_heats'], int(np.searchsorted(state['heat_seasons'], season, side='left'))
+    engine.calibrate(races, state['mu'], state['sigma'], ts, start_heat=start_heat, end_heat=end_heat)
+    state['is_rated'][races.rider_ids[races.heat_offsets[start_heat]:races.heat_offsets[end_heat]]] = True
+    state['n_calibrated_heats'] = end_heat
+    is_rated = state['is_rated']
+    return engine.elos_to_frame(races.riders[is_rated], state['mu'][is_rated], state['sigma'][is_rated])
+
+
+def walk_forward_backtest(df: pd.DataFrame, ts, test_seasons: list = None, race_types: list = None, n_best: int = 1,
+                          min_train_seasons: int = 1, league_col: str = 'league'):
+    """
+    Walk forward backtest over the seasons: calibrate the elo scores up to season s, predict season s with the snapshot
+    of the elo scores and continue the calibration from the snapshot into season s+1. Every heat is calibrated once,
+    independent of the number of test seasons. Returns the metrics of evaluate_predictions per test season and race type,
+    the top n_best accuracy as rank_1_accuracy.
+
+    Arguments:
+        df (pd.DataFrame) - all race results, indexed by race_index.build_race_index (the index is built if df has no heat ids)
+        ts (trueskill.TrueSkill) - TrueSkill object
+        test_seasons (list) - seasonid to predict, defaults to every season after the first min_train_seasons seasons
+        race_types (list) - race types to score, 'all' scores all test races, defaults to ['all']
+        n_best (int) - number of best riders to consider as favourite rider
+        min_train_seasons (int) - number of seasons which are only used for training if test_seasons is not given
+        league_col (str) - column containing the league of a race, each league has its own elo scores
+    """
+    start_time = time.time()
+    if HEAT_ID_COL not in df.columns:
+        df, _ = build_race_index(df)
+    if test_seasons is None:
+        test_seasons = np.sort(df.seasonid.dropna().unique())[min_train_seasons:].tolist()
+    race_types = race_types or ['all']
+    has_leagues = league_col in df.columns
+    leagues = df[league_col].unique().tolist() if has_leagues else [None]
+    states = {league: _league_state(df[df[league_col] == league] if has_leagues else df, ts) for league in leagues}
+
+    seasons = df.seasonid.values
+    results = []
+    for season in sorted(test_seasons):
+        elos_list = []
+        for league, state in states.items():
+            df_league_elos = _calibrate_until(state, season, ts)
+            if league is not None:
+                df_league_elos[league_col] = league
+            elos_list.append(df_league_elos)
+        df_current_elos = pd.concat(elos_list, ignore_index=True)
+
+        df_train, df_test = df[seasons < season], df[seasons == season]
+        if df_test.empty:
+            continue
+        # the actual ranks are only merged for the test races, all race types are scored at once
+        df_pred = elo_helper.predict_elos(df_current_elos, df_test, df_train, df_test)
+        metrics = evaluate_predictions(df_pred, ks=[n_best], ts=ts).rename(columns={f'top_{n_best}_accuracy': 'rank_1_accuracy'})
+        metrics = metrics[metrics.index.isin(race_types)].reset_index()
+        metrics.insert(0, 'seasonid', season)
+        results.append(metrics)
+
+    n_heats = sum(state['n_calibrated_heats'] for state in states.values())
+    end_time = time.time()
+    logger.info(f"Time taken to backtest {len(test_seasons)} seasons on {n_heats} calibrated heats: {end_time-start_time:.2f}")
+
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['seasonid', 'racetype', 'n_races', 'rank_1_accuracy', 'rank_1_error'])
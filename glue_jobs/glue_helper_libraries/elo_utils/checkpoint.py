@@ -0,0 +1,172 @@
+import json
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import boto3
+from elo_utils import GROUPBY_COLS, logger
+from elo_utils.trueskill_engine import CHRONOLOGICAL_ORDER_COLS, elos_to_frame, trueskill_params
+from elo_utils.race_index import heat_codes
+from elo_utils.s3 import split_s3_path, to_builtin
+
+CHECKPOINT_VERSION = 1
+
+
+class RatingCheckpoint(object):
+    """
+    Elo scores of all riders after the last processed race, together with the watermark of that race.
+
+    Attributes:
+        riders (np.ndarray) - int64 UCIID per dense rider id
+        mu (np.ndarray) - elo mean per dense rider id
+        sigma (np.ndarray) - elo std per dense rider id
+        watermark (dict) - CHRONOLOGICAL_ORDER_COLS of the last processed race
+        config (dict) - TrueSkill parameters and race types the elo scores were calibrated with
+    """
+    def __init__(self, riders, mu, sigma, watermark, config):
+        self.riders = riders
+        self.mu = mu
+        self.sigma = sigma
+        self.watermark = watermark
+        self.config = config
+
+    def to_frame(self):
+        """
+        The elo scores in the same format as df_current_elos.
+        """
+        return elos_to_frame(self.riders, self.mu, self.sigma)
+
+    def is_compatible(self, config: dict):
+        """
+        Check if the checkpoint was calibrated with the same configuration and can be continued.
+
+        Arguments:
+            config (dict) - configuration of the current run, see calibration_config
+        """
+        return self.config == config
+
+    def check_riders(self, df: pd.DataFrame):
+        """
+        Check that the riders of the checkpoint are found again in the race results of the next run.
+        Every rider of the checkpoint was rated on earlier races which are still part of the results,
+        a checkpoint which matches none of them was written with different UCIID types and would rate every rider twice.
+
+        Arguments:
+            df (pd.DataFrame) - DataFrame containing the race result rankings of the league, including the races before the watermark
+        """
+        is_known = np.isin(self.riders, df.results_uciid.values)
+        if len(self.riders) and not is_known.any():
+            raise ValueError(f"None of the {len(self.riders)} riders of the checkpoint ({self.riders.dtype}) match the UCIIDs of the race results ({df.results_uciid.dtype})")
+        if not is_known.all():
+            logger.warning(f"{(~is_known).sum()} of {len(self.riders)} riders of the checkpoint are not in the race results anymore")
+        return 0
+
+
+def _uciids(values):
+    # UCIIDs as int64, the same type the race results are calibrated and published with
+    return pd.to_numeric(pd.Series(values)).values.astype(np.int64)
+
+
+def calibration_config(ts, race_types: list):
+    """
+    Configuration which has to stay the same to continue the calibration from a checkpoint.
+
+    Arguments:
+        ts (trueskill.TrueSkill) - TrueSkill object
+        race_types (list) - list of race types the elo scores are calibrated on
+    """
+    config = trueskill_params(ts)
+    config.update({'version': CHECKPOINT_VERSION, 'race_types': sorted(race_types)})
+    return config
+
+
+def _heat_table(df: pd.DataFrame):
+    # one row per heat code with GROUPBY_COLS and the heat level season and timestamp, and the heat code per row
+    codes = heat_codes(df)
+    is_keyed = codes >= 0
+    aggregations = dict([(col, 'first') for col in GROUPBY_COLS] + [('seasonid', 'min'), ('timestamp', 'min')])
+    heats = df[is_keyed].groupby(codes[is_keyed]).agg(aggregations)
+    heats['timestamp'] = pd.to_datetime(heats.timestamp)
+    return heats, codes
+
+
+def race_watermark(df: pd.DataFrame):
+    """
+    Watermark of the chronologically last race in df.
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+    """
+    heats, _ = _heat_table(df)
+    last_heat = heats.sort_values(CHRONOLOGICAL_ORDER_COLS).iloc[-1]
+    return {col: to_builtin(last_heat[col]) for col in CHRONOLOGICAL_ORDER_COLS}
+
+
+def filter_races_after_watermark(df: pd.DataFrame, watermark: dict):
+    """
+    Keep only the races which come chronologically after the watermark.
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+        watermark (dict) - CHRONOLOGICAL_ORDER_COLS of the last processed race
+    """
+    if df.empty:
+        return df
+    last_key = tuple(pd.Timestamp(watermark[col]) if col == 'timestamp' else watermark[col] for col in CHRONOLOGICAL_ORDER_COLS)
+    heats, codes = _heat_table(df)
+    is_new_heat = np.zeros(max(codes.max() + 1, 1), dtype=bool)
+    is_new_heat[heats.index.values] = [heat_key > last_key for heat_key in heats[CHRONOLOGICAL_ORDER_COLS].itertuples(index=False, name=None)]
+    return df[(codes >= 0) & is_new_heat[np.maximum(codes, 0)]]
+
+
+def save_checkpoint(path: str, df_current_elos: pd.DataFrame, watermark: dict, config: dict, session: boto3.Session = None):
+    """
+    Persist the elo scores and the watermark of the last processed race as .npz file on S3 or the local disk.
+
+    Arguments:
+        path (str) - s3://bucket/key or local file path of the checkpoint
+        df_current_elos (pd.DataFrame) - the most up to date elo score per rider
+        watermark (dict) - CHRONOLOGICAL_ORDER_COLS of the last processed race
+        config (dict) - configuration of the calibration, see calibration_config
+        session (boto3.Session) - boto3 session used for S3 paths
+    """
+    riders = _uciids(df_current_elos.results_uciid.values)
+    metadata = json.dumps({'watermark': watermark, 'config': config})
+    buffer = BytesIO()
+    np.savez(buffer, riders=riders, mu=df_current_elos.elo_mean.values.astype(np.float64),
+             sigma=df_current_elos.elo_std.values.astype(np.float64), metadata=np.array(metadata))
+    if path.startswith('s3://'):
+        bucket, key = split_s3_path(path)
+        session.client('s3').put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    else:
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue())
+    logger.info(f"Saved checkpoint of {len(riders)} riders with watermark {watermark} to {path}")
+    return 0
+
+
+def load_checkpoint(path: str, session: boto3.Session = None):
+    """
+    Load a checkpoint written by save_checkpoint. Returns None if there is no checkpoint yet.
+
+    Arguments:
+        path (str) - s3://bucket/key or local file path of the checkpoint
+        session (boto3.Session) - boto3 session used for S3 paths
+    """
+    if path.startswith('s3://'):
+        bucket, key = split_s3_path(path)
+        s3_client = session.client('s3')
+        try:
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except s3_client.exceptions.NoSuchKey:
+            return None
+    else:
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+    with np.load(BytesIO(body), allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+        checkpoint = RatingCheckpoint(_uciids(data['riders']), data['mu'], data['sigma'], metadata['watermark'], metadata['config'])
+    logger.info(f"Loaded checkpoint of {len(checkpoint.riders)} riders with watermark {checkpoint.watermark} from {path}")
+    return checkpoint
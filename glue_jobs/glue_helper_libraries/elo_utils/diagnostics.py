@@ -0,0 +1,200 @@
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+import boto3
+from elo_utils import GROUPBY_COLS, logger
+from elo_utils.race_index import HEAT_ID_COL, RaceIndex
+from elo_utils.s3 import json_default, split_s3_path
+
+# log level of every section of the diagnostics, a section is only computed if its level is enabled or the report is written
+SECTION_LEVELS = {
+    'races': logging.DEBUG,
+    'riders_per_race': logging.INFO,
+    'riders_per_season': logging.DEBUG,
+    'races_per_rider': logging.DEBUG,
+    'rank_consistency': logging.WARNING,
+    'duplicate_names': logging.WARNING,
+}
+# sections computed from the rider level rows
+RIDER_SECTIONS = ['riders_per_season', 'races_per_rider', 'duplicate_names']
+# maximal number of example rows per check in the log and the report
+MAX_EXAMPLES = 20
+
+
+def enabled_sections(write_report: bool = False):
+    """
+    Sections of the diagnostics whose log level is enabled, all sections if the report is written.
+
+    Arguments:
+        write_report (bool) - the JSON report is written
+    """
+    return [section for section, level in SECTION_LEVELS.items() if write_report or logger.isEnabledFor(level)]
+
+
+def _race_counts(heat_keys: pd.DataFrame):
+    return {'n_races': int(heat_keys.shape[0]), 'per_race_type': heat_keys.groupby('racetype').size().sort_index().to_dict()}
+
+
+def _unique_pair_counts(codes_a: np.ndarray, codes_b: np.ndarray, n_a: int, n_b: int):
+    # number of distinct b per a and distinct a per b, rows with a missing value (code -1) are not paired
+    is_valid = (codes_a >= 0) & (codes_b >= 0)
+    pairs = np.unique(codes_a[is_valid].astype(np.int64) * max(n_b, 1) + codes_b[is_valid])
+    return np.bincount(pairs // max(n_b, 1), minlength=n_a), np.bincount(pairs % max(n_b, 1), minlength=n_b), pairs
+
+
+def compute_diagnostics(df: pd.DataFrame, races: RaceIndex, test_seasons: list, sections: list):
+    """
+    Statistics of the cleaned race results. Heat level statistics are read from the race index, rider level statistics
+    share one factorization of the riders, race types, seasons and names instead of grouping the rows per statistic.
+    Returns the report as dict of JSON serializable values per section.
+
+    Arguments:
+        df (pd.DataFrame) - race results indexed by race_index.build_race_index
+        races (RaceIndex) - race index of df
+        test_seasons (list) - seasonid of the test data, the races are counted for all, train and test data
+        sections (list) - sections to compute, see SECTION_LEVELS
+    """
+    report = {}
+    heat_keys = races.heat_keys
+    heat_lengths = races.heat_lengths
+
+    if 'races' in sections:
+        is_test = heat_keys.seasonid.isin(test_seasons).values
+        report['races'] = {'all': _race_counts(heat_keys), 'train': _race_counts(heat_keys[~is_test]), 'test': _race_counts(heat_keys[is_test])}
+
+    if 'riders_per_race' in sections:
+        # the riders of a heat are unique after cleaning, the number of riders is the heat length
+        n_riders = pd.Series(heat_lengths, name='n_riders').groupby(heat_keys.racetype.values)
+        stats = n_riders.agg(['mean', 'median', 'std', 'min', 'max', 'count'])
+        stats.insert(0, 'mode', n_riders.agg(lambda x: x.mode().iloc[0]))
+        # estimate of randomly picking the winning rider
+        stats['guess_probability'] = 1 / stats['mode']
+        report['riders_per_race'] = stats.to_dict(orient='index')
+
+    if any(section in sections for section in RIDER_SECTIONS):
+        rider_codes, riders = pd.factorize(df.results_uciid)
+    if 'riders_per_season' in sections:
+        season_codes, seasons = pd.factorize(df.seasonid)
+        _, riders_per_season, _ = _unique_pair_counts(rider_codes, season_codes, len(riders), len(seasons))
+        report['riders_per_season'] = dict(sorted(zip(seasons.tolist(), riders_per_season.tolist())))
+
+    if 'races_per_rider' in sections:
+        race_type_codes, race_types = pd.factorize(df.racetype)
+        is_valid = (rider_codes >= 0) & (race_type_codes >= 0)
+        races_per_rider = np.bincount(rider_codes[is_valid].astype(np.int64) * len(race_types) + race_type_codes[is_valid],
+                                      minlength=len(riders) * len(race_types)).reshape(len(riders), len(race_types))
+        races_overall = races_per_rider.sum(axis=1)
+        top_riders = np.argsort(-races_overall, kind='mergesort')[:MAX_EXAMPLES]
+        report['races_per_rider'] = {
+            'n_riders': len(riders),
+            'riders_per_race_type': dict(zip(race_types.tolist(), (races_per_rider > 0).sum(axis=0).tolist())),
+            'share_more_than_1_race': float((races_overall > 1).mean()) if len(riders) else 0.,
+            'share_more_than_2_races': float((races_overall > 2).mean()) if len(riders) else 0.,
+            'share_more_than_10_races': float((races_overall > 10).mean()) if len(riders) else 0.,
+            'top_riders': [dict(results_uciid=riders[i], races_overall=races_overall[i], **dict(zip(race_types.tolist(), races_per_rider[i].tolist())))
+                           for i in top_riders],
+        }
+
+    if 'rank_consistency' in sections:
+        n_ranks = np.bincount(df[HEAT_ID_COL].values[df.results_rank.notnull().values], minlength=races.n_heats)
+        is_mismatch = n_ranks != heat_lengths
+        report['rank_consistency'] = {
+            'n_heats_rank_count_mismatch': int(is_mismatch.sum()),
+            'examples': heat_keys[GROUPBY_COLS][is_mismatch].assign(n_riders=heat_lengths[is_mismatch], n_ranks=n_ranks[is_mismatch])
+                                                            .head(MAX_EXAMPLES).to_dict(orient='records'),
+        }
+
+    if 'duplicate_names' in sections:
+        name_codes, names = pd.factorize(df.results_lastname + ' ' + df.results_firstname)
+        names_per_rider, riders_per_name, pairs = _unique_pair_counts(rider_codes, name_codes, len(riders), len(names))
+        pair_riders, pair_names = pairs // max(len(names), 1), pairs % max(len(names), 1)
+        duplicate_riders = np.flatnonzero(names_per_rider > 1)
+        duplicate_names = np.flatnonzero(riders_per_name > 1)
+        report['duplicate_names'] = {
+            'n_riders_with_several_names': len(duplicate_riders),
+            'n_names_with_several_riders': len(duplicate_names),
+            'riders_with_several_names': [{'results_uciid': riders[i], 'names': names[pair_names[pair_riders == i]].tolist()}
+                                          for i in duplicate_riders[:MAX_EXAMPLES]],
+            'names_with_several_riders': [{'name': names[i], 'results_uciid': riders[pair_riders[pair_names == i]].tolist()}
+                                          for i in duplicate_names[:MAX_EXAMPLES]],
+        }
+
+    return report
+
+
+def log_diagnostics(report: dict):
+    """
+    Log every section of the report at its level of SECTION_LEVELS.
+
+    Arguments:
+        report (dict) - diagnostics report, see compute_diagnostics
+    """
+    if 'races' in report:
+        for split, counts in report['races'].items():
+            logger.debug(f"## Races of {split} data ## Number of races overall: {counts['n_races']}")
+            logger.debug(f"Race distribution among race types:\n{pd.Series(counts['per_race_type'], dtype=np.int64).sort_index()}")
+    if 'riders_per_race' in report:
+        stats = pd.DataFrame.from_dict(report['riders_per_race'], orient='index')
+        logger.debug(f"## Number of riders per race type (all data) ##\n{stats.drop(columns='guess_probability')}")
+        logger.info(f"Probabilities of correctly guessing the winning rider per race type:\n{stats.guess_probability}")
+    if 'riders_per_season' in report:
+        logger.debug(f"Number of riders per season:\n{pd.Series(report['riders_per_season'], dtype=np.int64)}")
+    if 'races_per_rider' in report:
+        races_per_rider = report['races_per_rider']
+        logger.debug(f"Number of riders: {races_per_rider['n_riders']}, per race type: {races_per_rider['riders_per_race_type']}")
+        logger.debug(f"Percentage of riders with more than 1 race: {100.0*races_per_rider['share_more_than_1_race']:.2f}%")
+        logger.debug(f"Percentage of riders with more than 2 races: {100.0*races_per_rider['share_more_than_2_races']:.2f}%")
+        logger.debug(f"Percentage of riders with more than 10 races: {100.0*races_per_rider['share_more_than_10_races']:.2f}%")
+    if report.get('rank_consistency', {}).get('n_heats_rank_count_mismatch'):
+        rank_consistency = report['rank_consistency']
+        logger.warning(f"{rank_consistency['n_heats_rank_count_mismatch']} races of unequal number of ranks and UCIID:\n{pd.DataFrame(rank_consistency['examples'])}")
+    if report.get('duplicate_names', {}).get('n_riders_with_several_names'):
+        logger.warning(f"Duplicate names per UCIID:\n{pd.DataFrame(report['duplicate_names']['riders_with_several_names'])}")
+    if report.get('duplicate_names', {}).get('n_names_with_several_riders'):
+        logger.warning(f"Duplicate UCIIDs per name:\n{pd.DataFrame(report['duplicate_names']['names_with_several_riders'])}")
+
+
+def write_report(report: dict, path: str, session: boto3.Session = None):
+    """
+    Write the diagnostics report as JSON file on S3 or the local disk.
+
+    Arguments:
+        report (dict) - diagnostics report, see compute_diagnostics
+        path (str) - s3://bucket/key or local file path of the report
+        session (boto3.Session) - boto3 session used for S3 paths
+    """
+    body = json.dumps(report, indent=2, default=json_default)
+    if path.startswith('s3://'):
+        bucket, key = split_s3_path(path)
+        session.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        with open(path, 'w') as f:
+            f.write(body)
+    logger.info(f"Wrote diagnostics report to {path}")
+    return 0
+
+
+def run_diagnostics(df: pd.DataFrame, races: RaceIndex, test_seasons: list, report_path: str = None, session: boto3.Session = None):
+    """
+    Diagnostics stage: compute the sections whose log level is enabled, log them and write the JSON report if a path is given.
+    Nothing is computed if neither a section is enabled nor the report is written. Returns the report.
+
+    Arguments:
+        df (pd.DataFrame) - race results indexed by race_index.build_race_index
+        races (RaceIndex) - race index of df
+        test_seasons (list) - seasonid of the test data
+        report_path (str) - s3://bucket/key or local file path of the JSON report, None does not write a report
+        session (boto3.Session) - boto3 session used for S3 paths
+    """
+    sections = enabled_sections(report_path is not None)
+    if not sections:
+        return {}
+    start_time = time.time()
+    report = compute_diagnostics(df, races, test_seasons, sections)
+    log_diagnostics(report)
+    if report_path is not None:
+        write_report(report, report_path, session)
+    logger.debug(f"Time taken to compute the diagnostics {sections}: {time.time()-start_time:.2f}")
+    return report
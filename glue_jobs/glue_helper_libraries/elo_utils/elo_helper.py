@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
 import time
 from elo_utils import GROUPBY_COLS, logger
+from elo_utils.trajectory import EloTrajectory
+from elo_utils.race_index import HEAT_ID_COL, heat_codes
+from elo_utils.evaluation import evaluate_predictions
 
 def init_elos(riders: list, df_train: pd.DataFrame, ts):
     """
@@ -16,21 +20,24 @@ def init_elos(riders: list, df_train: pd.DataFrame, ts):
     for r in riders:
         current_elos[r] = ts.create_rating()
     df_current_elos = pd.Series(current_elos)
-    df_elos_trajectory = pd.concat([df_train[GROUPBY_COLS].drop_duplicates(), 
-                                  pd.DataFrame(columns=riders)], axis=1).set_index(GROUPBY_COLS)
+    # change log of the elo scores, the races are stored in the order df_train.groupby(GROUPBY_COLS) traverses them
+    if 'timestamp' in df_train.columns:
+        heat_keys = pd.to_datetime(df_train.timestamp).groupby([df_train[col] for col in GROUPBY_COLS]).min().reset_index()
+    else:
+        heat_keys = df_train[GROUPBY_COLS].drop_duplicates().sort_values(GROUPBY_COLS).reset_index(drop=True)
+    elos_trajectory = EloTrajectory(riders, ts.mu, ts.sigma, heat_keys)
     
-    return df_current_elos, df_elos_trajectory
+    return df_current_elos, elos_trajectory
 
 
-def train_elos(df_train: pd.DataFrame, current_elos: pd.DataFrame, df_elos_trajectory: pd.DataFrame, df_race_order: pd.DataFrame, ts):
+def train_elos(df_train: pd.DataFrame, current_elos: pd.DataFrame, elos_trajectory: EloTrajectory, ts):
     """
     Calibrate the elo scores by updating them race by race. 
     
     Arguments:
         df_train (pd.DataFrame) - training data used for computing the elo score per rider
         current_elos (pd.DataFrame) - the elo score which is iteratively updated per rider
-        df_elos_trajectory (pd.DataFrame) - DataFrame containing the elo score per rider and per race with dimensions: (#races, #riders)
-        df_race_order (pd.DataFrame) - DataFrame containing the order of races used for calibrating the elo scores
+        elos_trajectory (EloTrajectory) - change log receiving the elo scores of the riders taking part in each race
         ts (trueskill.TrueSkill) - TrueSkill object
     """
     # iterate thorugh matches to update scores
@@ -42,11 +49,9 @@ def train_elos(df_train: pd.DataFrame, current_elos: pd.DataFrame, df_elos_traje
         ranks_match = list(grp.results_rank.values - 1)
         elo_score_after_match = ts.rate(elo_score_before_match, ranks=ranks_match)
         # update the elo scores with the updated scores after the match
-        current_elos.loc[grp.results_uciid.values] = list(zip(*elo_score_after_match))[0]
-        df_elos_trajectory.loc[grp_idx] = current_elos
-        df_race_order.loc[grp_idx] = race_id
-    df_elos_trajectory = df_elos_trajectory.merge(df_race_order, left_index=True, right_index=True, how='left')
-    df_elos_trajectory = df_elos_trajectory.sort_values('race_order')
+        elo_score_after_match = list(zip(*elo_score_after_match))[0]
+        current_elos.loc[grp.results_uciid.values] = elo_score_after_match
+        elos_trajectory.append_uciids(race_id, grp.results_uciid.values, [r.mu for r in elo_score_after_match], [r.sigma for r in elo_score_after_match])
     
     # expand elo mean and std from rider elo
     df_current_elos = current_elos.to_frame(name='elo_rating')
@@ -58,7 +63,7 @@ def train_elos(df_train: pd.DataFrame, current_elos: pd.DataFrame, df_elos_traje
     end_time = time.time()
     logger.debug(f"Time taken to calibrate the elo scores with training data: {end_time-start_time:.2f}")
     
-    return df_current_elos, df_elos_trajectory
+    return df_current_elos, elos_trajectory
 
 def predict_elos(df_current_elos: pd.DataFrame, df_train_test: pd.DataFrame, df_train: pd.DataFrame, df_test: pd.DataFrame):
     """
@@ -70,31 +75,36 @@ def predict_elos(df_current_elos: pd.DataFrame, df_train_test: pd.DataFrame, df_
         df_train_test (pd.DataFrame) - train + test data i.e. all race results
         df_test (pd.DataFrame) - test data to evalute performance of calibrated elo scores on
     """
-    df_pred_per_racetype = []
+    # riders have one elo score per league if several leagues are calibrated together
+    elo_merge_cols = ['results_uciid'] + (['league'] if 'league' in df_current_elos.columns and 'league' in df_test.columns else [])
     # number of races per rider within training data
     races_per_rider_train = df_train.results_uciid.value_counts().rename_axis('results_uciid').to_frame(name='races_per_rider').reset_index()
-    # iterate through test data to map the rider elo scores to it
-    for grp_idx, grp in df_test.groupby(GROUPBY_COLS):
-        df_riders_pred = grp.merge(df_current_elos, on='results_uciid', how='left')
-        # merge the number of races per rider
-        df_riders_pred = df_riders_pred.merge(races_per_rider_train, on='results_uciid', how='left')
-        # predict the rank based on the sorting for each rider on the elo score
-        df_riders_pred = df_riders_pred.sort_values(GROUPBY_COLS+['elo_mean'], ascending=False)
-        df_riders_pred['pred_rank'] = 1
-        df_riders_pred.pred_rank = df_riders_pred.groupby(GROUPBY_COLS).pred_rank.cumsum()
-        # merge the true rank to it
-        df_riders_pred = df_riders_pred.merge(df_train_test[GROUPBY_COLS+['results_uciid', 'results_rank']].rename(columns={'results_rank': 'actual_rank_orig'}), 
-                                              on=GROUPBY_COLS+['results_uciid'], how='left')
-        # the true rank could be e.g. 3, 4 subtract the min rank per race from these actual ranks to get ranks starting from 1
-        df_riders_pred['actual_rank'] = df_riders_pred.actual_rank_orig - df_riders_pred.groupby(GROUPBY_COLS).actual_rank_orig.transform('min') + 1
-        df_riders_pred['pred_err'] = (df_riders_pred.actual_rank - df_riders_pred.pred_rank).abs()
-        df_pred_per_racetype.append(df_riders_pred)
+    # integer race key, the heat id of the race index or GROUPBY_COLS order, all races are predicted at once
+    df_riders_pred = df_test.dropna(subset=GROUPBY_COLS)
+    df_riders_pred = df_riders_pred.assign(race_key=heat_codes(df_riders_pred))
+    race_merge_cols = [HEAT_ID_COL] if HEAT_ID_COL in df_test.columns and HEAT_ID_COL in df_train_test.columns else GROUPBY_COLS
+    # map the rider elo scores and the number of races per rider to the test data
+    df_riders_pred = df_riders_pred.merge(df_current_elos, on=elo_merge_cols, how='left')
+    df_riders_pred = df_riders_pred.merge(races_per_rider_train, on='results_uciid', how='left')
+    # predict the rank based on the sorting for each rider on the elo score, riders without elo score last
+    elo_sort_key = np.where(df_riders_pred.elo_mean.isnull(), np.inf, -df_riders_pred.elo_mean.values.astype(float))
+    df_riders_pred = df_riders_pred.iloc[np.lexsort((np.arange(df_riders_pred.shape[0]), elo_sort_key, df_riders_pred.race_key.values))]
+    df_riders_pred['pred_rank'] = df_riders_pred.groupby('race_key').cumcount().values + 1
+    # merge the true rank to it
+    df_riders_pred = df_riders_pred.merge(df_train_test[race_merge_cols+['results_uciid', 'results_rank']].rename(columns={'results_rank': 'actual_rank_orig'}), 
+                                          on=race_merge_cols+['results_uciid'], how='left')
+    # the true rank could be e.g. 3, 4 subtract the min rank per race from these actual ranks to get ranks starting from 1
+    df_riders_pred['actual_rank'] = df_riders_pred.actual_rank_orig - df_riders_pred.groupby('race_key').actual_rank_orig.transform('min') + 1
+    df_riders_pred['pred_err'] = (df_riders_pred.actual_rank - df_riders_pred.pred_rank).abs()
+    # index by the position within the race
+    df_riders_pred.index = df_riders_pred.groupby('race_key').cumcount().values
     
-    return pd.concat(df_pred_per_racetype)
+    return df_riders_pred.drop('race_key', axis=1)
 
 def compute_rank_1_accuracy_and_error(df_pred_per_racetype: list, race_types: list, n_best: int):
     """
-    Evalute the prediction vs. the actual rank 1 by computing the accuracy, error (rank distance to the 1st rider) and number of null values (unknown elo score) for the actual rank 1 riders
+    Evalute the prediction vs. the actual rank 1 by computing the accuracy, error (rank distance to the 1st rider) and number of null values (unknown elo score) for the actual rank 1 riders.
+    The metrics are taken from evaluation.evaluate_predictions, which scores all race types of one prediction frame at once.
     
     Arguments:
         df_pred_per_racetype (list[pd.DataFrame]) - list of DataFrames containing the predicted and actual ranks per race
@@ -103,9 +113,10 @@ def compute_rank_1_accuracy_and_error(df_pred_per_racetype: list, race_types: li
     """
     rank_1_accuracy_list, rank_1_error_list, rank_1_null_list = [], [], []
     for i, (race_type, df) in enumerate(zip(race_types, df_pred_per_racetype)):
-        rank_1_accuracy_list.append((df[df.pred_rank<=n_best].groupby(GROUPBY_COLS).actual_rank.min() == 1).sum()/df[df.actual_rank==1].shape[0])
-        rank_1_error_list.append((df[df.actual_rank==1].pred_rank - 1).abs().sum()/df[df.actual_rank==1].shape[0])
-        rank_1_null_list.append(df[df.actual_rank==1].elo_mean.isnull().sum()/df[df.actual_rank==1].shape[0])
+        metrics = evaluate_predictions(df, ks=[n_best]).loc['all']
+        rank_1_accuracy_list.append(metrics[f'top_{n_best}_accuracy'])
+        rank_1_error_list.append(metrics['rank_1_error'])
+        rank_1_null_list.append(metrics['rank_1_null'])
         logger.info(f"""rank_1_accuracy_{race_types[i]}: {rank_1_accuracy_list[i]}, rank_1_error_{race_types[i]}: {rank_1_error_list[i]}, rank_1_null_{race_types[i]}: {rank_1_null_list[i]}""")
     
     return rank_1_accuracy_list, rank_1_error_list
\ No newline at end of file
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from elo_utils.race_index import heat_codes
+from elo_utils.trueskill_engine import DEFAULT_MU, DEFAULT_SIGMA, DEFAULT_BETA, cdf
+
+# lower bound of the probabilities in the log-loss
+MIN_PROBABILITY = 1e-15
+
+
+def _mean_per_type(type_codes: np.ndarray, values: np.ndarray, n_types: int):
+    # mean of the non null values per race type code, the overall mean as last element
+    is_valid = ~np.isnan(values)
+    sums = np.bincount(type_codes[is_valid], values[is_valid], minlength=n_types)
+    counts = np.bincount(type_codes[is_valid], minlength=n_types)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.append(sums / counts, sums.sum() / counts.sum() if counts.sum() else np.nan)
+
+
+def _race_pairs(race_codes: np.ndarray):
+    # row pairs (first, second) of all riders of the same race, race_codes sorted
+    race_ends = np.searchsorted(race_codes, race_codes, side='right')
+    n_pairs = race_ends - np.arange(len(race_codes)) - 1
+    first = np.repeat(np.arange(len(race_codes)), n_pairs)
+    second = first + 1 + np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    return first, second
+
+
+def evaluate_predictions(df_pred: pd.DataFrame, ks: list = (1, ), ts=None, race_type_col: str = 'racetype'):
+    """
+    Score the predicted ranks of elo_helper.predict_elos per race type and overall ('all') in one pass over the rows:
+    top k accuracy (share of races whose winner is among the k best predicted riders), mean error of the winner's predicted rank,
+    share of winners without elo score, mean absolute rank error, mean Spearman correlation and NDCG per race and the log-loss
+    of the TrueSkill win probabilities of all rider pairs. Riders without elo score are rated with the prior rating.
+
+    Arguments:
+        df_pred (pd.DataFrame) - predictions with pred_rank, actual_rank, elo_mean and elo_std, see elo_helper.predict_elos
+        ks (list) - numbers of best predicted riders of the top k accuracy
+        ts (trueskill.TrueSkill) - TrueSkill object of the elo scores, defaults to the trueskill default parameters
+        race_type_col (str) - column the metrics are grouped by
+    """
+    mu0, sigma0, beta = (ts.mu, ts.sigma, ts.beta) if ts is not None else (DEFAULT_MU, DEFAULT_SIGMA, DEFAULT_BETA)
+    codes = heat_codes(df_pred)
+    # rows sorted by race, dense race ids
+    rows = np.flatnonzero(codes >= 0)
+    rows = rows[np.argsort(codes[rows], kind='mergesort')]
+    race_codes = np.unique(codes[rows], return_inverse=True)[1]
+    n_races = race_codes.max() + 1 if len(rows) else 0
+    type_codes, race_types = pd.factorize(df_pred[race_type_col].values[rows])
+    n_types = len(race_types)
+    race_type_per_race = np.zeros(n_races, dtype=np.int64)
+    race_type_per_race[race_codes] = type_codes
+    pred_rank = df_pred.pred_rank.values[rows].astype(np.float64)
+    actual_rank = df_pred.actual_rank.values[rows].astype(np.float64)
+    elo_mean = df_pred.elo_mean.values[rows].astype(np.float64)
+    elo_std = df_pred.elo_std.values[rows].astype(np.float64)
+    metrics = {'n_races': np.append(np.bincount(race_type_per_race, minlength=n_types), n_races)}
+
+    # winners: best predicted rank of the riders with actual rank 1 per race
+    is_winner = actual_rank == 1
+    winner_pred_rank = np.full(n_races, np.inf)
+    np.minimum.at(winner_pred_rank, race_codes[is_winner], pred_rank[is_winner])
+    has_winner = np.isfinite(winner_pred_rank)
+    for k in ks:
+        metrics[f'top_{k}_accuracy'] = _mean_per_type(race_type_per_race, np.where(has_winner, winner_pred_rank <= k, np.nan), n_types)
+    metrics['rank_1_error'] = _mean_per_type(type_codes[is_winner], pred_rank[is_winner] - 1, n_types)
+    metrics['rank_1_null'] = _mean_per_type(type_codes[is_winner], np.isnan(elo_mean[is_winner]).astype(np.float64), n_types)
+    metrics['mean_rank_error'] = _mean_per_type(type_codes, np.abs(actual_rank - pred_rank), n_types)
+
+    # Spearman correlation of predicted and actual ranks per race from the per race sums
+    is_ranked = ~np.isnan(actual_rank)
+    race_sum = lambda values: np.bincount(race_codes[is_ranked], values[is_ranked], minlength=n_races)
+    n, sx, sy = race_sum(np.ones(len(rows))), race_sum(pred_rank), race_sum(actual_rank)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = race_sum(pred_rank * actual_rank) - sx * sy / n
+        var_pred, var_actual = race_sum(pred_rank ** 2) - sx ** 2 / n, race_sum(actual_rank ** 2) - sy ** 2 / n
+        spearman = np.where((var_pred > 0) & (var_actual > 0), cov / np.sqrt(var_pred * var_actual), np.nan)
+    metrics['spearman'] = _mean_per_type(race_type_per_race, spearman, n_types)
+
+    # NDCG with the relevance 1 / actual rank, the ideal order is the actual order
+    relevance = np.where(is_ranked, 1. / actual_rank, 0.)
+    dcg = np.bincount(race_codes, relevance / np.log2(pred_rank + 1), minlength=n_races)
+    ideal_order = np.lexsort((np.where(is_ranked, actual_rank, np.inf), race_codes))
+    ideal_position = np.arange(len(rows)) - np.searchsorted(race_codes, race_codes[ideal_order], side='left') + 1
+    ideal_dcg = np.bincount(race_codes[ideal_order], relevance[ideal_order] / np.log2(ideal_position + 1), minlength=n_races)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['ndcg'] = _mean_per_type(race_type_per_race, np.where(ideal_dcg > 0, dcg / ideal_dcg, np.nan), n_types)
+
+    # log-loss of the probability that the better ranked rider of every pair beats the other one
+    first, second = _race_pairs(race_codes)
+    is_decided = is_ranked[first] & is_ranked[second] & (actual_rank[first] != actual_rank[second])
+    first, second = first[is_decided], second[is_decided]
+    is_swapped = actual_rank[first] > actual_rank[second]
+    winner, loser = np.where(is_swapped, second, first), np.where(is_swapped, first, second)
+    mu = np.where(np.isnan(elo_mean), mu0, elo_mean)
+    sigma = np.where(np.isnan(elo_std), sigma0, elo_std)
+    win_probability = cdf((mu[winner] - mu[loser]) / np.sqrt(2 * beta ** 2 + sigma[winner] ** 2 + sigma[loser] ** 2))
+    metrics['log_loss'] = _mean_per_type(type_codes[winner], -np.log(np.maximum(win_probability, MIN_PROBABILITY)), n_types)
+
+    return pd.DataFrame(metrics, index=pd.Index(list(race_types) + ['all'], name=race_type_col))
@@ -1,17 +1,204 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import boto3
+from botocore.exceptions import ClientError
+from elo_utils import logger
 
-def put_elo_to_ddb(df: pd.DataFrame, ddb_table: str, session: boto3.Session):
+# maximal number of items of one BatchWriteItem request
+BATCH_WRITE_SIZE = 25
+# maximal number of keys of one BatchGetItem request
+BATCH_GET_SIZE = 100
+# errors of a whole BatchWriteItem/BatchGetItem request which are retried like unprocessed items
+RETRYABLE_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+                    'InternalServerError', 'ServiceUnavailable']
+
+
+def _favorite_key(uciid):
+    return {'pk': {'S': "RIDER#UCIID=" + str(uciid) + "#"}, 'sk': {'S': "FAVORITE#"}}
+
+
+def _elo_put_requests(df: pd.DataFrame, rating_version: int):
+    # one PutRequest of the FAVORITE# item per rider, streamed row by row
+    for uciid, elo_mean, elo_std, racetype, racetypes in df[['uciid', 'elo_mean', 'elo_std', 'racetype', 'racetypes']].itertuples(index=False, name=None):
+        yield {'PutRequest': {'Item': {
+            **_favorite_key(uciid),
+            'UCIID': {'S': str(uciid)},
+            'EloMean': {'N': str(elo_mean)},
+            'EloStd': {'N': str(elo_std)},
+            'RaceType': {'S': str(racetype)},
+            'RaceTypes': {'SS': sorted(set(str(r) for r in racetypes))},
+            'RatingVersion': {'N': str(rating_version)}
+        }}}
+
+
+def _chunks(requests, size: int):
+    chunk = []
+    for request in requests:
+        chunk.append(request)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def batch_write(dynamodb_client, ddb_table: str, requests: list, max_retries: int = 8, base_delay: float = 0.05):
+    """
+    Write up to 25 put or delete requests with BatchWriteItem. Unprocessed items and throttled requests (RETRYABLE_ERRORS)
+    are retried with exponential backoff and jitter. Returns the number of written items.
+
+    Arguments:
+        dynamodb_client (botocore.client.DynamoDB) - DynamoDB client
+        ddb_table (str) - name of the DynamoDB table
+        requests (list) - list of PutRequest/DeleteRequest dicts
+        max_retries (int) - maximal number of retries of unprocessed items
+        base_delay (float) - delay in seconds before the first retry, doubled with every retry
+    """
+    n_requests = len(requests)
+    for retry in range(max_retries + 1):
+        try:
+            response = dynamodb_client.batch_write_item(RequestItems={ddb_table: requests})
+            requests = response.get('UnprocessedItems', {}).get(ddb_table, [])
+            if not requests:
+                return n_requests
+        except ClientError as ex:
+            if ex.response['Error']['Code'] not in RETRYABLE_ERRORS or retry == max_retries:
+                raise
+        if retry < max_retries:
+            time.sleep(base_delay * 2**retry * random.uniform(0.5, 1.5))
+    raise RuntimeError(f"{len(requests)} items were not written to {ddb_table} after {max_retries} retries")
+
+
+def batch_get(dynamodb_client, ddb_table: str, keys: list, projection: str, max_retries: int = 8, base_delay: float = 0.05):
+    """
+    Read up to 100 items with a strongly consistent BatchGetItem. Unprocessed keys and throttled requests (RETRYABLE_ERRORS)
+    are retried with exponential backoff and jitter. Returns the list of found items.
+
+    Arguments:
+        dynamodb_client (botocore.client.DynamoDB) - DynamoDB client
+        ddb_table (str) - name of the DynamoDB table
+        keys (list) - list of key dicts
+        projection (str) - ProjectionExpression of the read attributes
+        max_retries (int) - maximal number of retries of unprocessed keys
+        base_delay (float) - delay in seconds before the first retry, doubled with every retry
+    """
+    items = []
+    for retry in range(max_retries + 1):
+        try:
+            response = dynamodb_client.batch_get_item(RequestItems={ddb_table: {'Keys': keys, 'ProjectionExpression': projection, 'ConsistentRead': True}})
+            items.extend(response.get('Responses', {}).get(ddb_table, []))
+            keys = response.get('UnprocessedKeys', {}).get(ddb_table, {}).get('Keys', [])
+            if not keys:
+                return items
+        except ClientError as ex:
+            if ex.response['Error']['Code'] not in RETRYABLE_ERRORS or retry == max_retries:
+                raise
+        if retry < max_retries:
+            time.sleep(base_delay * 2**retry * random.uniform(0.5, 1.5))
+    raise RuntimeError(f"{len(keys)} items were not read from {ddb_table} after {max_retries} retries")
+
+
+def stale_elos(dynamodb_client, ddb_table: str, df: pd.DataFrame, decimals: int = 4, max_workers: int = 8):
+    """
+    Riders whose FAVORITE# item does not hold their elo score of df: the item is missing, was updated online by the
+    ingestion lambda since it was published (OnlineRatedRaces) or has another elo score. Returns the rows of df to rewrite.
+
+    Arguments:
+        dynamodb_client (botocore.client.DynamoDB) - DynamoDB client
+        ddb_table (str) - name of the DynamoDB table
+        df (pd.DataFrame) - elo scores per rider with uciid, elo_mean and elo_std, see elos_per_rider
+        decimals (int) - number of decimals the elo scores are compared on
+        max_workers (int) - number of threads sending the BatchGetItem requests
+    """
+    if df.empty:
+        return df
+    keys = [_favorite_key(uciid) for uciid in df.uciid]
+    chunks = [keys[start:start + BATCH_GET_SIZE] for start in range(0, len(keys), BATCH_GET_SIZE)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        items = [item for chunk_items in executor.map(
+            lambda chunk: batch_get(dynamodb_client, ddb_table, chunk, 'UCIID, EloMean, EloStd, OnlineRatedRaces'), chunks)
+            for item in chunk_items]
+    df_items = pd.DataFrame({
+        'uciid': [item['UCIID']['S'] for item in items],
+        'item_elo_mean': [float(item['EloMean']['N']) for item in items],
+        'item_elo_std': [float(item['EloStd']['N']) for item in items],
+        'online_rated': [bool(item.get('OnlineRatedRaces', {}).get('SS')) for item in items]})
+    merged = df[['uciid', 'elo_mean', 'elo_std']].astype({'uciid': str}).merge(df_items, on='uciid', how='left')
+    is_stale = (merged.item_elo_mean.isnull()
+                | (merged.online_rated == True)
+                | (merged.elo_mean.round(decimals) != merged.item_elo_mean.round(decimals))
+                | (merged.elo_std.round(decimals) != merged.item_elo_std.round(decimals)))
+    return df[is_stale.values]
+
+
+def elos_per_rider(df: pd.DataFrame):
+    """
+    Collapse the elo scores per rider and race type into one row per rider with the list of race types in racetypes.
+    Race types of the same league share the elo score. A rider with elo scores in several leagues keeps the elo score
+    of the last league in df, racetype is the last race type of that league.
+
+    Arguments:
+        df (pd.DataFrame) - elo scores with uciid, elo_mean, elo_std and racetype
+    """
+    df_riders = df.groupby(['uciid', 'elo_mean', 'elo_std'], sort=False).racetype.agg(list).reset_index(name='racetypes')
+    df_riders['racetype'] = df_riders.racetypes.str[-1]
+    return df_riders.drop_duplicates('uciid', keep='last').reset_index(drop=True)
+
+
+def changed_elos(df: pd.DataFrame, df_previous: pd.DataFrame, decimals: int = 4):
+    """
+    Keep the riders which are new or whose elo mean or std changed compared to the previously published elo scores.
+
+    Arguments:
+        df (pd.DataFrame) - elo scores to publish with uciid, elo_mean and elo_std
+        df_previous (pd.DataFrame) - previously published elo scores in the same format, None publishes all riders
+        decimals (int) - number of decimals the elo scores are compared on
+    """
+    if df_previous is None or df_previous.empty:
+        return df
+    df_previous = df_previous[['uciid', 'elo_mean', 'elo_std']].drop_duplicates('uciid', keep='last')
+    df_previous = df_previous.astype({'uciid': df.uciid.dtype})
+    merged = df[['uciid', 'elo_mean', 'elo_std']].merge(df_previous, on='uciid', how='left', suffixes=('', '_previous'))
+    is_changed = (merged.elo_mean_previous.isnull()
+                  | (merged.elo_mean.round(decimals) != merged.elo_mean_previous.round(decimals))
+                  | (merged.elo_std.round(decimals) != merged.elo_std_previous.round(decimals)))
+    return df[is_changed.values]
+
+
+def put_elo_to_ddb(df: pd.DataFrame, ddb_table: str, session: boto3.Session, df_previous: pd.DataFrame = None, max_workers: int = 8):
+    """
+    Publish the elo score per rider as FAVORITE# item with concurrent 25 item BatchWriteItem requests. Every rider is written
+    once, the race types the elo score is used for are stored in RaceTypes, see elos_per_rider.
+    Riders whose elo score did not change since the previously published elo scores are skipped, unless their item
+    does not hold that elo score anymore, e.g. after online updates of the ingestion lambda (see stale_elos).
+    Returns the number of written items.
+
+    Arguments:
+        df (pd.DataFrame) - elo scores with uciid, elo_mean, elo_std and racetype, one row per rider and race type
+        ddb_table (str) - name of the DynamoDB table
+        session (boto3.Session) - boto3 session
+        df_previous (pd.DataFrame) - previously published elo scores in the same format as df, see changed_elos
+        max_workers (int) - number of threads sending the BatchWriteItem requests
+    """
+    start_time = time.time()
+    # boto3 clients are thread safe, sessions are not
     dynamodb_client = session.client('dynamodb')
-    data_item = df.to_dict('index')
-    for item in data_item:
-        ddb_item = {
-            'pk': {'S': "RIDER#UCIID=" + str(data_item[item].get('uciid', "")) + "#"},
-            'sk': {'S': "FAVORITE#"},
-            'UCIID': {'S': str(data_item[item].get('uciid', ""))},
-            'EloMean': {'N': str(data_item[item].get('elo_mean', ""))},
-            'EloStd': {'N': str(data_item[item].get('elo_std', ""))},
-            'RaceType': {'S': str(data_item[item].get('racetype', ""))}
-        }
-        dynamodb_client.put_item(TableName=ddb_table, Item=ddb_item)  
-    return 0
\ No newline at end of file
+    # the batch calibration takes over the online updates of the ingestion lambda: a new rating version
+    # makes their pending conditional writes fail and drops the list of online rated races
+    rating_version = int(time.time() * 1000)
+    df_riders = elos_per_rider(df)
+    df_changed = changed_elos(df_riders, elos_per_rider(df_previous) if df_previous is not None else None)
+    if df_changed.shape[0] < df_riders.shape[0]:
+        # the batch calibration takes over the online updates of the unchanged riders
+        df_unchanged = df_riders[~df_riders.uciid.isin(df_changed.uciid)]
+        df_stale = stale_elos(dynamodb_client, ddb_table, df_unchanged, max_workers=max_workers)
+        logger.info(f"Rewriting {df_stale.shape[0]} of {df_unchanged.shape[0]} unchanged elo scores whose item was updated online or differs")
+        df_changed = pd.concat([df_changed, df_stale])
+    chunks = _chunks(_elo_put_requests(df_changed, rating_version), BATCH_WRITE_SIZE)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        n_written = sum(executor.map(lambda chunk: batch_write(dynamodb_client, ddb_table, chunk), chunks))
+    end_time = time.time()
+    logger.info(f"Published {n_written} of {df_riders.shape[0]} elo scores to {ddb_table} in {end_time-start_time:.2f}s, {df_riders.shape[0]-df_changed.shape[0]} unchanged")
+    return n_written
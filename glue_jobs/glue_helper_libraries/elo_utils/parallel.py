@@ -0,0 +1,124 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import trueskill
+from elo_utils import logger
+import elo_utils.trueskill_engine as engine
+from elo_utils.race_index import HEAT_ID_COL
+
+
+def rider_components(races: engine.EncodedRaces):
+    """
+    Connected components of the rider co-occurrence graph. Riders are connected if they took part in the same heat,
+    riders of different components never influence each other's elo score.
+    Returns the component label per dense rider id, the label is the smallest rider id of the component.
+
+    Arguments:
+        races (EncodedRaces) - encoded race results
+    """
+    labels = np.arange(races.n_riders)
+    if races.n_heats == 0 or len(races.rider_ids) == 0:
+        return labels
+    heat_starts = races.heat_offsets[:-1]
+    heat_lengths = np.diff(races.heat_offsets)
+    # propagate the smallest label through the heats until it is stable
+    while True:
+        heat_min = np.minimum.reduceat(labels[races.rider_ids], heat_starts)
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, races.rider_ids, np.repeat(heat_min, heat_lengths))
+        new_labels = new_labels[new_labels]
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+
+def assign_partitions(df: pd.DataFrame, n_partitions: int):
+    """
+    Assign every row to one of n_partitions independent rating partitions. Complete connected components
+    of the rider co-occurrence graph are packed into the partitions, balanced by the number of result rows.
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+        n_partitions (int) - maximal number of partitions
+    """
+    # the components do not depend on the heat order, the heat ids of the race index save the groupby
+    races = engine.encode_races(df, chronological=HEAT_ID_COL in df.columns)
+    component_per_rider = rider_components(races)
+    component_per_row = component_per_rider[pd.Index(races.riders).get_indexer(df.results_uciid.values)]
+    component_sizes = pd.Series(component_per_row).value_counts()
+    # greedy packing, largest components first into the currently smallest partition
+    partition_rows = np.zeros(n_partitions, dtype=np.int64)
+    partition_per_component = {}
+    for component, size in component_sizes.items():
+        partition = int(partition_rows.argmin())
+        partition_per_component[component] = partition
+        partition_rows[partition] += size
+    return pd.Series(component_per_row).map(partition_per_component).values
+
+
+def _train_partition(task):
+    # worker: calibrate one partition with the array based engine, the TrueSkill object is not picklable
+    df_partition, ts_params, initial_elos, chronological = task
+    ts = trueskill.TrueSkill(**ts_params)
+    df_current_elos, _ = engine.train_elos(df_partition, ts, initial_elos=initial_elos, chronological=chronological)
+    return df_current_elos
+
+
+def train_elos_partitioned(df_train: pd.DataFrame, ts, initial_elos: pd.DataFrame = None, league_col: str = 'league', max_workers: int = None, chronological: bool = True):
+    """
+    Calibrate the elo scores of independent rating partitions in parallel worker processes. Each league is calibrated separately
+    and is split into connected components of riders competing against each other, so the result is the same as calibrating
+    every league on its own.
+
+    Arguments:
+        df_train (pd.DataFrame) - training data used for computing the elo score per rider
+        ts (trueskill.TrueSkill) - TrueSkill object
+        initial_elos (pd.DataFrame) - elo scores to continue the calibration from, in the format of df_current_elos (plus league_col)
+        league_col (str) - column containing the league of a race, each league has its own elo scores. Without this column df_train is treated as one league
+        max_workers (int) - number of worker processes, defaults to the number of cpus
+        chronological (bool) - replay the heats in chronological order (True) or in GROUPBY_COLS order (False)
+    """
+    start_time = time.time()
+    max_workers = max_workers or os.cpu_count() or 1
+    has_leagues = league_col in df_train.columns
+    leagues = df_train[league_col].unique().tolist() if has_leagues else [None]
+
+    ts_params = engine.trueskill_params(ts)
+    tasks = []
+    for league in leagues:
+        df_league = df_train[df_train[league_col] == league] if has_leagues else df_train
+        initial_league = initial_elos
+        if initial_elos is not None and has_leagues:
+            initial_league = initial_elos[initial_elos[league_col] == league]
+        partitions = assign_partitions(df_league, max_workers)
+        for _, df_partition in df_league.groupby(partitions):
+            initial_partition = None
+            if initial_league is not None:
+                initial_partition = initial_league[initial_league.results_uciid.isin(df_partition.results_uciid)][['results_uciid', 'elo_mean', 'elo_std']]
+            tasks.append((league, (df_partition, ts_params, initial_partition, chronological)))
+    logger.debug(f"Calibrating {len(tasks)} partitions of {len(leagues)} leagues with {max_workers} workers")
+
+    if max_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_train_partition, [task for _, task in tasks]))
+    else:
+        results = [_train_partition(task) for _, task in tasks]
+
+    elos_list = []
+    for (league, _), df_current_elos in zip(tasks, results):
+        if has_leagues:
+            df_current_elos[league_col] = league
+        elos_list.append(df_current_elos)
+    key_cols = ['results_uciid'] + ([league_col] if has_leagues else [])
+    if initial_elos is not None:
+        # riders without new races keep the elo score they started with
+        elos_list.append(initial_elos[key_cols + ['elo_mean', 'elo_std']])
+    if not elos_list:
+        return pd.DataFrame(columns=key_cols + ['elo_mean', 'elo_std'])
+    df_current_elos = pd.concat(elos_list, ignore_index=True).drop_duplicates(key_cols, keep='first').reset_index(drop=True)
+    end_time = time.time()
+    logger.debug(f"Time taken to calibrate the elo scores of all partitions: {end_time-start_time:.2f}")
+
+    return df_current_elos
@@ -0,0 +1,49 @@
+from elo_utils import GROUPBY_COLS
+
+# columns of the race results used by the elo calibration, the remaining columns of the source tables are not scanned
+RESULT_COLUMNS = GROUPBY_COLS + ['seasonid', 'timestamp', 'racename', 'results_uciid', 'results_rank', 'results_status',
+                                 'results_firstname', 'results_lastname']
+
+
+def source_race_types(race_types: list, proxy_elimination_with_omnium: bool):
+    """
+    Race types to read from the source tables, Omnium is read as proxy for Elimination Race.
+
+    Arguments:
+        race_types (list) - race types to calibrate
+        proxy_elimination_with_omnium (bool) - use Omnium as proxy for Elimination Race (True) or not (False)
+    """
+    race_types_extended = list(race_types)
+    if 'Elimination Race' in race_types and proxy_elimination_with_omnium:
+        race_types_extended.append('Omnium')
+    return race_types_extended
+
+
+def _quote(value: str):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _identifier(name: str):
+    # column names like timestamp and round are quoted to not be read as keywords
+    return '"' + name.replace('"', '""') + '"'
+
+
+def race_results_query(table_name: str, race_types: list, columns: list = RESULT_COLUMNS, column_sources: dict = None, min_date_part: str = None):
+    """
+    Athena query of the race results of the given race types. The projection and the filters on race type,
+    UCIID and date are pushed down to Athena, only the needed columns and rows are scanned and returned.
+
+    Arguments:
+        table_name (str) - source table with the race results
+        race_types (list) - race types to read, see source_race_types
+        columns (list) - columns to read
+        column_sources (dict) - source column per column which is named differently in the table, e.g. {'seasonid': 'season'}
+        min_date_part (str) - only read the races with date_part on or after this date, e.g. '2021-10-01'
+    """
+    column_sources = column_sources or {}
+    projection = ', '.join(f"{_identifier(column_sources.get(col, col))} AS {_identifier(col)}" for col in columns)
+    conditions = [f"{_identifier('racetype')} IN ({', '.join(_quote(race_type) for race_type in race_types)})",
+                  f"{_identifier('results_uciid')} IS NOT NULL"]
+    if min_date_part is not None:
+        conditions.append(f"{_identifier('date_part')} >= {_quote(min_date_part)}")
+    return f"SELECT {projection} FROM {table_name} WHERE {' AND '.join(conditions)}"
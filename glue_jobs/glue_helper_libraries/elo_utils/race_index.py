@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from elo_utils import GROUPBY_COLS
+
+# heat level sort order used to replay the races in the order they were ridden
+CHRONOLOGICAL_ORDER_COLS = ['seasonid', 'timestamp', 'eventid', 'raceid', 'racetype', 'gender', 'round', 'heat']
+# column of the dense integer heat key assigned by build_race_index
+HEAT_ID_COL = 'heat_id'
+
+
+class RaceIndex(object):
+    """
+    Shared integer key of the heats of the cleaned race results. The heat ids are dense, in chronological order
+    and the rows of the indexed DataFrame are sorted by heat id and rank.
+
+    Attributes:
+        heat_keys (pd.DataFrame) - GROUPBY_COLS, heat level seasonid and timestamp per heat id
+        heat_offsets (np.ndarray) - start row of every heat in the indexed DataFrame plus the total number of rows as last element
+    """
+    def __init__(self, heat_keys, heat_offsets):
+        self.heat_keys = heat_keys
+        self.heat_offsets = heat_offsets
+
+    @property
+    def n_heats(self):
+        return len(self.heat_offsets) - 1
+
+    @property
+    def heat_lengths(self):
+        return np.diff(self.heat_offsets).astype(np.int32)
+
+    def heats(self, df: pd.DataFrame = None):
+        """
+        Heat keys with the number of result rows of the heats in df, all heats of the index by default.
+
+        Arguments:
+            df (pd.DataFrame) - subset of the indexed DataFrame, e.g. the train or test data
+        """
+        if df is None:
+            n_rows = self.heat_lengths
+        else:
+            n_rows = np.bincount(df[HEAT_ID_COL].values, minlength=self.n_heats)
+        heat_ids = np.flatnonzero(n_rows)
+        return self.heat_keys.iloc[heat_ids].assign(n_rows=n_rows[heat_ids])
+
+    def rows_per_heat(self):
+        """
+        Number of result rows per heat as Series indexed by GROUPBY_COLS, like df.groupby(GROUPBY_COLS).size().
+        """
+        return pd.Series(self.heat_lengths, index=pd.MultiIndex.from_frame(self.heat_keys[GROUPBY_COLS]))
+
+
+def heat_codes(df: pd.DataFrame):
+    """
+    Integer heat key per row: the heat id of the race index if df is indexed, otherwise the group number of GROUPBY_COLS
+    (-1 for rows with missing key values).
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+    """
+    if HEAT_ID_COL in df.columns:
+        return df[HEAT_ID_COL].values
+    return df.groupby(GROUPBY_COLS).ngroup().values
+
+
+def build_race_index(df: pd.DataFrame):
+    """
+    Assign every heat a dense int32 heat id in chronological order (CHRONOLOGICAL_ORDER_COLS with the heat level season
+    and timestamp) and sort the rows by heat id and rank. Build it once after cleaning, later groupings, splits and
+    statistics run on the heat id instead of GROUPBY_COLS. Rows with missing key values are dropped.
+    Returns the indexed DataFrame and the RaceIndex.
+
+    Arguments:
+        df (pd.DataFrame) - cleaned DataFrame containing the race result rankings with seasonid and timestamp
+    """
+    df = df.dropna(subset=GROUPBY_COLS).reset_index(drop=True)
+    # the only groupby on the six key columns
+    codes = df.groupby(GROUPBY_COLS, sort=False).ngroup().values
+    heat_table = df[GROUPBY_COLS].assign(seasonid=df.seasonid, timestamp=pd.to_datetime(df.timestamp)).groupby(codes).agg(
+        dict([(col, 'first') for col in GROUPBY_COLS] + [('seasonid', 'min'), ('timestamp', 'min')]))
+    heat_order = heat_table.sort_values(CHRONOLOGICAL_ORDER_COLS, kind='mergesort').index.values
+    heat_id_per_code = np.empty(len(heat_order), dtype=np.int32)
+    heat_id_per_code[heat_order] = np.arange(len(heat_order), dtype=np.int32)
+    heat_ids = heat_id_per_code[codes]
+
+    # stable sort, tied ranks keep their order like trueskill does
+    rows = np.lexsort((df.results_rank.values, heat_ids))
+    df = df.iloc[rows].reset_index(drop=True)
+    df[HEAT_ID_COL] = heat_ids[rows]
+    heat_offsets = np.searchsorted(df[HEAT_ID_COL].values, np.arange(len(heat_order) + 1)).astype(np.int64)
+    heat_keys = heat_table.iloc[heat_order][GROUPBY_COLS + ['seasonid', 'timestamp']].reset_index(drop=True)
+
+    return df, RaceIndex(heat_keys, heat_offsets)
@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
 import time
 from elo_utils import GROUPBY_COLS, logger
+from elo_utils.race_index import heat_codes
 
 def remove_disqualified_riders(df: pd.DataFrame):
     """
@@ -21,50 +23,102 @@ def remove_one_rider_races(df: pd.DataFrame):
     Arguments:
         df (pd.DataFrame) - DataFrame containing the race result rankings
     """
-    df['ranks_per_race'] = df.groupby(GROUPBY_COLS).results_rank.transform('count')
+    codes = heat_codes(df)
+    is_ranked = (codes >= 0) & df.results_rank.notnull().values
+    # number of ranks per heat code, rows with missing key values count as heats without ranks
+    ranks_per_heat = np.bincount(codes[is_ranked], minlength=max(codes.max() + 1 if len(codes) else 0, 1))
+    df['ranks_per_race'] = np.where(codes >= 0, ranks_per_heat[np.maximum(codes, 0)], 0)
     # filter on heats with more than one rider
     df = df[df.ranks_per_race > 1]
     return df
 
 
+class HeatQualityReport(object):
+    """
+    Violations of the rank consistency checks per heat, see validate_heats.
+
+    Attributes:
+        n_heats (int) - number of checked heats
+        n_rows (int) - number of checked rows
+        rank_count_mismatch (pd.DataFrame) - GROUPBY_COLS, min_rank, max_rank and n_ranks of heats where max rank - min rank + 1 differs from the number of ranks
+        duplicated_ranks (pd.DataFrame) - GROUPBY_COLS and results_rank of ranks occurring more than once in a heat
+        rank_gaps (pd.DataFrame) - GROUPBY_COLS, results_rank and rank_diff of rows whose rank differs from the previous rank of the heat by other than 1
+    """
+    def __init__(self, n_heats, n_rows, rank_count_mismatch, duplicated_ranks, rank_gaps):
+        self.n_heats = n_heats
+        self.n_rows = n_rows
+        self.rank_count_mismatch = rank_count_mismatch
+        self.duplicated_ranks = duplicated_ranks
+        self.rank_gaps = rank_gaps
+
+    @property
+    def is_valid(self):
+        return self.rank_count_mismatch.empty and self.duplicated_ranks.empty and self.rank_gaps.empty
+
+    def summary(self):
+        """
+        Number of violations per check.
+        """
+        return {'n_heats': self.n_heats, 'n_rows': self.n_rows, 'rank_count_mismatch': self.rank_count_mismatch.shape[0],
+                'duplicated_ranks': self.duplicated_ranks.shape[0], 'rank_gaps': self.rank_gaps.shape[0]}
+
+
+def validate_heats(df: pd.DataFrame):
+    """
+    Check the ranks of every heat in one pass over the rows sorted by integer heat code and rank, see race_index.heat_codes.
+    Check 1: max rank, min rank and therefore rank count match up per heat
+    Check 2: no duplicated ranks per heat
+    Check 3: the difference between subsequent ranks is 1
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+    """
+    codes = heat_codes(df)
+    ranks = df.results_rank.values.astype(np.float64)
+    rows = np.flatnonzero((codes >= 0) & ~np.isnan(ranks))
+    rows = rows[np.lexsort((ranks[rows], codes[rows]))]
+    sorted_codes, sorted_ranks = codes[rows], ranks[rows]
+    heat_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+    heat_ends = np.r_[heat_starts[1:], len(rows)]
+    heat_keys = lambda positions: df[GROUPBY_COLS].iloc[rows[positions]].reset_index(drop=True)
+
+    # check 1 on the first and last rank of every heat
+    min_rank, max_rank, n_ranks = sorted_ranks[heat_starts], sorted_ranks[heat_ends - 1], heat_ends - heat_starts
+    is_mismatch = max_rank - min_rank + 1 != n_ranks
+    rank_count_mismatch = heat_keys(heat_starts[is_mismatch]).assign(
+        min_rank=min_rank[is_mismatch], max_rank=max_rank[is_mismatch], n_ranks=n_ranks[is_mismatch])
+
+    # checks 2 and 3 on the differences of subsequent ranks within a heat
+    rank_diff = np.diff(sorted_ranks)
+    same_heat = sorted_codes[1:] == sorted_codes[:-1]
+    is_duplicate = same_heat & (rank_diff == 0)
+    is_duplicate_start = is_duplicate & ~np.r_[False, is_duplicate[:-1]]
+    duplicated_ranks = heat_keys(np.flatnonzero(is_duplicate_start) + 1).assign(results_rank=sorted_ranks[1:][is_duplicate_start])
+    is_gap = same_heat & (rank_diff != 1)
+    rank_gaps = heat_keys(np.flatnonzero(is_gap) + 1).assign(results_rank=sorted_ranks[1:][is_gap], rank_diff=rank_diff[is_gap])
+
+    return HeatQualityReport(len(heat_starts), len(rows), rank_count_mismatch, duplicated_ranks, rank_gaps)
+
+
 def check_heat_stats(df: pd.DataFrame): 
     """
-    Checks performed per heat and rank.
-    Check 1: check if max rank, min rank and therefore rank count match up per heat
-    Check 2: check for duplicated ranks per heat and rank
-    Check 3: check if difference between subsequent ranks is not 1
+    Run validate_heats and log a warning per failed check. Returns the HeatQualityReport.
     
     Arguments:
         df (pd.DataFrame) - DataFrame containing the race result rankings
     """
-    df['min_rank_per_race'] = df.groupby(GROUPBY_COLS).results_rank.transform('min')
-    df['max_rank_per_race'] = df.groupby(GROUPBY_COLS).results_rank.transform('max')
-    
-    # check if max rank, min rank and therefore rank count match up
-    check1 = df[df.max_rank_per_race - df.min_rank_per_race + 1 != df.ranks_per_race]
-    if not check1.empty:
-        if check1.shape[0] <= 10:
-            display(check1)
-        number_of_cases = check1.drop_duplicates(subset=GROUPBY_COLS)
-        logger.warning(f"Failed check 1: Number of ranks is unequal to difference between max and min rank in {number_of_cases.shape[0]} number of cases.")
-    
-    # Check for duplicated ranks per heat and rank
-    check_duplicated_ranks = df[df.duplicated(subset=GROUPBY_COLS+['results_rank'], keep=False)]
-    if not check_duplicated_ranks.empty:
-        if check_duplicated_ranks.shape[0] <= 10:
-            display(check_duplicated_ranks)
-        number_of_duplicates = check_duplicated_ranks.drop_duplicates(subset=GROUPBY_COLS+['results_rank'])
-        logger.warning(f"Failed duplicated ranks. {number_of_duplicates.shape[0]} Duplicates in {GROUPBY_COLS+['results_rank']}.")
-    
-    df = df.sort_values(GROUPBY_COLS+['results_rank'])
-    df['rank_diff'] = df.groupby(GROUPBY_COLS).results_rank.apply(lambda x: x) - df.groupby(GROUPBY_COLS).results_rank.shift(1)
-    check3 = df[~((df.rank_diff==1) | (df.rank_diff.isnull()))]
-    if not check3.empty:
-        if check3.shape[0] <= 10:
-            display(check3)
-        logger.warning(f"Failed check 3: difference between subsequent ranks is not always 1 or null. In {check3.shape[0]} cases this is not fulfilled.")
+    report = validate_heats(df)
+    if not report.rank_count_mismatch.empty:
+        logger.warning(f"Failed check 1: Number of ranks is unequal to difference between max and min rank in {report.rank_count_mismatch.shape[0]} number of cases.")
+        logger.debug(f"\n{report.rank_count_mismatch.head(10)}")
+    if not report.duplicated_ranks.empty:
+        logger.warning(f"Failed duplicated ranks. {report.duplicated_ranks.shape[0]} Duplicates in {GROUPBY_COLS+['results_rank']}.")
+        logger.debug(f"\n{report.duplicated_ranks.head(10)}")
+    if not report.rank_gaps.empty:
+        logger.warning(f"Failed check 3: difference between subsequent ranks is not always 1 or null. In {report.rank_gaps.shape[0]} cases this is not fulfilled.")
+        logger.debug(f"\n{report.rank_gaps.head(10)}")
         
-    return 0
+    return report
 
 def train_test_split(df: pd.DataFrame, test_season: list):
     """
@@ -77,8 +131,10 @@ def train_test_split(df: pd.DataFrame, test_season: list):
     test_idx = (df.seasonid.isin(test_season))
     df_train = df[~test_idx].copy()
     df_test = df[test_idx].copy()
-    n_overall_races = df[GROUPBY_COLS].drop_duplicates().shape[0]
-    n_train_races = df_train[GROUPBY_COLS].drop_duplicates().shape[0]
-    n_test_races = df_test[GROUPBY_COLS].drop_duplicates().shape[0]
+    codes = heat_codes(df)
+    n_heats = lambda heat_codes_subset: len(np.unique(heat_codes_subset[heat_codes_subset >= 0]))
+    n_overall_races = n_heats(codes)
+    n_train_races = n_heats(codes[~test_idx.values])
+    n_test_races = n_heats(codes[test_idx.values])
     logger.info(f"Number of Heats/races in test data: {n_test_races}.\nPercentage split of races in train/test: {100.0*n_train_races/n_overall_races:.2f}%/{100.0*n_test_races/n_overall_races:.2f}%")
     return df_train, df_test, test_idx
\ No newline at end of file
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+
+def split_s3_path(path: str):
+    """
+    Split an S3 path into bucket and key.
+
+    Arguments:
+        path (str) - s3://bucket/key path
+    """
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def to_builtin(value):
+    """
+    JSON serializable version of numpy and pandas values, other values are returned unchanged.
+
+    Arguments:
+        value (object) - value to convert
+    """
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def json_default(value):
+    """
+    default function of json.dumps for numpy and pandas values.
+
+    Arguments:
+        value (object) - value json can not serialize
+    """
+    builtin = to_builtin(value)
+    if builtin is value:
+        raise TypeError(f"{type(value)} is not JSON serializable")
+    return builtin
@@ -0,0 +1,133 @@
+import itertools
+import multiprocessing
+import os
+import time
+import numpy as np
+import pandas as pd
+import trueskill
+from elo_utils import logger
+import elo_utils.elo_helper as elo_helper
+import elo_utils.trueskill_engine as engine
+from elo_utils.evaluation import evaluate_predictions
+
+# metrics of evaluate_predictions added to the leaderboard per race type
+LEADERBOARD_METRICS = ['spearman', 'ndcg', 'log_loss']
+
+# encoded races and test data shared by all configurations, set by _init_worker once per worker process
+# (the pool initializer) so the data is not pickled per configuration
+_shared = {}
+
+
+def parameter_grid(param_grid: dict):
+    """
+    All combinations of the TrueSkill parameter values of a grid search.
+
+    Arguments:
+        param_grid (dict) - list of values per trueskill.TrueSkill parameter, e.g. {'beta': [2.0, 4.2], 'tau': [0.05, 0.1]}
+    """
+    names = sorted(param_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[param_grid[name] for name in names])]
+
+
+def random_parameters(param_distributions: dict, n_iter: int, seed: int = 0):
+    """
+    Random TrueSkill parameter configurations of a random search.
+
+    Arguments:
+        param_distributions (dict) - per trueskill.TrueSkill parameter either a (low, high) tuple sampled uniformly or a list of values sampled from
+        n_iter (int) - number of configurations
+        seed (int) - seed of the random generator
+    """
+    random_state = np.random.RandomState(seed)
+    configs = []
+    for _ in range(n_iter):
+        params = {}
+        for name in sorted(param_distributions):
+            distribution = param_distributions[name]
+            if isinstance(distribution, tuple):
+                params[name] = float(random_state.uniform(*distribution))
+            else:
+                params[name] = distribution[random_state.randint(len(distribution))]
+        configs.append(params)
+    return configs
+
+
+def _init_worker(shared: dict):
+    _shared.clear()
+    _shared.update(shared)
+
+
+def _evaluate_params(params: dict):
+    # worker: calibrate every league with one configuration and score the predictions on the test data
+    ts = trueskill.TrueSkill(**params)
+    elos_list = []
+    for league, races in _shared['races'].items():
+        mu = np.full(races.n_riders, ts.mu, dtype=np.float64)
+        sigma = np.full(races.n_riders, ts.sigma, dtype=np.float64)
+        engine.calibrate(races, mu, sigma, ts)
+        df_league_elos = engine.elos_to_frame(races.riders, mu, sigma)
+        if league is not None:
+            df_league_elos['league'] = league
+        elos_list.append(df_league_elos)
+    df_current_elos = pd.concat(elos_list, ignore_index=True)
+
+    # the races are predicted independently, one prediction of the test data is scored for all race types at once
+    df_pred = elo_helper.predict_elos(df_current_elos, _shared['df_train_test'], _shared['df_train'], _shared['df_test'])
+    metrics = evaluate_predictions(df_pred, ks=[_shared['n_best']], ts=ts).reindex(_shared['race_types'])
+
+    scores = engine.trueskill_params(ts)
+    for race_type, race_type_metrics in metrics.iterrows():
+        scores[f'rank_1_accuracy_{race_type}'] = race_type_metrics[f"top_{_shared['n_best']}_accuracy"]
+        scores[f'rank_1_error_{race_type}'] = race_type_metrics['rank_1_error']
+        for metric in LEADERBOARD_METRICS:
+            scores[f'{metric}_{race_type}'] = race_type_metrics[metric]
+    return scores
+
+
+def run_sweep(configs: list, df_train: pd.DataFrame, df_train_test: pd.DataFrame, df_test: pd.DataFrame, race_types: list,
+              n_best: int = 1, league_col: str = 'league', max_workers: int = None, chronological: bool = True):
+    """
+    Evaluate TrueSkill parameter configurations in parallel worker processes and rank them in a leaderboard.
+    The training data is encoded once and shared by all configurations, every configuration is scored with
+    evaluate_predictions on the test data. The leaderboard is sorted by the rank 1 accuracy of the first
+    race type, ties are broken by the rank 1 error.
+
+    Arguments:
+        configs (list) - list of trueskill.TrueSkill parameter dicts, see parameter_grid and random_parameters
+        df_train (pd.DataFrame) - training data used for computing the elo score per rider
+        df_train_test (pd.DataFrame) - train + test data i.e. all race results
+        df_test (pd.DataFrame) - test data to evalute performance of calibrated elo scores on
+        race_types (list) - race types to score, 'all' scores the whole test data
+        n_best (int) - number of best riders to consider as favourite rider
+        league_col (str) - column containing the league of a race, each league has its own elo scores
+        max_workers (int) - number of worker processes, defaults to the number of cpus
+        chronological (bool) - replay the heats in chronological order (True) or in GROUPBY_COLS order (False)
+    """
+    start_time = time.time()
+    max_workers = max_workers or os.cpu_count() or 1
+    if league_col in df_train.columns:
+        races = {league: engine.encode_races(df_league, chronological=chronological) for league, df_league in df_train.groupby(league_col)}
+    else:
+        races = {None: engine.encode_races(df_train, chronological=chronological)}
+    shared = {'races': races, 'df_train': df_train, 'df_train_test': df_train_test, 'df_test': df_test,
+              'race_types': list(race_types), 'n_best': n_best}
+    logger.info(f"Evaluating {len(configs)} TrueSkill configurations with {max_workers} workers")
+
+    if max_workers > 1 and len(configs) > 1:
+        # multiprocessing.Pool, the initializer of ProcessPoolExecutor needs python 3.7. Works with fork and spawn
+        with multiprocessing.Pool(processes=max_workers, initializer=_init_worker, initargs=(shared,)) as pool:
+            results = pool.map(_evaluate_params, configs, chunksize=1)
+    else:
+        _init_worker(shared)
+        try:
+            results = [_evaluate_params(params) for params in configs]
+        finally:
+            _shared.clear()
+
+    leaderboard = pd.DataFrame(results)
+    leaderboard = leaderboard.sort_values([f'rank_1_accuracy_{race_types[0]}', f'rank_1_error_{race_types[0]}'], ascending=[False, True], kind='mergesort')
+    leaderboard.insert(0, 'rank', np.arange(1, leaderboard.shape[0] + 1))
+    end_time = time.time()
+    logger.info(f"Time taken to evaluate {len(configs)} TrueSkill configurations: {end_time-start_time:.2f}")
+
+    return leaderboard.reset_index(drop=True)
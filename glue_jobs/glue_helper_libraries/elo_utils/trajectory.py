@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+
+class EloTrajectory(object):
+    """
+    Columnar change log of the elo scores. Instead of storing every rider's elo score after every race
+    only the (race_order, rider, mu, sigma) rows of the riders taking part in a race are kept.
+    The elo scores at any race are rebuilt from the initial scores and the changes up to that race, a per rider
+    index of the log answers every lookup with a binary search.
+
+    Arguments:
+        riders (list) - list of unique rider UCIIDS, the position in the list is the rider id used in the log
+        initial_mu (float or np.ndarray) - elo mean of every rider before the first race
+        initial_sigma (float or np.ndarray) - elo std of every rider before the first race
+        heat_keys (pd.DataFrame) - GROUPBY_COLS and optionally the timestamp of every race, the row position is the race_order
+    """
+    def __init__(self, riders: list, initial_mu, initial_sigma, heat_keys: pd.DataFrame = None):
+        self.riders = pd.Index(riders)
+        self.initial_mu = initial_mu
+        self.initial_sigma = initial_sigma
+        self.heat_keys = heat_keys
+        # append buffers, consolidated into arrays on first read
+        self._buffers = ([], [], [], [])
+        self._arrays = None
+        self._rider_order = None
+        self._rider_offsets = None
+        self._rider_keys = None
+        self._key_span = None
+        self._race_times = None
+
+    def append(self, race_order: int, rider_ids, mu, sigma):
+        """
+        Log the elo scores of the riders after the race with the given race_order. Races have to be appended in race order.
+
+        Arguments:
+            race_order (int) - position of the race in the calibration
+            rider_ids (list) - rider ids of the riders taking part in the race
+            mu (list) - elo mean per rider after the race
+            sigma (list) - elo std per rider after the race
+        """
+        race_orders, rider_id_buffer, mu_buffer, sigma_buffer = self._buffers
+        race_orders.extend([race_order] * len(rider_ids))
+        rider_id_buffer.extend(rider_ids)
+        mu_buffer.extend(mu)
+        sigma_buffer.extend(sigma)
+        self._arrays = None
+
+    def append_uciids(self, race_order: int, uciids, mu, sigma):
+        """
+        Same as append, but the riders are given by their UCIID.
+        """
+        self.append(race_order, self.riders.get_indexer(uciids), mu, sigma)
+
+    @property
+    def arrays(self):
+        """
+        Tuple of the race_order, rider id, mu and sigma arrays of the log.
+        """
+        if self._arrays is None:
+            race_orders, rider_ids, mu, sigma = self._buffers
+            self._arrays = (np.asarray(race_orders, dtype=np.int32), np.asarray(rider_ids, dtype=np.int32),
+                            np.asarray(mu, dtype=np.float64), np.asarray(sigma, dtype=np.float64))
+            self._rider_order = None
+        return self._arrays
+
+    def __len__(self):
+        return len(self._buffers[0])
+
+    def _rider_index(self):
+        # rows of the log grouped per rider, in race order within each rider
+        if self._rider_order is None:
+            race_orders, rider_ids, _, _ = self.arrays
+            self._rider_order = np.argsort(rider_ids, kind='mergesort')
+            self._rider_offsets = np.concatenate([[0], np.cumsum(np.bincount(rider_ids, minlength=len(self.riders)))])
+            # sorted (rider id, race_order) search keys of the grouped rows
+            self._key_span = int(race_orders.max()) + 2 if len(race_orders) else 1
+            self._rider_keys = rider_ids[self._rider_order].astype(np.int64) * self._key_span + race_orders[self._rider_order]
+        return self._rider_order, self._rider_offsets
+
+    def rider_trajectory(self, uciid):
+        """
+        Elo mean and std of one rider after every race the rider took part in.
+
+        Arguments:
+            uciid - UCIID of the rider
+        """
+        rider_id = self.riders.get_loc(uciid)
+        rider_order, rider_offsets = self._rider_index()
+        rows = rider_order[rider_offsets[rider_id]:rider_offsets[rider_id + 1]]
+        race_orders, _, mu, sigma = self.arrays
+        return pd.DataFrame({'race_order': race_orders[rows], 'elo_mean': mu[rows], 'elo_std': sigma[rows]})
+
+    def ratings_as_of(self, race_order: int, uciids: list = None):
+        """
+        Elo mean and std of the riders after the race with the given race_order, in the same format as df_current_elos.
+        Every rider is looked up with a binary search in its part of the log. Riders unknown to the log get NaN.
+
+        Arguments:
+            race_order (int) - position of the race in the calibration, -1 returns the initial elo scores
+            uciids (list) - UCIIDs of the riders, e.g. a start list, defaults to all riders
+        """
+        rider_order, rider_offsets = self._rider_index()
+        _, _, mu, sigma = self.arrays
+        uciids = self.riders.values if uciids is None else np.asarray(uciids)
+        rider_ids = self.riders.get_indexer(uciids)
+        is_known = rider_ids >= 0
+        rider_ids = rider_ids[is_known]
+        # last logged row of the rider with a race_order up to the race
+        race_order = min(max(int(race_order), -1), self._key_span - 2)
+        positions = np.searchsorted(self._rider_keys, rider_ids.astype(np.int64) * self._key_span + race_order, side='right')
+        has_row = positions > rider_offsets[rider_ids]
+        rows = rider_order[positions[has_row] - 1]
+        known_mu = np.array(np.broadcast_to(self.initial_mu, len(self.riders))[rider_ids], dtype=np.float64)
+        known_sigma = np.array(np.broadcast_to(self.initial_sigma, len(self.riders))[rider_ids], dtype=np.float64)
+        known_mu[has_row] = mu[rows]
+        known_sigma[has_row] = sigma[rows]
+        current_mu = np.full(len(uciids), np.nan)
+        current_sigma = np.full(len(uciids), np.nan)
+        current_mu[is_known] = known_mu
+        current_sigma[is_known] = known_sigma
+        return pd.DataFrame({'results_uciid': uciids, 'elo_mean': current_mu, 'elo_std': current_sigma})
+
+    def race_order_at(self, timestamp):
+        """
+        Race order of the last race such that all races up to it started at or before the timestamp, -1 if there is none.
+        Requires the timestamp in heat_keys. If the races were not replayed chronologically, later races started before
+        the timestamp are not included.
+
+        Arguments:
+            timestamp (str or pd.Timestamp) - point in time
+        """
+        if self._race_times is None:
+            if self.heat_keys is None or 'timestamp' not in self.heat_keys.columns:
+                raise ValueError('The trajectory has no race timestamps')
+            # NaT is the smallest int64 and never moves the running maximum
+            race_times = pd.to_datetime(self.heat_keys.timestamp).values.astype('datetime64[ns]').view(np.int64)
+            self._race_times = np.maximum.accumulate(race_times) if len(race_times) else race_times
+        return int(np.searchsorted(self._race_times, pd.Timestamp(timestamp).value, side='right')) - 1
+
+    def ratings_as_of_time(self, timestamp, uciids: list = None):
+        """
+        Elo mean and std of the riders after all races up to the timestamp, see ratings_as_of and race_order_at.
+
+        Arguments:
+            timestamp (str or pd.Timestamp) - point in time
+            uciids (list) - UCIIDs of the riders, e.g. a start list, defaults to all riders
+        """
+        return self.ratings_as_of(self.race_order_at(timestamp), uciids)
+
+    def to_frame(self):
+        """
+        The change log as DataFrame with one row per rider and race, including the GROUPBY_COLS of the race if known.
+        """
+        race_orders, rider_ids, mu, sigma = self.arrays
+        df = pd.DataFrame({'race_order': race_orders, 'results_uciid': self.riders.values[rider_ids], 'elo_mean': mu, 'elo_std': sigma})
+        if self.heat_keys is not None:
+            df = self.heat_keys.iloc[race_orders].reset_index(drop=True).join(df)
+        return df
@@ -0,0 +1,310 @@
+import math
+import time
+import numpy as np
+import pandas as pd
+import trueskill
+from elo_utils import GROUPBY_COLS, logger
+from elo_utils.trajectory import EloTrajectory
+from elo_utils.race_index import CHRONOLOGICAL_ORDER_COLS, HEAT_ID_COL
+
+# trueskill defaults, riders without elo score are rated with the prior rating
+DEFAULT_MU = trueskill.MU
+DEFAULT_SIGMA = trueskill.SIGMA
+DEFAULT_BETA = trueskill.BETA
+
+
+def erfc(x: np.ndarray):
+    """
+    Complementary error function of the trueskill default backend (Numerical Recipes erfcc), vectorized.
+
+    Arguments:
+        x (np.ndarray) - values
+    """
+    z = np.abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (.37409196 + t * (.09678418 + t * (-.18628806 + t * (
+        .27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-.82215223 + t * .17087277)))))))))
+    return np.where(x < 0, 2. - r, r)
+
+
+def cdf(x: np.ndarray):
+    """
+    Cumulative distribution function of the standard normal distribution, same values as trueskill.TrueSkill.cdf, vectorized.
+
+    Arguments:
+        x (np.ndarray) - values
+    """
+    return .5 * erfc(-x / math.sqrt(2))
+
+
+class EncodedRaces(object):
+    """
+    Race results encoded as flat arrays, one row per rider and heat, sorted heat by heat.
+
+    Attributes:
+        riders (np.ndarray) - UCIID per dense rider id
+        rider_ids (np.ndarray) - dense rider id per row
+        ranks (np.ndarray) - results_rank per row, ascending within a heat
+        heat_offsets (np.ndarray) - start row of every heat plus the total number of rows as last element
+        heat_keys (pd.DataFrame) - GROUPBY_COLS (and the heat level timestamp if known) of every heat in the order the heats are replayed
+    """
+    def __init__(self, riders, rider_ids, ranks, heat_offsets, heat_keys):
+        self.riders = riders
+        self.rider_ids = rider_ids
+        self.ranks = ranks
+        self.heat_offsets = heat_offsets
+        self.heat_keys = heat_keys
+
+    @property
+    def n_heats(self):
+        return len(self.heat_offsets) - 1
+
+    @property
+    def n_riders(self):
+        return len(self.riders)
+
+
+def encode_races(df: pd.DataFrame, riders: list = None, chronological: bool = True):
+    """
+    Encode the race results as dense integer rider ids and precomputed heat boundaries.
+
+    Arguments:
+        df (pd.DataFrame) - DataFrame containing the race result rankings
+        riders (list) - list of unique rider UCIIDS defining the rider ids, defaults to the riders in order of appearance in df
+        chronological (bool) - replay the heats ordered by CHRONOLOGICAL_ORDER_COLS (True) or by GROUPBY_COLS like df.groupby(GROUPBY_COLS) (False)
+    """
+    df = df.dropna(subset=GROUPBY_COLS).reset_index(drop=True)
+    if riders is None:
+        riders = df.results_uciid.drop_duplicates().tolist()
+    riders = pd.Index(riders)
+    # the heat ids of the race index are in chronological order
+    by_heat_id = chronological and HEAT_ID_COL in df.columns
+    if by_heat_id:
+        df_sorted = df.iloc[np.lexsort((df.results_rank.values, df[HEAT_ID_COL].values))]
+    elif chronological:
+        # rows of one heat share the same heat level season and timestamp and therefore stay contiguous
+        df_order = df[GROUPBY_COLS].copy()
+        df_order['seasonid'] = df.groupby(GROUPBY_COLS).seasonid.transform('min')
+        df_order['timestamp'] = df.groupby(GROUPBY_COLS).timestamp.transform('min')
+        df_order['results_rank'] = df.results_rank
+        sort_cols = CHRONOLOGICAL_ORDER_COLS + ['results_rank']
+    else:
+        df_order = df[GROUPBY_COLS+['results_rank']]
+        sort_cols = GROUPBY_COLS + ['results_rank']
+    if not by_heat_id:
+        # stable sort to keep the order of tied ranks the same as trueskill does
+        df_sorted = df.iloc[df_order.sort_values(sort_cols, kind='mergesort').index]
+
+    rider_ids = riders.get_indexer(df_sorted.results_uciid)
+    if (rider_ids < 0).any():
+        raise ValueError('df contains riders which are not part of the riders list')
+    heat_codes = df_sorted[HEAT_ID_COL].values if by_heat_id else df_sorted.groupby(GROUPBY_COLS, sort=False).ngroup().values
+    if len(heat_codes):
+        heat_offsets = np.concatenate([[0], np.flatnonzero(np.diff(heat_codes)) + 1, [len(heat_codes)]])
+    else:
+        heat_offsets = np.zeros(1)
+    heat_keys = df_sorted[GROUPBY_COLS].iloc[heat_offsets[:-1]].reset_index(drop=True)
+    if 'timestamp' in df.columns and len(heat_codes):
+        heat_keys['timestamp'] = pd.to_datetime(df_sorted.timestamp).groupby(heat_codes).min().values
+
+    return EncodedRaces(riders.values, rider_ids.astype(np.int32), df_sorted.results_rank.values, heat_offsets.astype(np.int64), heat_keys)
+
+
+def _combine(pi_a: float, pi_b: float):
+    # precision of the sum or difference of two independent gaussian messages
+    pi_inv = (1. / pi_a if pi_a else math.inf) + (1. / pi_b if pi_b else math.inf)
+    return 1. / pi_inv
+
+
+def rate_heat(mu: list, sigma: list, ranks: list, ts, draw_margin: float, min_delta: float = trueskill.DELTA):
+    """
+    Free-for-all TrueSkill update of one heat. Follows the message passing schedule of trueskill.TrueSkill.rate
+    for teams of one rider, but works on plain floats instead of factor graph objects.
+
+    Arguments:
+        mu (list) - elo mean per rider, ordered by rank
+        sigma (list) - elo std per rider, ordered by rank
+        ranks (list) - rank per rider in ascending order, equal ranks are treated as draw
+        ts (trueskill.TrueSkill) - TrueSkill object
+        draw_margin (float) - draw margin between two riders, see trueskill.calc_draw_margin
+        min_delta (float) - convergence threshold of the message passing loop
+    """
+    n = len(mu)
+    beta2 = ts.beta ** 2
+    tau2 = ts.tau ** 2
+    # prior (including the dynamic tau) and performance messages per rider
+    prior_pi = [1. / (s * s + tau2) for s in sigma]
+    prior_tau = [p * m for p, m in zip(prior_pi, mu)]
+    perf_pi, perf_tau = [], []
+    for p, t in zip(prior_pi, prior_tau):
+        a = 1. / (1. + beta2 * p)
+        perf_pi.append(a * p)
+        perf_tau.append(a * t)
+    # messages of the difference factors to the rider on their left and right side
+    left_pi, left_tau = [0.] * n, [0.] * n
+    right_pi, right_tau = [0.] * n, [0.] * n
+    # messages of the difference and truncate factors to the difference variables
+    diff_pi, diff_tau = [0.] * (n - 1), [0.] * (n - 1)
+    trunc_pi, trunc_tau = [0.] * (n - 1), [0.] * (n - 1)
+    is_draw = [ranks[j] == ranks[j + 1] for j in range(n - 1)]
+
+    def down(j):
+        a_pi, a_tau = perf_pi[j] + left_pi[j], perf_tau[j] + left_tau[j]
+        b_pi, b_tau = perf_pi[j + 1] + right_pi[j + 1], perf_tau[j + 1] + right_tau[j + 1]
+        diff_mu = (a_pi and a_tau / a_pi) - (b_pi and b_tau / b_pi)
+        pi = _combine(a_pi, b_pi)
+        diff_pi[j], diff_tau[j] = pi, pi * diff_mu
+
+    def truncate(j):
+        div_pi, div_tau = diff_pi[j], diff_tau[j]
+        sqrt_pi = math.sqrt(div_pi)
+        args = (div_tau / sqrt_pi, draw_margin * sqrt_pi)
+        if is_draw[j]:
+            v, w = ts.v_draw(*args), ts.w_draw(*args)
+        else:
+            # same as ts.v_win and ts.w_win without evaluating v twice
+            x = args[0] - args[1]
+            cdf = ts.cdf(x)
+            v = ts.pdf(x) / cdf if cdf else -x
+            w = v * (v + x)
+            if not 0 < w < 1:
+                raise FloatingPointError('Cannot calculate correctly, set backend to "mpmath"')
+        denom = 1. - w
+        pi, tau = div_pi / denom, (div_tau + sqrt_pi * v) / denom
+        pi_delta = abs(div_pi + trunc_pi[j] - pi)
+        delta = 0. if pi_delta == math.inf else max(abs(div_tau + trunc_tau[j] - tau), math.sqrt(pi_delta))
+        trunc_pi[j], trunc_tau[j] = pi - div_pi, tau - div_tau
+        return delta
+
+    def up_right(j):
+        a_pi, a_tau = perf_pi[j] + left_pi[j], perf_tau[j] + left_tau[j]
+        b_pi, b_tau = trunc_pi[j], trunc_tau[j]
+        team_mu = (a_pi and a_tau / a_pi) - (b_pi and b_tau / b_pi)
+        pi = _combine(a_pi, b_pi)
+        left_pi[j + 1], left_tau[j + 1] = pi, pi * team_mu
+
+    def up_left(j):
+        a_pi, a_tau = trunc_pi[j], trunc_tau[j]
+        b_pi, b_tau = perf_pi[j + 1] + right_pi[j + 1], perf_tau[j + 1] + right_tau[j + 1]
+        team_mu = (a_pi and a_tau / a_pi) + (b_pi and b_tau / b_pi)
+        pi = _combine(a_pi, b_pi)
+        right_pi[j], right_tau[j] = pi, pi * team_mu
+
+    n_diffs = n - 1
+    for _ in range(10):
+        if n_diffs == 1:
+            down(0)
+            delta = truncate(0)
+        else:
+            delta = 0.
+            for j in range(n_diffs - 1):
+                down(j)
+                delta = max(delta, truncate(j))
+                up_right(j)
+            for j in range(n_diffs - 1, 0, -1):
+                down(j)
+                delta = max(delta, truncate(j))
+                up_left(j)
+        if delta <= min_delta:
+            break
+    up_left(0)
+    up_right(n_diffs - 1)
+
+    # send the messages back from the performance to the rating of every rider
+    new_mu, new_sigma = [], []
+    for i in range(n):
+        m_pi, m_tau = left_pi[i] + right_pi[i], left_tau[i] + right_tau[i]
+        pi = 1. / (1. / m_pi) if m_pi else 0.
+        tau = pi * (m_pi and m_tau / m_pi)
+        a = 1. / (1. + beta2 * pi)
+        pi, tau = prior_pi[i] + a * pi, prior_tau[i] + a * tau
+        new_mu.append(tau / pi)
+        new_sigma.append(math.sqrt(1. / pi))
+    return new_mu, new_sigma
+
+
+def calibrate(races: EncodedRaces, mu: np.ndarray, sigma: np.ndarray, ts, elos_trajectory: EloTrajectory = None, start_heat: int = 0, end_heat: int = None):
+    """
+    Update the elo scores in place by replaying the encoded heats in order, all heats by default.
+
+    Arguments:
+        races (EncodedRaces) - encoded race results
+        mu (np.ndarray) - elo mean per dense rider id, updated in place
+        sigma (np.ndarray) - elo std per dense rider id, updated in place
+        ts (trueskill.TrueSkill) - TrueSkill object
+        elos_trajectory (EloTrajectory) - optional change log receiving the elo scores after every heat, the heat position is the race_order
+        start_heat (int) - position of the first heat to replay, calibrating consecutive heat ranges continues the calibration
+        end_heat (int) - position after the last heat to replay, defaults to all remaining heats
+    """
+    if callable(ts.draw_probability):
+        raise ValueError('Dynamic draw probabilities are not supported by the array based calibration')
+    draw_margin = trueskill.calc_draw_margin(ts.draw_probability, 2, env=ts)
+    rider_ids = races.rider_ids
+    ranks = races.ranks.tolist()
+    end_heat = races.n_heats if end_heat is None else end_heat
+    offsets = races.heat_offsets[start_heat:end_heat + 1].tolist()
+    for race_order, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]), start_heat):
+        # heats with one rider have neither winner nor loser
+        if end - start < 2:
+            continue
+        idx = rider_ids[start:end]
+        new_mu, new_sigma = rate_heat(mu[idx].tolist(), sigma[idx].tolist(), ranks[start:end], ts, draw_margin)
+        mu[idx], sigma[idx] = new_mu, new_sigma
+        if elos_trajectory is not None:
+            elos_trajectory.append(race_order, idx, new_mu, new_sigma)
+    return mu, sigma
+
+
+def trueskill_params(ts):
+    """
+    Parameters of a TrueSkill object as dict, trueskill.TrueSkill(**params) creates an equivalent object.
+    Used where the TrueSkill object itself cannot be pickled or serialized.
+
+    Arguments:
+        ts (trueskill.TrueSkill) - TrueSkill object
+    """
+    return {'mu': ts.mu, 'sigma': ts.sigma, 'beta': ts.beta, 'tau': ts.tau, 'draw_probability': ts.draw_probability}
+
+
+def elos_to_frame(riders: np.ndarray, mu: np.ndarray, sigma: np.ndarray):
+    """
+    Build the df_current_elos DataFrame with one row per rider.
+
+    Arguments:
+        riders (np.ndarray) - UCIID per dense rider id
+        mu (np.ndarray) - elo mean per dense rider id
+        sigma (np.ndarray) - elo std per dense rider id
+    """
+    return pd.DataFrame({'results_uciid': riders, 'elo_mean': mu, 'elo_std': sigma})
+
+
+def train_elos(df_train: pd.DataFrame, ts, riders: list = None, chronological: bool = True, initial_elos: pd.DataFrame = None):
+    """
+    Calibrate the elo scores with the array based TrueSkill engine. Replacement for elo_helper.train_elos returning the same df_current_elos and elos_trajectory.
+
+    Arguments:
+        df_train (pd.DataFrame) - training data used for computing the elo score per rider
+        ts (trueskill.TrueSkill) - TrueSkill object
+        riders (list) - list of unique rider UCIIDS, defaults to the riders in order of appearance in df_train
+        chronological (bool) - replay the heats in chronological order (True) or in GROUPBY_COLS order like elo_helper.train_elos (False)
+        initial_elos (pd.DataFrame) - elo scores to continue the calibration from, in the format of df_current_elos. Riders not contained start with the default rating
+    """
+    start_time = time.time()
+    if riders is None:
+        riders = df_train.results_uciid.drop_duplicates().tolist()
+    if initial_elos is not None:
+        known_riders = pd.Index(initial_elos.results_uciid)
+        riders = known_riders.tolist() + [r for r in riders if r not in known_riders]
+    races = encode_races(df_train, riders, chronological)
+    mu = np.full(races.n_riders, ts.mu, dtype=np.float64)
+    sigma = np.full(races.n_riders, ts.sigma, dtype=np.float64)
+    if initial_elos is not None:
+        mu[:len(initial_elos)] = initial_elos.elo_mean.values
+        sigma[:len(initial_elos)] = initial_elos.elo_std.values
+    elos_trajectory = EloTrajectory(races.riders, mu.copy(), sigma.copy(), races.heat_keys)
+    calibrate(races, mu, sigma, ts, elos_trajectory)
+    df_current_elos = elos_to_frame(races.riders, mu, sigma)
+    end_time = time.time()
+    logger.debug(f"Time taken to calibrate the elo scores of {races.n_heats} heats with training data: {end_time-start_time:.2f}")
+
+    return df_current_elos, elos_trajectory
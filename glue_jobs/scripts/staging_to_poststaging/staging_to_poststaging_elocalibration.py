@@ -13,8 +13,18 @@ import sys
 import re
 from elo_utils import *
 import elo_utils.elo_helper as elo_helper
+import elo_utils.trueskill_engine as engine
+import elo_utils.parallel as parallel
 import elo_utils.race_preprocessing as preproc
 import elo_utils.io as io
+import elo_utils.checkpoint as ckpt
+import elo_utils.sweep as sweep
+import elo_utils.athena_cache as athena_cache
+import elo_utils.queries as queries
+import elo_utils.race_index as race_index
+import elo_utils.diagnostics as diagnostics
+import elo_utils.backtest as backtest
+import elo_utils.evaluation as evaluation
 try:
     from awsglue.utils import getResolvedOptions
     glue_mode = True
@@ -23,7 +33,7 @@ except:
     
 if glue_mode:
     args = getResolvedOptions(sys.argv, ['src_database', 'src_table_historicresults', 'src_table_raceresults', 'target_bucket', 'target_database', 'target_table', 
-                                         'ddb_table', 'USE_TRIMARAN_DATA', 'PROXY_ELIMINATION_WITH_OMNIUM', 'RACE_LEAGUE', 'LOGGER_LEVEL'])
+                                         'ddb_table', 'USE_TRIMARAN_DATA', 'PROXY_ELIMINATION_WITH_OMNIUM', 'RACE_LEAGUE', 'LOGGER_LEVEL', 'FULL_REBUILD', 'SWEEP_MODE', 'DIAGNOSTICS_REPORT', 'BACKTEST'])
     print(args)
     src_database = args['src_database'] #'dev_eurosport_cycling_staging'
     src_table_historicresults = args['src_table_historicresults'] #'ucichampionshiphistoricresults'
@@ -37,18 +47,20 @@ if glue_mode:
     # Configuration of parameters
     
     # use Trimaran race result data or not
-    USE_TRIMARAN_DATA = args['USE_TRIMARAN_DATA'] # bool: True, False
+    USE_TRIMARAN_DATA = args['USE_TRIMARAN_DATA'].lower() == 'true' # bool: True, False
     # use Omnium as proxy for Elimination (True) or not (False)
-    PROXY_ELIMINATION_WITH_OMNIUM = args['PROXY_ELIMINATION_WITH_OMNIUM'] # bool: True, False
-    RACE_LEAGUE = args['RACE_LEAGUE'] # string: 'endurance', 'sprint'
-    if RACE_LEAGUE.lower() == 'sprint':
-        RACE_TYPES = ['Sprint', 'Keirin']
-    elif RACE_LEAGUE.lower() == 'endurance':
-        RACE_TYPES = ['Scratch', 'Elimination Race'] 
-    else:
-        raise ValueError('Wrong value for RACE_LEAGUE. Expected values: "endurance" or "sprint"')
+    PROXY_ELIMINATION_WITH_OMNIUM = args['PROXY_ELIMINATION_WITH_OMNIUM'].lower() == 'true' # bool: True, False
+    RACE_LEAGUE = args['RACE_LEAGUE'] # string: 'endurance', 'sprint', 'all'
     # logger level
     LOGGER_LEVEL = args['LOGGER_LEVEL'] # string: 'DEBUG', 'INFO', 'WARNING', 'ERROR'
+    # recalibrate all races (True) or only the races after the last checkpoint (False)
+    FULL_REBUILD = args['FULL_REBUILD'].lower() == 'true' # bool: True, False
+    # TrueSkill hyper-parameter sweep on the train/test split instead of calibrating the elo scores
+    SWEEP_MODE = args['SWEEP_MODE'].lower() # string: 'none', 'grid', 'random'
+    # write the race statistics as JSON report, the statistics are computed only if the report or their log level is enabled
+    DIAGNOSTICS_REPORT = args['DIAGNOSTICS_REPORT'].lower() == 'true' # bool: True, False
+    # walk forward backtest over all seasons instead of calibrating the elo scores
+    BACKTEST = args['BACKTEST'].lower() == 'true' # bool: True, False
     # evalute Performance: 
     # True: do a train/test split and evalute performance on test data
     # False: no train/test split, using all data for training
@@ -58,6 +70,16 @@ if glue_mode:
     EVALUATE_PERFORMANCE_N_BEST_RIDERS = 1 # int: 1, 2, 3, ...
     # Plot graphs of data for Data Analysis and debugging
     DEBUG_PLOTS = False
+    # rating checkpoint per league of the last run, used to only calibrate the races after its watermark
+    checkpoint_path = lambda league: f's3://{target_bucket}/checkpoints/{target_table}/{league}.npz'
+    # leaderboard of the TrueSkill configurations evaluated by the sweep
+    sweep_leaderboard_path = f's3://{target_bucket}/sweeps/{target_table}/leaderboard_{RACE_LEAGUE.lower()}.csv'
+    # rank 1 accuracy and error per season and race type of the walk forward backtest
+    backtest_path = f's3://{target_bucket}/backtests/{target_table}/backtest_{RACE_LEAGUE.lower()}.csv'
+    # Parquet cache of the source tables, reused while the files of a table do not change
+    athena_cache_path = f's3://{target_bucket}/cache/{target_table}/'
+    # JSON report of the race statistics
+    diagnostics_report_path = f's3://{target_bucket}/diagnostics/{target_table}/report_{RACE_LEAGUE.lower()}.json'
 else:
     src_database = 'dev_eurosport_cycling_staging'
     src_table_historicresults = 'ucichampionshiphistoricresults'
@@ -79,18 +101,52 @@ else:
     EVALUATE_PERFORMANCE_TESTSEASON = [2021, 2020]
     # Number of Riders to evalute the winning rider on 
     EVALUATE_PERFORMANCE_N_BEST_RIDERS = 1
-    RACE_LEAGUE = 'sprint' # string: 'endurance', 'sprint'
-    if RACE_LEAGUE.lower() == 'sprint':
-        RACE_TYPES = ['Sprint', 'Keirin']
-    elif RACE_LEAGUE.lower() == 'endurance':
-        RACE_TYPES = ['Scratch', 'Elimination Race'] 
-    else:
-        raise ValueError('Wrong value for RACE_LEAGUE. Expected values: "endurance" or "sprint"')
+    RACE_LEAGUE = 'sprint' # string: 'endurance', 'sprint', 'all'
     # logger level
     LOGGER_LEVEL = 'DEBUG'
+    # recalibrate all races (True) or only the races after the last checkpoint (False)
+    FULL_REBUILD = False
+    # TrueSkill hyper-parameter sweep on the train/test split instead of calibrating the elo scores
+    SWEEP_MODE = 'none' # string: 'none', 'grid', 'random'
+    # write the race statistics as JSON report, the statistics are computed only if the report or their log level is enabled
+    DIAGNOSTICS_REPORT = False
+    # walk forward backtest over all seasons instead of calibrating the elo scores
+    BACKTEST = False
     # Plot graphs of data for Data Analysis and debugging
     DEBUG_PLOTS = False
     USE_TRIMARAN_DATA = False
+    # rating checkpoint per league of the last run, used to only calibrate the races after its watermark
+    checkpoint_path = lambda league: f's3://{target_bucket}/checkpoints/{target_table}/{league}.npz'
+    # leaderboard of the TrueSkill configurations evaluated by the sweep
+    sweep_leaderboard_path = f's3://{target_bucket}/sweeps/{target_table}/leaderboard_{RACE_LEAGUE.lower()}.csv'
+    # rank 1 accuracy and error per season and race type of the walk forward backtest
+    backtest_path = f's3://{target_bucket}/backtests/{target_table}/backtest_{RACE_LEAGUE.lower()}.csv'
+    # Parquet cache of the source tables, reused while the files of a table do not change
+    athena_cache_path = 'athena_cache/'
+    # JSON report of the race statistics
+    diagnostics_report_path = f'diagnostics_report_{RACE_LEAGUE.lower()}.json'
+    
+# 'all' calibrates every league in one run, the leagues are calibrated in parallel worker processes
+if RACE_LEAGUE.lower() == 'all':
+    LEAGUES = list(RACE_LEAGUES)
+elif RACE_LEAGUE.lower() in RACE_LEAGUES:
+    LEAGUES = [RACE_LEAGUE.lower()]
+else:
+    raise ValueError('Wrong value for RACE_LEAGUE. Expected values: "endurance", "sprint" or "all"')
+RACE_TYPES = [race_type for league in LEAGUES for race_type in RACE_LEAGUES[league]]
+RACE_TYPE_LEAGUE = {race_type: league for league in LEAGUES for race_type in RACE_LEAGUES[league]}
+# Trimaran race results are used from this date on
+TRIMARAN_START_DATE = '2021-10-01'
+
+# TrueSkill parameters evaluated by the sweep, parameters which are not given keep the trueskill defaults
+SWEEP_PARAM_GRID = {'beta': [2.0, 3.0, 25/6, 6.0, 8.0], 'tau': [25/600, 25/300, 25/150, 25/75], 'draw_probability': [0]}
+SWEEP_PARAM_DISTRIBUTIONS = {'beta': (1.0, 10.0), 'tau': (0.01, 0.5), 'draw_probability': [0]}
+SWEEP_N_ITER = 50
+if SWEEP_MODE not in ['none', 'grid', 'random']:
+    raise ValueError('Wrong value for SWEEP_MODE. Expected values: "none", "grid" or "random"')
+# the sweep scores every configuration on the test seasons
+if SWEEP_MODE != 'none':
+    EVALUATE_PERFORMANCE = True
     
 if DEBUG_PLOTS and not glue_mode:
     import matplotlib.pyplot as plt
@@ -101,33 +157,26 @@ if DEBUG_PLOTS and not glue_mode:
 logger.setLevel(LOGGER_LEVEL)
 logger.info('')
 logger.info('#### Reading input data from datalake ####')
-# read historic race results
-sql_query = lambda table_name: f"SELECT * FROM {table_name}"
-wr.athena.repair_table(table=src_table_historicresults, database=src_database, boto3_session=session)
-df_raw_uci = wr.athena.read_sql_query(sql_query(src_table_historicresults), database=src_database, boto3_session=session)
-df_raw_uci.seasonid = df_raw_uci.season#.astype(int)
-wr.athena.repair_table(table=src_table_raceresults, database=src_database, boto3_session=session)
-df_raw_trimaran = wr.athena.read_sql_query(sql_query(src_table_raceresults), database=src_database, boto3_session=session)
-
-
+# only the columns and race types of the calibration are read, the filters are pushed down to Athena
+race_types_extended = queries.source_race_types(RACE_TYPES, PROXY_ELIMINATION_WITH_OMNIUM)
+# read historic race results, the season of the historic results is used as seasonid
+sql_query_uci = queries.race_results_query(src_table_historicresults, race_types_extended, column_sources={'seasonid': 'season'})
+# the tables are only repaired and queried when their files changed since the cached read
+df_raw = athena_cache.read_table_cached(sql_query_uci, src_database, src_table_historicresults, athena_cache_path, session)
 # append historic UCI results with trimaran results 
-common_cols = list(set(df_raw_trimaran.columns.tolist()).intersection(set(df_raw_uci.columns.tolist())))
-common_cols_sorted = []
-for col in df_raw_uci.columns:
-    if col in common_cols:
-        common_cols_sorted.append(col)
-df_raw_uci = df_raw_uci[common_cols_sorted]
-df_raw_trimaran = df_raw_trimaran[df_raw_trimaran.date_part>='2021-10-01'][common_cols_sorted]
 if USE_TRIMARAN_DATA:
-    df_raw = df_raw_uci.append(df_raw_trimaran)
-else:
-    df_raw = df_raw_uci.copy()
+    sql_query_trimaran = queries.race_results_query(src_table_raceresults, race_types_extended, min_date_part=TRIMARAN_START_DATE)
+    df_raw_trimaran = athena_cache.read_table_cached(sql_query_trimaran, src_database, src_table_raceresults, athena_cache_path, session)
+    df_raw = df_raw.append(df_raw_trimaran)
+logger.info(f"Read {df_raw.shape[0]} race results of the race types {race_types_extended}")
 
 
 logger.info('')
 logger.info('#### Clean raw data ####')
 # drop riders with no UCIID
 df_raw = df_raw.dropna(subset=['results_uciid'], how='any')
+# the UCIID type can differ between the historic and the trimaran results, the checkpoints and DynamoDB use int64
+df_raw.results_uciid = df_raw.results_uciid.astype(np.int64)
 # extract race gender from race name
 df_raw.gender = df_raw.gender.str.slice(0, 1)
 # remove all non alphanumeric characters from string
@@ -146,16 +195,7 @@ df_raw = df_raw.drop_duplicates(GROUPBY_COLS+['results_uciid'], keep='first')
 logger.debug(f"Rows after dropping duplicates: {df_raw.shape[0]}")
 
 
-logger.debug(f"Number of races per race type:\n{df_raw.drop_duplicates(GROUPBY_COLS).racetype.value_counts()}")
-logger.debug(f"Number of riders per season:\n{df_raw.groupby('seasonid').results_uciid.nunique()}")
-
-
 race_results_list = []
-race_types_extended = list(RACE_TYPES)
-# use Omnium as proxy for Elimination if PROXY_ELIMINATION_WITH_OMNIUM=True and Elimination Race is in the RACE_TYPES list
-if 'Elimination Race' in RACE_TYPES and PROXY_ELIMINATION_WITH_OMNIUM:
-    race_types_extended.append('Omnium')
-    
 # iterate over the race_types_extended to filter the data to only the specified race types and clean the data
 for race_type in race_types_extended:
     df_raw_race = df_raw[df_raw.racetype==race_type].copy()
@@ -174,91 +214,32 @@ for race_type in race_types_extended:
 
 df_race_results = pd.concat(race_results_list)
 
-# duplicate names per uci_id
-df_race_results['name'] = df_race_results.results_lastname + ' ' + df_race_results.results_firstname 
-duplicate_names_per_uciid = df_race_results.groupby('results_uciid').name.agg(['nunique', 'unique']).reset_index()
-if duplicate_names_per_uciid[duplicate_names_per_uciid['nunique']>1].empty:
-    logger.warning(f"Duplicate names per UCIID:\n{duplicate_names_per_uciid[duplicate_names_per_uciid['nunique']>1]}")
-    
-# duplicate uci_id per name
-duplicate_uciid_per_name = df_race_results.groupby('name').results_uciid.agg(['nunique', 'unique']).reset_index()
-if not duplicate_uciid_per_name[duplicate_uciid_per_name['nunique']>1].empty:
-    logger.warning(f"Duplicate names per UCIID:\n{duplicate_uciid_per_name[duplicate_uciid_per_name['nunique']>1]}")
-
-
 # use Omnium as proxy for Elimination
 if 'Elimination Race' in RACE_TYPES and PROXY_ELIMINATION_WITH_OMNIUM:
     df_race_results.racetype = df_race_results.racetype.replace('Omnium', 'Elimination Race')
+df_race_results['league'] = df_race_results.racetype.map(RACE_TYPE_LEAGUE)
+# dense chronological heat ids, the rows are sorted by heat id and rank. Splits and statistics group by the heat id
+df_race_results, races = race_index.build_race_index(df_race_results)
 
 
 # ## Race Stats
+# the statistics are computed in one pass over the race index, only if their log level is enabled or the report is written
 
 logger.debug('')
 logger.debug('#### Race Stats ####')
-unique_races = df_race_results[GROUPBY_COLS].drop_duplicates()
-logger.debug("## All races (all data) ##")
-logger.debug(f"Number of races overall: {unique_races.shape}")
-logger.debug(f"Race distribution among race types:\n{unique_races.groupby('racetype').size().sort_index()}")
-
-df_train, df_test, test_idx = preproc.train_test_split(df_race_results, EVALUATE_PERFORMANCE_TESTSEASON)
+diagnostics.run_diagnostics(df_race_results, races, EVALUATE_PERFORMANCE_TESTSEASON, diagnostics_report_path if DIAGNOSTICS_REPORT else None, session)
 
-unique_races_train = df_train[GROUPBY_COLS].drop_duplicates()
-logger.debug('')
-logger.debug("## Races used for rating the riders (train data) ##")
-logger.debug(f"Number of races overall: {unique_races_train.shape}")
-logger.debug(f"Race distribution among race types:\n{unique_races_train.groupby('racetype').size().sort_index()}")
-
-logger.debug('')
-logger.debug("## Races used for evaluating the rider rating (test data) ##")
-unique_races_test = df_test[GROUPBY_COLS].drop_duplicates()
-logger.debug(f"Number of races overall: {unique_races_test.shape}")
-logger.debug(f"Race distribution among race types:\n{unique_races_test.groupby('racetype').size().sort_index()}")
-
-races_per_rider = df_race_results.groupby(['racetype', 'results_uciid']).size().to_frame(name='number_of_races_per_rider')
-races_per_rider = races_per_rider.reset_index()
-races_per_rider.sort_values(['racetype', 'number_of_races_per_rider'], ascending=[True, False]).groupby(['racetype']).head()
-
-logger.debug('## Number of riders per race type (all data) ##')
-n_riders_per_race = df_race_results.groupby(GROUPBY_COLS).results_uciid.nunique()
-# determine the mode and median number of riders per race to have an estimate of randomly picking the correct winning rider
-most_frequent_n_riders_per_race = n_riders_per_race.groupby(level=[2]).apply(lambda x: pd.Series.mode(x)[0]).rename('mode')
-n_rider_stats = n_riders_per_race.groupby(level=[2]).agg(['mean', 'median', 'std', 'min', 'max', 'count'])
-n_rider_stats = pd.concat([most_frequent_n_riders_per_race, n_rider_stats], axis=1)
-logger.debug(f"\n{n_rider_stats}")
-logger.info(f'Probabilities of correctly guessing the winning rider per race type:\n{1/most_frequent_n_riders_per_race}')
-
-
-# check if number of unique UCIID and number of Ranks is the same per race
-riders_unique_count = df_race_results.groupby(GROUPBY_COLS).agg({'results_uciid': ['nunique'], 'results_rank': ['count']})
-riders_unique_count.columns = riders_unique_count.columns.droplevel(1)
-if not riders_unique_count[riders_unique_count.results_rank!=riders_unique_count.results_uciid].empty:
-    logger.warning(f"The following races of unequal number of unique ranks and UCIID:\n{riders_unique_count[riders_unique_count.results_rank!=riders_unique_count.results_uciid]}")
-
-
-# Number of riders per race type displayed as histogram
-number_of_ranks = df_race_results.groupby(GROUPBY_COLS).results_uciid.nunique()
-if DEBUG_PLOTS: 
+if DEBUG_PLOTS:
+    # Number of riders per race type displayed as histogram
+    number_of_ranks = races.rows_per_heat()
     for race_type in RACE_TYPES:
         plt.figure()
         number_of_ranks[:, :, race_type].hist(bins=20)
         plt.title(f"Number of riders per race for {race_type}")
-
-
-if len(RACE_TYPES) > 1:
-    for i, race_type in enumerate(RACE_TYPES):
-        df_results_tmp = df_race_results[df_race_results.racetype==race_type]
-        if i == 0:
-            number_of_races_per_rider = df_results_tmp.results_uciid.value_counts().to_frame(name=f'{race_type}_races')
-        else:
-            number_of_races_per_rider = number_of_races_per_rider.merge(df_results_tmp.results_uciid.value_counts().to_frame(name=f'{race_type}_races'), how='outer', left_index=True, right_index=True)
-    number_of_races_per_rider = number_of_races_per_rider.fillna(0)
-    number_of_races_per_rider['races_overall'] = number_of_races_per_rider.sum(axis=1)
-    number_of_races_per_rider = number_of_races_per_rider.sort_values('races_overall', ascending=False)
-    logger.debug(f"Number of riders: {number_of_races_per_rider.shape[0]} in the race types: {RACE_TYPES}")
-    logger.debug(f"Percentage of riders with more than 1 race: {100.0*(number_of_races_per_rider.races_overall>1).sum()/number_of_races_per_rider.shape[0]:.2f}%")
-    logger.debug(f"Percentage of riders with more than 2 races: {100.0*(number_of_races_per_rider.races_overall>2).sum()/number_of_races_per_rider.shape[0]:.2f}%")
-    logger.debug(f"Percentage of riders with more than 10 races: {100.0*(number_of_races_per_rider.races_overall>10).sum()/number_of_races_per_rider.shape[0]:.2f}%")
-    if DEBUG_PLOTS:
+    if len(RACE_TYPES) > 1:
+        number_of_races_per_rider = pd.crosstab(df_race_results.results_uciid, df_race_results.racetype)
+        number_of_races_per_rider['races_overall'] = number_of_races_per_rider.sum(axis=1)
+        number_of_races_per_rider = number_of_races_per_rider.sort_values('races_overall', ascending=False)
         number_of_races_per_rider[number_of_races_per_rider.races_overall>10].drop('races_overall', axis=1).plot.bar(figsize=(30, 10), stacked=True, title=f'Number of races per rider on {RACE_TYPES[0]}/ {RACE_TYPES[1]} races')
 
 
@@ -267,8 +248,7 @@ if len(RACE_TYPES) > 1:
 
 logger.info('')
 logger.info('#### Calibrate ELO scores based on past race results ####')
-# sort the dataframe by time to later iterate starting from first matches to last matches
-df_race_results = df_race_results.sort_values(GROUPBY_COLS+['seasonid', 'timestamp'])
+# the race index sorted the rows chronologically, the heats are replayed in heat id order
 if EVALUATE_PERFORMANCE:
     df_train, df_test, test_idx = preproc.train_test_split(df_race_results, EVALUATE_PERFORMANCE_TESTSEASON)
     logger.debug(f"Size of train data: {df_train.shape}")
@@ -276,37 +256,84 @@ if EVALUATE_PERFORMANCE:
 else:
     df_train = df_race_results.copy()
     logger.debug(f"Size of train data: {df_train.shape}")
-riders = df_train.results_uciid.drop_duplicates().tolist()
 
 race_types_all = list(RACE_TYPES)
 if len(RACE_TYPES) > 1 and 'all' not in RACE_TYPES:
     race_types_all = ['all'] + RACE_TYPES
 
 
-# init
-ts = trueskill.TrueSkill(draw_probability=0)
-df_current_elos, df_elos_trajectory = elo_helper.init_elos(riders, df_train, ts)
-# save the order the races are traversed in a dedicated dataframe to later sort them according to the race_order
-df_race_order = pd.DataFrame(columns=['race_order'], index=df_elos_trajectory.index)
+# backtest: predict every season with the elo scores calibrated on the seasons before, only the accuracy per season is written
+if BACKTEST:
+    logger.info('')
+    logger.info('#### Walk forward backtest ####')
+    df_backtest = backtest.walk_forward_backtest(df_race_results, trueskill.TrueSkill(draw_probability=0), race_types=race_types_all,
+                                                 n_best=EVALUATE_PERFORMANCE_N_BEST_RIDERS)
+    logger.info(f"Rank 1 accuracy per season:\n{df_backtest.pivot(index='seasonid', columns='racetype', values='rank_1_accuracy')}")
+    wr.s3.to_csv(df=df_backtest, path=backtest_path, index=False, boto3_session=session)
+    print('Job Succeeded')
+    sys.exit(0)
 
 
-# train
-df_current_elos, df_elos_trajectory = elo_helper.train_elos(df_train, df_current_elos, df_elos_trajectory, df_race_order, ts)
+# sweep: calibrate and score all TrueSkill configurations on the same cleaned data, only the leaderboard is written
+if SWEEP_MODE != 'none':
+    logger.info('')
+    logger.info(f'#### TrueSkill hyper-parameter {SWEEP_MODE} search ####')
+    if SWEEP_MODE == 'grid':
+        sweep_configs = sweep.parameter_grid(SWEEP_PARAM_GRID)
+    else:
+        sweep_configs = sweep.random_parameters(SWEEP_PARAM_DISTRIBUTIONS, SWEEP_N_ITER)
+    leaderboard = sweep.run_sweep(sweep_configs, df_train, df_race_results, df_test, race_types_all, EVALUATE_PERFORMANCE_N_BEST_RIDERS)
+    logger.info(f"Best TrueSkill configurations:\n{leaderboard.head(10)}")
+    wr.s3.to_csv(df=leaderboard, path=sweep_leaderboard_path, index=False, boto3_session=session)
+    print('Job Succeeded')
+    sys.exit(0)
 
+ts = trueskill.TrueSkill(draw_probability=0)
+# continue every league from its last checkpoint unless a full rebuild is requested, evaluation always trains from scratch
+df_train_list, initial_elos_list = [], []
+for league in LEAGUES:
+    df_train_league = df_train[df_train.league==league]
+    checkpoint = None
+    if not EVALUATE_PERFORMANCE and not FULL_REBUILD:
+        checkpoint = ckpt.load_checkpoint(checkpoint_path(league), session)
+        calibration_config = ckpt.calibration_config(ts, RACE_LEAGUES[league])
+        if checkpoint is not None and not checkpoint.is_compatible(calibration_config):
+            logger.warning(f"Checkpoint at {checkpoint_path(league)} was calibrated with {checkpoint.config} instead of {calibration_config}. Recalibrating all races.")
+            checkpoint = None
+    if checkpoint is not None:
+        checkpoint.check_riders(df_train_league)
+        df_train_league = ckpt.filter_races_after_watermark(df_train_league, checkpoint.watermark)
+        initial_elos_list.append(checkpoint.to_frame().assign(league=league))
+        logger.info(f"Calibrating {df_train_league.shape[0]} result rows of {league} after the watermark {checkpoint.watermark}")
+    df_train_list.append(df_train_league)
+df_train = pd.concat(df_train_list)
+initial_elos = pd.concat(initial_elos_list) if initial_elos_list else None
+
+
+# train: replay the heats in chronological order on the array based TrueSkill engine, independent rating partitions run in parallel
+df_current_elos = parallel.train_elos_partitioned(df_train, ts, initial_elos=initial_elos)
+
+
+# checkpoint the ratings per league, evaluation runs only see the train data and are not persisted
+if not EVALUATE_PERFORMANCE:
+    for league in LEAGUES:
+        df_train_league = df_train[df_train.league==league]
+        if not df_train_league.empty:
+            df_league_elos = df_current_elos[df_current_elos.league==league]
+            ckpt.save_checkpoint(checkpoint_path(league), df_league_elos, ckpt.race_watermark(df_train_league), ckpt.calibration_config(ts, RACE_LEAGUES[league]), session)
+        else:
+            logger.info(f'No new {league} races after the watermark of the checkpoint.')
 
-# predict
+
+# predict, the races are predicted independently of each other
 if EVALUATE_PERFORMANCE:
-    df_riders_pred_list = []
-    for race_type in race_types_all:
-        if race_type == 'all':
-            df_riders_pred_list.append(elo_helper.predict_elos(df_current_elos, df_race_results, df_train, df_test))
-        else:
-            df_riders_pred_list.append(elo_helper.predict_elos(df_current_elos, df_race_results, df_train, df_test[df_test.racetype==race_type]))
+    df_riders_pred = elo_helper.predict_elos(df_current_elos, df_race_results, df_train, df_test)
 
 
-# evaluate
+# evaluate all race types at once
 if EVALUATE_PERFORMANCE:
-    rank_1_accuracy_list, rank_1_error_list = elo_helper.compute_rank_1_accuracy_and_error(df_riders_pred_list, race_types_all, EVALUATE_PERFORMANCE_N_BEST_RIDERS)
+    df_metrics = evaluation.evaluate_predictions(df_riders_pred, ks=sorted({1, 2, 3, EVALUATE_PERFORMANCE_N_BEST_RIDERS}), ts=ts)
+    logger.info(f"Evaluation of the predictions on the test data:\n{df_metrics.reindex(race_types_all).T}")
 
 
 # ## Persisting output to Athena and DynamoDB
@@ -317,20 +344,28 @@ logger.info('#### Write ELO scores per UCIID to S3/Athena and DynamoDB. ELO scor
 df_current_elos.results_uciid = df_current_elos.results_uciid.astype(int)
 df_current_elos.elo_mean = df_current_elos.elo_mean.round(4)
 df_current_elos.elo_std = df_current_elos.elo_std.round(4)
-for race_type in RACE_TYPES:
-    df_result = df_current_elos.rename(columns={'results_uciid': 'uciid'}).copy()
-    df_result['racetype'] = race_type.split(' ')[0]
-    wr.s3.to_parquet(
-        df=df_result,
-        path=f's3://{target_bucket}/{target_table}/',
-        dataset=True,
-        database=target_database,
-        table=target_table,
-        mode='overwrite_partitions',
-        partition_cols=['racetype'],
-        boto3_session=session
-    )
-    io.put_elo_to_ddb(df_result, ddb_table, session)
+# all racetype partitions in one frame, the race types of a league share the elo scores of the league
+df_result = pd.concat([df_current_elos[df_current_elos.league==RACE_TYPE_LEAGUE[race_type]].assign(racetype=race_type.split(' ')[0]) for race_type in RACE_TYPES], ignore_index=True)
+df_result = df_result.drop(columns='league').rename(columns={'results_uciid': 'uciid'})
+# elo scores published by the last run in the partitions which are overwritten, riders without changes are not written to DynamoDB again
+output_partitions = df_result.racetype.unique().tolist()
+try:
+    df_published = wr.s3.read_parquet(path=f's3://{target_bucket}/{target_table}/', dataset=True,
+                                      partition_filter=lambda partition: partition['racetype'] in output_partitions, boto3_session=session)
+except wr.exceptions.NoFilesFound:
+    df_published = None
+wr.s3.to_parquet(
+    df=df_result,
+    path=f's3://{target_bucket}/{target_table}/',
+    dataset=True,
+    database=target_database,
+    table=target_table,
+    mode='overwrite_partitions',
+    partition_cols=['racetype'],
+    boto3_session=session
+)
+# one FAVORITE# item per rider with the race types of its elo score
+io.put_elo_to_ddb(df_result, ddb_table, session, df_published)
     
 print('Job Succeeded')
 
@@ -3,7 +3,7 @@ import * as s3 from '@aws-cdk/aws-s3';
 import * as ddb from '@aws-cdk/aws-dynamodb';
 import * as glue from '@aws-cdk/aws-glue';
 import * as iam from '@aws-cdk/aws-iam';
-import { envSpecific } from './helpers';
+import { envSpecific, proxyEliminationWithOmnium } from './helpers';
 
 export interface GlueProps {
   readonly s3raw: s3.IBucket;
@@ -1411,9 +1411,13 @@ export class Glue extends cdk.Construct {
         '--target_table': 'riders_elos',
         '--ddb_table': props.ddbTableStatic.tableName,
         '--USE_TRIMARAN_DATA': 'False', // bool: 'True', 'False'
-        '--PROXY_ELIMINATION_WITH_OMNIUM': 'True', // bool: 'True', 'False'
-        '--RACE_LEAGUE': 'sprint', // string: 'endurance', 'sprint'
+        '--PROXY_ELIMINATION_WITH_OMNIUM': proxyEliminationWithOmnium, // bool: 'True', 'False'
+        '--RACE_LEAGUE': 'sprint', // string: 'endurance', 'sprint', 'all'
         '--LOGGER_LEVEL': 'DEBUG', // string: 'DEBUG', 'INFO', 'WARNING', 'ERROR'
+        '--FULL_REBUILD': 'False', // bool: 'True', 'False'
+        '--SWEEP_MODE': 'none', // string: 'none', 'grid', 'random'
+        '--DIAGNOSTICS_REPORT': 'False', // bool: 'True', 'False'
+        '--BACKTEST': 'False', // bool: 'True', 'False'
       },
     });
   }
@@ -33,8 +33,12 @@ const hashCode = function (s) {
   return s.split('').reduce((a, b) => { a = ((a << 5) - a) + b.charCodeAt(0); return a & a; }, 0);
 };
 
+// rate Omnium results as Elimination, shared by the elocalibration Glue job and the online rating of the REST API lambda
+const proxyEliminationWithOmnium: string = 'True'; // bool: 'True', 'False'
+
 export {
   // eslint-disable-next-line import/prefer-default-export
   envSpecific,
   hashCode,
+  proxyEliminationWithOmnium,
 };
@@ -7,7 +7,7 @@ import * as s3 from '@aws-cdk/aws-s3';
 import * as secretsmanager from '@aws-cdk/aws-secretsmanager';
 import { ManagedPolicy, Role, ServicePrincipal } from '@aws-cdk/aws-iam';
 import * as s3deploy from '@aws-cdk/aws-s3-deployment';
-import { envSpecific } from './helpers';
+import { envSpecific, proxyEliminationWithOmnium } from './helpers';
 import * as ssm from '@aws-cdk/aws-ssm';
 
 export interface RestAPIprops {
@@ -54,7 +54,13 @@ export class RestAPI extends cdk.Construct {
 
       // Create lambda function for data ingestion into Kinesis or S3
       const KinesisLambdaFunction = new lambda.Function(this, 'KinesisAPILambda', {
-        code: lambda.Code.fromAsset('lib/lambda/python/kinesis-s3-api'),
+        // numpy of requirements.txt is bundled for the bracket simulation of rating.py
+        code: lambda.Code.fromAsset('lib/lambda/python/kinesis-s3-api', {
+          bundling: {
+            image: lambda.Runtime.PYTHON_3_8.bundlingImage,
+            command: ['bash', '-c', 'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output'],
+          },
+        }),
         runtime: lambda.Runtime.PYTHON_3_8,
         handler: 'main.handler',
         role: LambdaServiceRole,
@@ -64,6 +70,7 @@ export class RestAPI extends cdk.Construct {
           DYNAMODB_TABLE: props.ddbTableStatic.tableName,
           OUTPUT_S3_BUCKET: props.s3raw.bucketName,
           OUTPUT_S3_KEY: 'batch_data/',
+          PROXY_ELIMINATION_WITH_OMNIUM: proxyEliminationWithOmnium,
         },
         tracing: lambda.Tracing.ACTIVE,
       });
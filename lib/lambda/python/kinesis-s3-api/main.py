@@ -6,9 +6,11 @@ from botocore.exceptions import ClientError
 import logging
 import datetime
 import os
+import time
 import copy
 from collections.abc import MutableMapping
 import random as rand
+import rating
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -26,6 +28,39 @@ s3_client = boto3.client('s3')
 partition_day = 'date_part=' + datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
 timestamp = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d-%H:%M:%S')
 
+# statuses of riders which are not rated, same as the remove_disqualified_riders preprocessing of the elocalibration job
+UNRATED_STATUSES = ['DNF', 'DNS', 'DSQ', 'REL']
+# race types per league of the elocalibration job (RACE_LEAGUES) in the RaceTypes format of the FAVORITE# items,
+# every league has its own elo scores and other race types are not rated
+RATING_LEAGUES = {'sprint': ['Sprint', 'Keirin'], 'endurance': ['Scratch', 'Elimination']}
+# same as the PROXY_ELIMINATION_WITH_OMNIUM argument of the elocalibration job: Omnium results are rated as Elimination
+PROXY_ELIMINATION_WITH_OMNIUM = os.environ.get('PROXY_ELIMINATION_WITH_OMNIUM', 'True').lower() == 'true'
+ONLINE_RATING_RETRIES = 3
+# retries of unprocessed keys and throttled BatchGetItem requests, with exponential backoff and jitter from BATCH_GET_BASE_DELAY seconds
+BATCH_GET_RETRIES = 5
+BATCH_GET_BASE_DELAY = 0.05
+BATCH_GET_RETRYABLE_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+                              'InternalServerError', 'ServiceUnavailable']
+# round structure per race type, the number of heats of the first round is given by the race list
+ROUND_DEFINITIONS = {
+    'Sprint': {
+        1: {'roundName': 'Eliminations', 'defaultNoOfRiders': 3},
+        2: {'roundName': 'Semi finals', 'defaultNoOfRiders': 3, 'defaultNoOfHeats': 2},
+        3: {'roundName': 'Finals', 'defaultNoOfRiders': 2, 'defaultNoOfHeats': 1}
+    },
+    'Elimination': {
+        1: {'roundName': '', 'defaultNoOfRiders': 18},
+    },
+    'Scratch': {
+        1: {'roundName': '', 'defaultNoOfRiders': 18},
+    },
+    'Keirin': {
+        1: {'roundName': 'Qualifications', 'defaultNoOfRiders': 6},
+        2: {'roundName': 'Final', 'defaultNoOfRiders': 6, 'defaultNoOfHeats': 1},
+    }
+}
+BRACKET_SIMULATIONS = 2000
+
 live_data_list = ['/StoreLiveRidersTracking', '/StoreLiveRidersData', '/StoreStartTime', '/StoreLapCounter',
                   '/StoreRiderEliminated', '/StoreFinishTime', '/StoreRaceStartLive']
 
@@ -141,10 +176,15 @@ def handler(event, context):
                     return response_body(500, event['path'], "Data not saved - please validate schema and values")
             # we have to update artificial object based on this data with Round level statistics
             try:
-                update_round_level_object_with_startlist(body)
+                round_object = update_round_level_object_with_startlist(body)
             except Exception as e:
                 logger.error(e)
                 return response_body(500, event['path'], "Data for RaceID=%s not saved - please check if this race was in RaceList or Race is has correct Rounds/heats and raceType=Sprint|Elimination|Scratch|Kerin" % race_id)
+            try:
+                update_bracket_predictions(body, round_object)
+            except Exception as e:
+                logger.warning("Failed to simulate the bracket for Race ID: %s", str(race_id))
+                logger.warning(e, exc_info=True)
             return response_body(200, event['path'], "race id: {} start list".format(race_id))
         except Exception as e:
             logger.error(e)
@@ -171,6 +211,7 @@ def handler(event, context):
                 except Exception as e:
                     logger.error(e)
                     return response_body(500, event['path'], "Data not saved - please validate schema and values")
+            update_online_ratings(body)
             return response_body(200, event['path'], "race id: {} results".format(race_id))
         except Exception as e:
             logger.error(e)
@@ -389,7 +430,8 @@ def convert_record_to_ddb_item(data_item, data_type):
             'Status': {'S': str(data_item['Status'])},
             'StartPosition': {'N': str(data_item['StartPosition'])},
             'StartingLane': {'N': str(data_item['StartingLane'])},
-            'PredictedRank': {'N': str(data_item.get('PredictedRank', ""))}
+            'PredictedRank': {'N': str(data_item.get('PredictedRank', ""))},
+            'ExpectedRank': {'N': str(data_item.get('ExpectedRank', 0))}
         }
 
     if data_type == "race_results":
@@ -619,23 +661,32 @@ def flatten_dict(d, parent_key='', sep='_'):
 
 
 def append_predicted_rank(race_start_list):
+    '''
+    Appends the expected finishing position and the predicted rank to every rider of the start list. The expected
+    position is computed from the pairwise TrueSkill win probabilities of the riders' elo mean and std, riders without
+    elo score get the default rating. The predicted rank orders the riders by expected position, it is 0 for all riders
+    if none of them has an elo score.
+    :param dict race_start_list: start list payload of /StoreRaceStartList
+    :return: start list with PredictedRank and ExpectedRank per rider
+    '''
     try:
-        elo_means_list = {
-            startlist["UCIID"]: float(query_ddb_for_favourite_rider_data(DYNAMODB_TABLE, str(startlist["UCIID"]))) for
-            startlist in race_start_list["Startlist"]}
-        elo_ranks_list = {key: rank for rank, key in
-                          enumerate(sorted(elo_means_list, key=elo_means_list.get, reverse=True), 1)}
-
+        start_list = race_start_list["Startlist"]
+        uciids = [str(rider["UCIID"]) for rider in start_list]
+        ratings = get_favourite_ratings(DYNAMODB_TABLE, uciids, consistent_read=False)
+        _, expected = rating.expected_ranks([ratings[uciid]['mu'] for uciid in uciids],
+                                            [ratings[uciid]['sigma'] for uciid in uciids])
         logger.debug(
-            "Elo ranking list for Race ID: " + str(race_start_list.get("RaceID", "")) + " is " + str(elo_ranks_list))
-
-        for startlist in race_start_list["Startlist"]:
-            # No elo scores found
-            if all(means==-1.0 for means in elo_means_list.values()):
-                race_start_list["Startlist"][race_start_list["Startlist"].index(startlist)]["PredictedRank"] = 0
-            else:
-                race_start_list["Startlist"][race_start_list["Startlist"].index(startlist)]["PredictedRank"] = \
-                elo_ranks_list[startlist["UCIID"]]
+            "Expected ranks for Race ID: " + str(race_start_list.get("RaceID", "")) + " are " + str(dict(zip(uciids, expected))))
+
+        # No elo scores found
+        if not any(ratings[uciid]['rated'] for uciid in uciids):
+            for rider in start_list:
+                rider["PredictedRank"] = 0
+                rider["ExpectedRank"] = 0
+        else:
+            for predicted_rank, i in enumerate(sorted(range(len(start_list)), key=expected.__getitem__), 1):
+                start_list[i]["PredictedRank"] = predicted_rank
+                start_list[i]["ExpectedRank"] = round(expected[i], 4)
         return race_start_list
     except Exception as ex:
         logger.warning("Failed to compute rider predictions for Race ID: %s", str(race_start_list.get("RaceID", "")))
@@ -643,22 +694,140 @@ def append_predicted_rank(race_start_list):
         return race_start_list
 
 
-def query_ddb_for_favourite_rider_data(table_name, uciid):
+def get_favourite_ratings(table_name, uciids, consistent_read=True):
+    '''
+    Reads the current elo score of the riders from their FAVORITE# items
+    :param str table_name: name of table
+    :param list uciids: UCIIDs of the riders
+    :param bool consistent_read: strongly consistent read, needed before conditional writes
+    :return: dict UCIID -> dict with mu, sigma, rated (False for riders without elo score, they get the default rating),
+             version (None if the item has no RatingVersion), rated_races and race_types (race types of the league
+             of the elo score, None if the item has no RaceTypes)
+    '''
+    ratings = {str(uciid): {'mu': rating.DEFAULT_MU, 'sigma': rating.DEFAULT_SIGMA, 'rated': False, 'version': None,
+                            'rated_races': [], 'race_types': None} for uciid in uciids}
+    keys = [{'pk': {'S': 'RIDER#UCIID=' + uciid + '#'}, 'sk': {'S': 'FAVORITE#'}} for uciid in ratings]
+    # BatchGetItem reads at most 100 keys
+    for start in range(0, len(keys), 100):
+        request = {table_name: {'Keys': keys[start:start + 100], 'ConsistentRead': consistent_read}}
+        for retry in range(BATCH_GET_RETRIES + 1):
+            try:
+                response = dynamodb_client.batch_get_item(RequestItems=request)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] not in BATCH_GET_RETRYABLE_ERRORS or retry == BATCH_GET_RETRIES:
+                    raise
+                response = {'Responses': {}, 'UnprocessedKeys': request}
+            for item in response['Responses'].get(table_name, []):
+                ratings[item['UCIID']['S']] = {
+                    'mu': float(item['EloMean']['N']),
+                    'sigma': float(item['EloStd']['N']),
+                    'rated': True,
+                    'version': item['RatingVersion']['N'] if 'RatingVersion' in item else None,
+                    'rated_races': item.get('OnlineRatedRaces', {}).get('SS', []),
+                    'race_types': item['RaceTypes']['SS'] if 'RaceTypes' in item else None
+                }
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            if retry == BATCH_GET_RETRIES:
+                raise RuntimeError("%s FAVORITE# items were not read from %s after %s retries" % (
+                    len(request[table_name]['Keys']), table_name, BATCH_GET_RETRIES))
+            time.sleep(BATCH_GET_BASE_DELAY * 2 ** retry * rand.uniform(0.5, 1.5))
+    return ratings
+
+
+def rating_race_types(race_type):
+    '''
+    Race types sharing the elo score with race_type, like the leagues of the elocalibration job
+    :param str race_type: RaceType of the race results
+    :return: list race types of the league, None if race_type is not rated
+    '''
+    race_type = str(race_type).split(' ')[0]
+    if race_type == 'Omnium' and PROXY_ELIMINATION_WITH_OMNIUM:
+        race_type = 'Elimination'
+    for race_types in RATING_LEAGUES.values():
+        if race_type in race_types:
+            return race_types
+    return None
+
+
+def update_online_ratings(race_results):
+    '''
+    Applies the TrueSkill update of a finished heat to the FAVORITE# elo scores of its riders, so predictions
+    use the latest results before the next batch calibration. The riders are written in one transaction with
+    conditional writes on the RatingVersion read before the update: a concurrent update or a batch calibration
+    in between cancels the transaction and the update is retried on the new elo scores. Heats which were
+    already applied are recorded in OnlineRatedRaces and skipped.
+    Like the batch calibration only the race types of RATING_LEAGUES are rated. A rider has one FAVORITE# score:
+    riders whose score belongs to the other league are rated with the default rating and their score is kept.
+    :param dict race_results: race results payload of /StoreRaceResults
+    :return: list with the UCIIDs of the updated riders
+    '''
+    race_key = str(race_results.get('RaceID', '')) + '#' + str(race_results.get('Heat', ''))
     try:
-        response_fav_rider = dynamodb_client.query(
-            TableName=table_name,
-            KeyConditionExpression='pk = :myPK AND sk = :mySK',
-            ExpressionAttributeValues={
-                ':myPK': {'S': 'RIDER#UCIID=' + str(uciid) + '#'},
-                ':mySK': {"S": 'FAVORITE#'}
-            }
-        )
-        logger.debug("in query_ddb response for FAVORITE#: " + str(response_fav_rider["Items"]))
-        return response_fav_rider["Items"][0]["EloMean"]["N"]
+        race_types = rating_race_types(race_results.get('RaceType', ''))
+        if race_types is None:
+            logger.info("Race type %s of race %s is not rated", race_results.get('RaceType', ''), race_key)
+            return []
+        finishers = [result for result in race_results['Results']
+                     if str(result.get('Status', '')) not in UNRATED_STATUSES and int(result.get('Rank') or 0) > 0]
+        # ties are rated in payload order, the calibration is done without draws
+        finishers.sort(key=lambda result: int(result['Rank']))
+        # a rider listed twice keeps the best rank, one transaction can not update an item twice
+        uciids = []
+        for result in finishers:
+            if str(result['UCIID']) not in uciids:
+                uciids.append(str(result['UCIID']))
+        if len(uciids) < 2:
+            return []
+        for retry in range(ONLINE_RATING_RETRIES):
+            current_ratings = get_favourite_ratings(DYNAMODB_TABLE, uciids)
+            if any(race_key in current_ratings[uciid]['rated_races'] for uciid in uciids):
+                logger.info("Elo scores of race %s were already updated", race_key)
+                return []
+            # riders with the elo score of the other league
+            other_league = {uciid for uciid in uciids if current_ratings[uciid]['race_types'] is not None
+                            and not set(current_ratings[uciid]['race_types']) & set(race_types)}
+            for uciid in other_league:
+                current_ratings[uciid].update(mu=rating.DEFAULT_MU, sigma=rating.DEFAULT_SIGMA)
+            new_mu, new_sigma = rating.rate_free_for_all([current_ratings[uciid]['mu'] for uciid in uciids],
+                                                         [current_ratings[uciid]['sigma'] for uciid in uciids])
+            transact_items = []
+            for uciid, mu, sigma in zip(uciids, new_mu, new_sigma):
+                if uciid in other_league:
+                    continue
+                version = current_ratings[uciid]['version']
+                expression_values = {':mu': {'N': str(mu)}, ':sigma': {'N': str(sigma)}, ':uciid': {'S': uciid},
+                                     ':race': {'SS': [race_key]}, ':one': {'N': '1'}, ':zero': {'N': '0'},
+                                     ':racetype': {'S': race_types[-1]}, ':racetypes': {'SS': race_types}}
+                if version is None:
+                    condition = 'attribute_not_exists(RatingVersion)'
+                else:
+                    condition = 'RatingVersion = :version'
+                    expression_values[':version'] = {'N': version}
+                transact_items.append({'Update': {
+                    'TableName': DYNAMODB_TABLE,
+                    'Key': {'pk': {'S': 'RIDER#UCIID=' + uciid + '#'}, 'sk': {'S': 'FAVORITE#'}},
+                    'UpdateExpression': 'SET EloMean = :mu, EloStd = :sigma, UCIID = :uciid, '
+                                        'RaceType = if_not_exists(RaceType, :racetype), RaceTypes = if_not_exists(RaceTypes, :racetypes), '
+                                        'RatingVersion = if_not_exists(RatingVersion, :zero) + :one ADD OnlineRatedRaces :race',
+                    'ConditionExpression': condition,
+                    'ExpressionAttributeValues': expression_values
+                }})
+            if not transact_items:
+                return []
+            try:
+                dynamodb_client.transact_write_items(TransactItems=transact_items)
+                logger.info("Updated elo scores of %s riders with race %s", len(transact_items), race_key)
+                return [uciid for uciid in uciids if uciid not in other_league]
+            except dynamodb_client.exceptions.TransactionCanceledException as ex:
+                logger.info("Elo scores changed while updating race %s, try number: %s", race_key, retry + 1)
+                logger.debug(ex, exc_info=True)
+        logger.warning("Failed to update elo scores of race %s after %s tries", race_key, ONLINE_RATING_RETRIES)
     except Exception as ex:
-        logger.warning("Failed to find elo scores for UCIID: %s", str(uciid))
+        logger.warning("Failed to update elo scores of race %s", race_key)
         logger.warning(ex, exc_info=True)
-        return "-1.0"
+    return []
 
 
 def compute_est_timeslot(time_actual_race, time_next_race):
@@ -688,23 +857,7 @@ def generate_and_save_round_level_object(race_list):
     :param dict race_list: list with races
     :return: nothing, just execute
     '''
-    d = {
-        'Sprint': {
-            1: {'roundName': 'Eliminations', 'defaultNoOfRiders': 3},
-            2: {'roundName': 'Semi finals', 'defaultNoOfRiders': 3},
-            3: {'roundName': 'Finals', 'defaultNoOfRiders': 2}
-        },
-        'Elimination': {
-            1: {'roundName': '', 'defaultNoOfRiders': 18},
-        },
-        'Scratch': {
-            1: {'roundName': '', 'defaultNoOfRiders': 18},
-        },
-        'Keirin': {
-            1: {'roundName': 'Qualifications', 'defaultNoOfRiders': 6},
-            2: {'roundName': 'Final', 'defaultNoOfRiders': 6},
-        }
-    }
+    d = ROUND_DEFINITIONS
 
     # select only races with 1st Heat, as it is start of round.
     round_start_races = []
@@ -764,7 +917,7 @@ def update_round_level_object_with_startlist(start_list):
     In order to enrich Rounds object with RacesInRound we have to first get actual state of function,
     Then append new race which is within scope of round and update Round object
     :param dict start_list: name of table
-    :return: nothing, just execute
+    :return: updated Round object
     '''
     count = 0
     UCIIDs = []
@@ -797,6 +950,45 @@ def update_round_level_object_with_startlist(start_list):
         }
     update_ddb_item(DYNAMODB_TABLE, update_params['keys'], update_params['update_expressions'], update_params['expression_values'])
     logger.info("Successfully updated Round objects in ddb under pk=%s  sk=%s  " % (actual['pk']['S'], actual['sk']['S']))
+    return actual
+
+
+def update_bracket_predictions(start_list, round_object):
+    '''
+    Used for Rounds, triggered with StartList object call
+    Once the start lists of all heats of a Sprint or Keirin round are known, simulates the rest of the event from the
+    riders' elo scores and saves the probability to reach every following round and to win per rider in the Round object
+    :param dict start_list: start list payload of /StoreRaceStartList
+    :param dict round_object: Round object in DynamoDB format, as returned by update_round_level_object_with_startlist
+    :return: BracketPredictions attribute in DynamoDB format, None if the round was not simulated
+    '''
+    rounds = ROUND_DEFINITIONS.get(start_list['RaceType'], {})
+    current_round = int(start_list['Round'])
+    next_rounds = [(rounds[r]['defaultNoOfHeats'], rounds[r]['defaultNoOfRiders']) for r in sorted(rounds) if r > current_round]
+    heats_uciids = [[rider['N'] for rider in race['M']['RidersUCIID']['L']]
+                    for race in round_object['RacesInRound']['L'] if 'RidersUCIID' in race['M']]
+    if not next_rounds or len(heats_uciids) < int(start_list['TotalHeats']):
+        return None
+    uciids = [uciid for heat in heats_uciids for uciid in heat]
+    start_time = time.time()
+    ratings = get_favourite_ratings(DYNAMODB_TABLE, uciids, consistent_read=False)
+    heats, position = [], 0
+    for heat in heats_uciids:
+        heats.append(list(range(position, position + len(heat))))
+        position += len(heat)
+    reach_probabilities, win_probabilities = rating.simulate_bracket(
+        heats, [ratings[uciid]['mu'] for uciid in uciids], [ratings[uciid]['sigma'] for uciid in uciids],
+        next_rounds, BRACKET_SIMULATIONS)
+    bracket_predictions = {'L': [{'M': {
+        'UCIID': {'N': uciid},
+        'RoundProbabilities': {'L': [{'N': str(round(p, 4))} for p in reach]},
+        'WinProbability': {'N': str(round(win, 4))}
+    }} for uciid, reach, win in zip(uciids, reach_probabilities, win_probabilities)]}
+    update_ddb_item(DYNAMODB_TABLE, {'pk': round_object['pk'], 'sk': round_object['sk']},
+                    'SET BracketPredictions = :bracketPredictions', {':bracketPredictions': bracket_predictions})
+    logger.info("Simulated the %s bracket of %s riders from round %s %s times in %.3fs" % (
+        start_list['RaceType'], len(uciids), current_round, BRACKET_SIMULATIONS, time.time() - start_time))
+    return bracket_predictions
 
 
 
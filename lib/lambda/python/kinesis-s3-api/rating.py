@@ -0,0 +1,224 @@
+"""TrueSkill rating helpers used for predictions and online rating updates on race data ingestion"""
+
+import math
+import numpy as np
+
+# TrueSkill environment of the elocalibration Glue job: trueskill.TrueSkill(draw_probability=0)
+DEFAULT_MU = 25.0
+DEFAULT_SIGMA = DEFAULT_MU / 3
+BETA = DEFAULT_SIGMA / 2
+TAU = DEFAULT_SIGMA / 100
+# convergence threshold of the message passing loop, same as trueskill.DELTA
+MIN_DELTA = 0.0001
+
+
+def erfc(x):
+    '''
+    Complementary error function approximation (Numerical Recipes erfcc) of the default trueskill backend, which the
+    elocalibration Glue job rates with, so online updates match the batch elo scores
+    :param float x: value
+    :return: float
+    '''
+    z = abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * math.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+        0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+    return 2. - r if x < 0 else r
+
+
+def cdf(x):
+    '''
+    Cumulative distribution function of the standard normal distribution
+    :param float x: value
+    :return: float
+    '''
+    return 0.5 * erfc(-x / math.sqrt(2))
+
+
+def pdf(x):
+    '''
+    Probability density function of the standard normal distribution
+    :param float x: value
+    :return: float
+    '''
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+
+def _combine(pi_a, pi_b):
+    # precision of the sum or difference of two independent gaussian messages
+    pi_inv = (1. / pi_a if pi_a else math.inf) + (1. / pi_b if pi_b else math.inf)
+    return 1. / pi_inv
+
+
+def rate_free_for_all(mu, sigma, beta=BETA, tau=TAU, min_delta=MIN_DELTA):
+    '''
+    Free-for-all TrueSkill update of one heat without draws, same message passing schedule as trueskill.TrueSkill.rate
+    for teams of one rider (see elo_utils.trueskill_engine.rate_heat of the elocalibration Glue job)
+    :param list mu: rating mean per rider, ordered by finishing position (winner first)
+    :param list sigma: rating std per rider, ordered by finishing position (winner first)
+    :param float beta: performance std
+    :param float tau: dynamic factor added to sigma before the heat
+    :param float min_delta: convergence threshold of the message passing loop
+    :return: tuple with the list of new means and the list of new stds, same order as the input
+    '''
+    n = len(mu)
+    if n < 2:
+        return list(mu), list(sigma)
+    beta2 = beta ** 2
+    tau2 = tau ** 2
+    prior_pi = [1. / (s * s + tau2) for s in sigma]
+    prior_tau = [p * m for p, m in zip(prior_pi, mu)]
+    perf_pi = [p / (1. + beta2 * p) for p in prior_pi]
+    perf_tau = [t / (1. + beta2 * p) for p, t in zip(prior_pi, prior_tau)]
+    left_pi, left_tau = [0.] * n, [0.] * n
+    right_pi, right_tau = [0.] * n, [0.] * n
+    diff_pi, diff_tau = [0.] * (n - 1), [0.] * (n - 1)
+    trunc_pi, trunc_tau = [0.] * (n - 1), [0.] * (n - 1)
+
+    def down(j):
+        a_pi, a_tau = perf_pi[j] + left_pi[j], perf_tau[j] + left_tau[j]
+        b_pi, b_tau = perf_pi[j + 1] + right_pi[j + 1], perf_tau[j + 1] + right_tau[j + 1]
+        pi = _combine(a_pi, b_pi)
+        diff_pi[j], diff_tau[j] = pi, pi * ((a_pi and a_tau / a_pi) - (b_pi and b_tau / b_pi))
+
+    def truncate(j):
+        div_pi, div_tau = diff_pi[j], diff_tau[j]
+        sqrt_pi = math.sqrt(div_pi)
+        x = div_tau / sqrt_pi
+        denom_cdf = cdf(x)
+        v = pdf(x) / denom_cdf if denom_cdf else -x
+        w = v * (v + x)
+        if not 0 < w < 1:
+            raise FloatingPointError('Cannot calculate the rating update of the heat')
+        pi, tau = div_pi / (1. - w), (div_tau + sqrt_pi * v) / (1. - w)
+        pi_delta = abs(div_pi + trunc_pi[j] - pi)
+        delta = 0. if pi_delta == math.inf else max(abs(div_tau + trunc_tau[j] - tau), math.sqrt(pi_delta))
+        trunc_pi[j], trunc_tau[j] = pi - div_pi, tau - div_tau
+        return delta
+
+    def up_right(j):
+        a_pi, a_tau = perf_pi[j] + left_pi[j], perf_tau[j] + left_tau[j]
+        pi = _combine(a_pi, trunc_pi[j])
+        left_pi[j + 1], left_tau[j + 1] = pi, pi * ((a_pi and a_tau / a_pi) - (trunc_pi[j] and trunc_tau[j] / trunc_pi[j]))
+
+    def up_left(j):
+        b_pi, b_tau = perf_pi[j + 1] + right_pi[j + 1], perf_tau[j + 1] + right_tau[j + 1]
+        pi = _combine(trunc_pi[j], b_pi)
+        right_pi[j], right_tau[j] = pi, pi * ((trunc_pi[j] and trunc_tau[j] / trunc_pi[j]) + (b_pi and b_tau / b_pi))
+
+    n_diffs = n - 1
+    for _ in range(10):
+        if n_diffs == 1:
+            down(0)
+            delta = truncate(0)
+        else:
+            delta = 0.
+            for j in range(n_diffs - 1):
+                down(j)
+                delta = max(delta, truncate(j))
+                up_right(j)
+            for j in range(n_diffs - 1, 0, -1):
+                down(j)
+                delta = max(delta, truncate(j))
+                up_left(j)
+        if delta <= min_delta:
+            break
+    up_left(0)
+    up_right(n_diffs - 1)
+
+    new_mu, new_sigma = [], []
+    for i in range(n):
+        m_pi, m_tau = left_pi[i] + right_pi[i], left_tau[i] + right_tau[i]
+        pi = 1. / (1. / m_pi) if m_pi else 0.
+        tau = pi * (m_pi and m_tau / m_pi)
+        a = 1. / (1. + beta2 * pi)
+        pi, tau = prior_pi[i] + a * pi, prior_tau[i] + a * tau
+        new_mu.append(tau / pi)
+        new_sigma.append(math.sqrt(1. / pi))
+    return new_mu, new_sigma
+
+
+def win_probability_matrix(mu, sigma, beta=BETA):
+    '''
+    Pairwise TrueSkill win probabilities of a start list without draws
+    :param list mu: rating mean per rider
+    :param list sigma: rating std per rider
+    :param float beta: performance std
+    :return: N x N list of lists, entry [i][j] is the probability that rider i finishes ahead of rider j, 0 on the diagonal
+    '''
+    beta2 = 2 * beta ** 2
+    variances = [s * s for s in sigma]
+    return [[cdf((mu_i - mu_j) / math.sqrt(beta2 + var_i + var_j)) if i != j else 0.
+             for j, (mu_j, var_j) in enumerate(zip(mu, variances))]
+            for i, (mu_i, var_i) in enumerate(zip(mu, variances))]
+
+
+def expected_ranks(mu, sigma, beta=BETA):
+    '''
+    Expected finishing position of every rider of a start list: one plus the probabilities of being beaten by the other riders
+    :param list mu: rating mean per rider
+    :param list sigma: rating std per rider
+    :param float beta: performance std
+    :return: tuple with the win probability matrix and the list of expected finishing positions
+    '''
+    win_probabilities = win_probability_matrix(mu, sigma, beta)
+    n = len(mu)
+    return win_probabilities, [n - sum(row) for row in win_probabilities]
+
+
+def _advance(riders, performance, heat_sizes, n_next_heats, riders_per_heat):
+    # riders of a round ordered by qualification: all heat winners first, then all second places and so on, each
+    # placing ordered by performance. They are seeded serpentine into the heats of the next round.
+    # riders and performance are (simulations x riders of the round) arrays, the heats are consecutive columns of heat_sizes
+    placings_riders, placings_performance = [], []
+    start = 0
+    for size in heat_sizes:
+        order = np.argsort(-performance[:, start:start + size], axis=1)
+        placings_riders.append(np.take_along_axis(riders[:, start:start + size], order, axis=1))
+        placings_performance.append(np.take_along_axis(performance[:, start:start + size], order, axis=1))
+        start += size
+    qualified = []
+    for placing in range(max(heat_sizes)):
+        heats = [i for i, size in enumerate(heat_sizes) if placing < size]
+        placing_riders = np.stack([placings_riders[i][:, placing] for i in heats], axis=1)
+        placing_performance = np.stack([placings_performance[i][:, placing] for i in heats], axis=1)
+        qualified.append(np.take_along_axis(placing_riders, np.argsort(-placing_performance, axis=1), axis=1))
+    qualified = np.concatenate(qualified, axis=1)[:, :n_next_heats * riders_per_heat]
+    next_heats = [[] for _ in range(n_next_heats)]
+    for i in range(qualified.shape[1]):
+        lap, position = divmod(i, n_next_heats)
+        next_heats[position if lap % 2 == 0 else n_next_heats - 1 - position].append(i)
+    next_heats = [heat for heat in next_heats if heat]
+    return qualified[:, [i for heat in next_heats for i in heat]], [len(heat) for heat in next_heats]
+
+
+def simulate_bracket(heats, mu, sigma, next_rounds, n_simulations=2000, seed=None, beta=BETA):
+    '''
+    Monte Carlo simulation of a multi-round event. Every simulation samples one performance per rider and round from
+    the TrueSkill rating, the riders with the best performance per heat advance until the final is decided.
+    All simulations of a round are sampled at once as one (simulations x riders) matrix.
+    :param list heats: list of heats of the first simulated round, each a list of rider indexes into mu and sigma
+    :param list mu: rating mean per rider
+    :param list sigma: rating std per rider
+    :param list next_rounds: (number of heats, riders per heat) of every following round, the last one is the final
+    :param int n_simulations: number of simulated events
+    :param int seed: seed of the random generator
+    :param float beta: performance std
+    :return: tuple with the list of probabilities to reach every following round per rider and the win probability per rider
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(mu)
+    mu = np.asarray(mu, dtype=float)
+    performance_std = np.sqrt(np.asarray(sigma, dtype=float) ** 2 + beta ** 2)
+    reached = np.zeros((n, len(next_rounds)))
+    riders = np.tile([rider for heat in heats for rider in heat], (n_simulations, 1))
+    heat_sizes = [len(heat) for heat in heats]
+    for round_index, (n_next_heats, riders_per_heat) in enumerate(next_rounds):
+        performance = mu[riders] + performance_std[riders] * rng.standard_normal(riders.shape)
+        riders, heat_sizes = _advance(riders, performance, heat_sizes, n_next_heats, riders_per_heat)
+        reached[:, round_index] = np.bincount(riders.ravel(), minlength=n)
+    wins = np.zeros(n)
+    if riders.shape[1]:
+        performance = mu[riders] + performance_std[riders] * rng.standard_normal(riders.shape)
+        wins = np.bincount(riders[np.arange(n_simulations), np.argmax(performance, axis=1)], minlength=n)
+    return (reached / n_simulations).tolist(), (wins / n_simulations).tolist()
@@ -4,9 +4,13 @@ import base64
 import datetime
 import logging
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from json import loads
 
 import boto3
+from botocore.exceptions import ClientError
 
 dynamodb_client = boto3.client('dynamodb')
 cloudwatch_client = boto3.client('cloudwatch')
@@ -18,6 +22,25 @@ table_name_live = os.environ['DYNAMODB_TABLE_NAME_LIVE']
 table_name_static = os.environ['DYNAMODB_TABLE_NAME_STATIC']
 project_env = os.environ['ENVIRONMENT']
 NUMBER_OF_RETRIES = 2
+# concurrent BatchWriteItem writer of the stream items
+BATCH_SIZE = 25
+MAX_WRITE_WORKERS = 8
+BASE_BACKOFF_S = 0.05
+MAX_BACKOFF_S = 2.
+# remaining invocation time kept for the derived updates after the item writes
+WRITE_TIME_RESERVE_MS = 10000
+RETRYABLE_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+                    'InternalServerError', 'ServiceUnavailable']
+# messages whose items are merged into the AGG#JOINEDLIVEDATA#LATEST# row of the rider
+LATEST_MESSAGES = ["AggRidersData", "AggRidersTracking"]
+# EventTimeStamp of the LATEST rows written by this container, stale updates are dropped before they are sent
+MAX_CACHED_LATEST_ROWS = 10000
+latest_event_time_stamps = {}
+
+# pipeline latency metrics, aggregated per invocation
+METRICS_NAMESPACE = 'UciTcl/dataPipeline'
+MAX_METRIC_DATA = 1000
+EPOCH = datetime.datetime(1970, 1, 1)
 
 # ONLY FOR PERSONAL BEST
 SENDER = os.environ['SENDER']
@@ -31,135 +54,75 @@ POWER_FIELDS = ["Power5s", "Power15s", "Power30s", "Power60s", "Power120s", "Pow
 def lambda_handler(event, context):
     payload = event['records']
     logger.info('Got : %s Records', len(payload))
-    output = []
-    success = 0
-    failure = 0
-    put_request_list = []
-    update_request_list_riders_data = []
-    update_request_list_riders_tracking = []
-    records_processed_in_current_batch = []
-    metrics_for_cw = {}
-    number_of_elements_to_process = len(payload)
-    logger.info("Number of records to process: {}".format(number_of_elements_to_process))
-    batch_processing_start = time_now_str()
-    for i, record in enumerate(payload):
+    batch_processing_start_ms = now_epoch_ms()
+    # time budget of the item writes, the rest of the invocation is left for the derived updates
+    write_deadline = time.monotonic() + max(context.get_remaining_time_in_millis() - WRITE_TIME_RESERVE_MS, 0) / 1000.
+    converted_records = []
+    ddb_items = {}
+    latency_stats = {}
+    errors = {}
+    for record in payload:
         try:
             # main flow which handles standard items and raw messages
-            ddb_item = convert_event_to_dbd_item(record)
-
-            records_processed_in_current_batch.append({"record": record, "ddb_item": ddb_item})
-            logger.debug('ddb_item: %s', ddb_item)
-            put_request = {
-                "PutRequest": {
-                    "Item": ddb_item
-                }
-            }
-            put_request_list.append(put_request)
-            # batch every 25 elements or process remaining items if less then 25
+            data_item = decode_record(record)
+            ddb_item = convert_event_to_dbd_item(data_item)
+            if not ddb_item:
+                raise ValueError("Unknown InputMessage: {}".format(data_item.get('InputMessage')))
+            item_key = (ddb_item['pk']['S'], ddb_item['sk']['S'])
+            # one write per key, BatchWriteItem rejects duplicate keys in one request
+            ddb_items[item_key] = ddb_item
+            converted_records.append((record, data_item, ddb_item, item_key))
             try:
-                metrics_for_cw[ddb_item["Message"]['S']] = {}
-                metrics_for_cw[ddb_item["Message"]['S']]['APIIngestTime'] = ddb_item["ApiIngestTime"]['S']
-                metrics_for_cw[ddb_item["Message"]['S']]['KinesisAnalyticsIngestTime'] = ddb_item["KinesisAnalyticsIngestTime"]['S']
-                metrics_for_cw[ddb_item["Message"]['S']]['DynamoIngestTime'] = ddb_item["DynamoIngestTime"]['S']
-                metrics_for_cw[ddb_item["Message"]['S']]['StoreToDynamoLambdaTimeStart'] = batch_processing_start
+                entity = ddb_item["Message"]['S']
+                dynamo_ingest_ms = now_epoch_ms()
+                api_ingest_ms = epoch_ms(ddb_item["ApiIngestTime"]['S'])
+                kinesis_analytics_ingest_ms = epoch_ms(ddb_item["KinesisAnalyticsIngestTime"]['S'])
+                add_latency(latency_stats, entity, 'TotalPipelineTimeMs', dynamo_ingest_ms - api_ingest_ms)
+                add_latency(latency_stats, entity, 'APIToKinesisTimeMs', kinesis_analytics_ingest_ms - api_ingest_ms)
+                add_latency(latency_stats, entity, 'KinesisToDynamoTimeMs', dynamo_ingest_ms - kinesis_analytics_ingest_ms)
             except Exception as e:
                 logger.error(e, exc_info=True)
                 logger.error("Failed to get metrics from record.")
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            logger.error("Failed to convert record %s.", record['recordId'])
+            errors[record['recordId']] = str(e)
+
+    logger.info("Number of distinct entries stored to DynamoDB {}".format(len(ddb_items)))
+    failed_items = write_items(table_name_live, ddb_items, write_deadline)
+    for record, _, _, item_key in converted_records:
+        if item_key in failed_items:
+            errors[record['recordId']] = failed_items[item_key]
+    lambda_to_dynamo_ms = now_epoch_ms() - batch_processing_start_ms
+    for entity in {entity for entity, _ in latency_stats}:
+        add_latency(latency_stats, entity, 'StoreToDynamoLambdaTime', lambda_to_dynamo_ms)
+    put_latency_stats_to_cw(latency_stats)
 
-            if len(put_request_list) == 25 or i == number_of_elements_to_process - 1:
-                try:
-                    logger.debug("Processed {} number of records. Sending them to DynamoDB table.".format(len(put_request_list)))
-                    logger.debug("items before distinct: {}".format(put_request_list))
-                    distinct_put_requests = list({str(v['PutRequest']['Item']['pk']) + str(v['PutRequest']['Item']['sk']): v for v in put_request_list}.values())
-                    logger.info("Number of distinct entries stored to DynamoDB {}".format(len(distinct_put_requests)))
-                    data = {
-                        table_name_live: distinct_put_requests
-                    }
-                    logger.debug("put_requests: " + str(data))
-                    multi_put_result = dynamodb_client.batch_write_item(RequestItems=data)
-                    logger.debug("multi put result: " + str(multi_put_result))
-                    unprocessed_items = multi_put_result.get("UnprocessedItems").get(table_name_live, "")
-                    if len(unprocessed_items) > 0:
-                        # In case there are unprocessed items try sending them again (see https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchWriteItem.html)
-                        # We try it once and assume succeeds. This will happen if any requested operations fail because the table's provisioned
-                        # throughput is exceeded or an internal processing failure occurs
-                        logger.warning("The following records were not processed: {}. Trying again.".format(unprocessed_items))
-                        multi_put_result = dynamodb_client.batch_write_item(RequestItems=multi_put_result.get("UnprocessedItems"))
-                        logger.info("Retry result: {}.".format(multi_put_result))
-                    success += len(records_processed_in_current_batch)
-                    for currently_processed_record in records_processed_in_current_batch:
-                        output.append({'recordId': currently_processed_record.get("record")['recordId'], 'result': 'Ok'})
-                    put_request_list.clear()
-                    records_processed_in_current_batch.clear()
-                    for key in metrics_for_cw.keys():
-                        metrics_for_cw.get(key)['StoreToDynamoLambdaTimeEnd'] = time_now_str()
-                    put_timing_stats_to_cw(metrics_for_cw)
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-                    logger.error("Failed to store batch of records. Trying to put then one by one")
-                    # In case of batch exception try to process individual records one by one
-                    for currently_processed_record in records_processed_in_current_batch:
-                        try:
-                            put_item_to_ddb(currently_processed_record.get("ddb_item"), table_name_live)
-                            success += 1
-                        except Exception as e:
-                            logger.error(e, exc_info=True)
-                            logger.error("Failed to process single record.")
-                            if (currently_processed_record.get("record")['lambdaDeliveryRecordMetadata']['retryHint'] > NUMBER_OF_RETRIES):
-                                # TODO: implement dead letter queue for such records
-                                logger.info("skipping record after %d retries", currently_processed_record['lambdaDeliveryRecordMetadata']['retryHint'])
-                                output.append({'recordId': currently_processed_record.get("record")['recordId'], 'result': 'Ok'})
-                            else:
-                                output.append({'recordId': currently_processed_record.get("record")['recordId'], 'result': 'DeliveryFailed', 'reason:': str(e)})
-                                failure += 1
-                                output.append({'recordId': currently_processed_record.get("record")['recordId'], 'result': 'Ok'})
-                    for key in metrics_for_cw.keys():
-                        metrics_for_cw.get(key)['StoreToDynamoLambdaTimeEnd'] = time_now_str()
-                    put_timing_stats_to_cw(metrics_for_cw)
-                    put_request_list.clear()
-                    records_processed_in_current_batch.clear()
-
-            race_details = extract_message_details(record)
+    output = []
+    failure = 0
+    for record in payload:
+        if record['recordId'] not in errors:
+            output.append({'recordId': record['recordId'], 'result': 'Ok'})
+        elif record['lambdaDeliveryRecordMetadata']['retryHint'] > NUMBER_OF_RETRIES:
+            # TODO: implement dead letter queue for such records
+            logger.info("skipping record %s after %d retries: %s", record['recordId'],
+                        record['lambdaDeliveryRecordMetadata']['retryHint'], errors[record['recordId']])
+            output.append({'recordId': record['recordId'], 'result': 'Ok'})
+        else:
+            output.append({'recordId': record['recordId'], 'result': 'DeliveryFailed'})
+            failure += 1
+
+    # side computations which populates derived data like aggregates, updates for race_status
+    # or LATEST row for each rider with the most current information, after the items of the batch are stored.
+    # The LATEST rows are updated first, race aggregates of FinishTime are computed from them.
+    latest_items = [ddb_item for _, data_item, ddb_item, _ in converted_records
+                    if data_item['InputMessage'] in LATEST_MESSAGES]
+    update_latest_items(coalesce_latest_updates(latest_items))
+    for record, data_item, ddb_item, _ in converted_records:
+        try:
+            race_details = extract_message_details(data_item)
             logger.debug("Race details: " + str(race_details))
-
-            # side computations which populates derived data like aggregates, updates for race_status
-            # or LATEST row for each rider with the most current information.
-            if race_details["InputMessage"] in ["AggRidersData", "AggRidersTracking"]:
-                # updates current rider item
-                logger.debug("Updating Rider #LATEST item")
-                update_params = get_update_params_for_latest(ddb_item)
-                logger.debug("update params: {}".format(update_params))
-                transact_item = {
-                    "Update": {
-                        'TableName': table_name_live,
-                        'Key': update_params['keys'],
-                        'UpdateExpression': update_params['update_expressions'],
-                        "ExpressionAttributeValues": update_params['expression_values']
-
-                    }
-                }
-                if race_details["InputMessage"] == "AggRidersData":
-                    update_request_list_riders_data.append({
-                        "record": record,
-                        "transact_item": transact_item,
-                        "update_params": update_params
-                    })
-                if len(update_request_list_riders_data) == 25:
-                    update_agg_latest(update_request_list_riders_data)
-                if race_details["InputMessage"] == "AggRidersTracking":
-                    update_request_list_riders_tracking.append({
-                        "record": record,
-                        "transact_item": transact_item,
-                        "update_params": update_params
-                    })
-                if len(update_request_list_riders_tracking) == 25:
-                    update_agg_latest(update_request_list_riders_tracking)
-            # if some aggregates are left to process  and the whole batch was processed update aggreagates
-            if i == number_of_elements_to_process - 1 and len(update_request_list_riders_data) > 0:
-                update_agg_latest(update_request_list_riders_data)
-            if i == number_of_elements_to_process - 1 and len(update_request_list_riders_tracking) > 0:
-                update_agg_latest(update_request_list_riders_tracking)
-            elif race_details["InputMessage"] == "RaceStartLive":
+            if race_details["InputMessage"] == "RaceStartLive":
                 # set race_status to LIVE
                 update_params = get_update_params_for_race_status(ddb_item, new_race_status="LIVE")
                 update_ddb_item(table_name_static, _keys=update_params['keys'],
@@ -177,34 +140,129 @@ def lambda_handler(event, context):
                                 _expression_values=update_params['expression_values'])
                 # trigger personal best email notification after race end
                 trigger_personal_best(table_name_live, table_name_static, race_details)
-
         except Exception as e:
             logger.error(e, exc_info=True)
-    logger.info('Successfully delivered %s records, failed to deliver %s records', success, failure)
+
+    logger.info('Successfully delivered %s records, failed to deliver %s records', len(payload) - len(errors), failure)
     return {'records': output}
 
 
-def update_agg_latest(update_request_list):
+def write_batch(_table_name, put_requests, deadline, _retry_count=0):
+    '''
+    Writes up to 25 put requests with BatchWriteItem. Unprocessed items and throttled requests are retried with jittered
+    exponential backoff until the deadline, a batch rejected as invalid is split to isolate the invalid items
+    :param str _table_name: name of table
+    :param list put_requests: PutRequest dicts with distinct keys
+    :param float deadline: time.monotonic() after which no retry is started
+    :param int _retry_count: number of retries so far
+    :return: dict error message per (pk, sk) of the items which were not written
+    '''
     try:
-        # get distinct updates for any given key (only one update for a given primary key is allowed in one batch)
-        # order list by timestamp
-        def get_start_time(round_object):
-            return round_object['transact_item']['Update']['Key']['sk']['S']
-        update_request_list.sort(key=get_start_time)
-        transact_items = list({str(v['transact_item']['Update']['Key']): v['transact_item'] for v in update_request_list}.values())
-        logger.info("Number of unique updates to perform: {}".format(len(transact_items)))
-        update_result = dynamodb_client.transact_write_items(TransactItems=transact_items)
-        update_request_list.clear()
-    except Exception as e:
-        logger.error("Failed to update in batch")
-        logger.error(e, exc_info=True)
-        logger.info("Trying to process updates one by one. ")
-        for update in update_request_list:
-            update_params = update.get("update_params")
-            update_ddb_item(table_name_live, _keys=update_params['keys'],
-                            _update_expressions=update_params['update_expressions'],
-                            _expression_values=update_params['expression_values'])
-        update_request_list.clear()
+        multi_put_result = dynamodb_client.batch_write_item(RequestItems={_table_name: put_requests})
+        put_requests = multi_put_result.get("UnprocessedItems", {}).get(_table_name, [])
+        if not put_requests:
+            return {}
+        # see https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchWriteItem.html
+        reason = "{} unprocessed items".format(len(put_requests))
+    except ClientError as ex:
+        reason = ex.response['Error']['Code']
+        if reason not in RETRYABLE_ERRORS:
+            if len(put_requests) == 1:
+                logger.error("Failed to store item %s", put_requests[0]['PutRequest']['Item'])
+                logger.error(ex, exc_info=True)
+                return {item_key(put_requests[0]): reason}
+            middle = len(put_requests) // 2
+            failed_items = write_batch(_table_name, put_requests[:middle], deadline)
+            failed_items.update(write_batch(_table_name, put_requests[middle:], deadline))
+            return failed_items
+
+    backoff = min(MAX_BACKOFF_S, BASE_BACKOFF_S * 2 ** _retry_count) * random.uniform(0.5, 1.5)
+    if time.monotonic() + backoff > deadline:
+        logger.error("Giving up on %d items after %d retries: %s", len(put_requests), _retry_count, reason)
+        return {item_key(put_request): reason for put_request in put_requests}
+    logger.warning("Retrying %d items in %.3fs: %s", len(put_requests), backoff, reason)
+    time.sleep(backoff)
+    return write_batch(_table_name, put_requests, deadline, _retry_count + 1)
+
+
+def write_items(_table_name, ddb_items, deadline):
+    '''
+    Writes the items of the invocation with concurrent 25 item BatchWriteItem requests
+    :param str _table_name: name of table
+    :param dict ddb_items: DynamoDB item per (pk, sk)
+    :param float deadline: time.monotonic() after which no retry is started
+    :return: dict error message per (pk, sk) of the items which were not written
+    '''
+    put_requests = [{"PutRequest": {"Item": ddb_item}} for ddb_item in ddb_items.values()]
+    batches = [put_requests[i:i + BATCH_SIZE] for i in range(0, len(put_requests), BATCH_SIZE)]
+    if not batches:
+        return {}
+    failed_items = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WRITE_WORKERS, len(batches))) as executor:
+        futures = {executor.submit(write_batch, _table_name, batch, deadline): batch for batch in batches}
+        for future, batch in futures.items():
+            try:
+                failed_items.update(future.result())
+            except Exception as ex:
+                logger.error("Failed to store batch of records.")
+                logger.error(ex, exc_info=True)
+                failed_items.update({item_key(put_request): str(ex) for put_request in batch})
+    logger.info("Stored %d items in %d batches, %d failed", len(put_requests) - len(failed_items), len(batches), len(failed_items))
+    return failed_items
+
+
+def item_key(put_request):
+    return put_request['PutRequest']['Item']['pk']['S'], put_request['PutRequest']['Item']['sk']['S']
+
+
+def latest_sort_key(ddb_item):
+    return 'RACE#RaceID=' + ddb_item['RaceID']['S'] + '#' + "UCIID=" + ddb_item['UCIID']['S'] + '#'
+
+
+def coalesce_latest_updates(ddb_items):
+    '''
+    Coalesces the AggRidersData and AggRidersTracking items of the invocation into one LATEST attribute set per rider:
+    the items of a rider are merged in EventTimeStamp order, every attribute keeps its newest value
+    :param list ddb_items: AggRidersData and AggRidersTracking items in stream order
+    :return: dict merged item per LATEST sk
+    '''
+    latest_items = {}
+    # stable sort, items with the same EventTimeStamp are merged in stream order
+    for ddb_item in sorted(ddb_items, key=lambda item: item['EventTimeStamp']['S']):
+        latest_items.setdefault(latest_sort_key(ddb_item), {}).update(ddb_item)
+    logger.info("Coalesced {} LATEST updates into {} updates".format(len(ddb_items), len(latest_items)))
+    return latest_items
+
+
+def update_latest_items(latest_items):
+    '''
+    Updates the LATEST row of every rider with concurrent UpdateItem requests
+    :param dict latest_items: merged item per LATEST sk, see coalesce_latest_updates
+    :return: nothing, just execute
+    '''
+    if not latest_items:
+        return
+    # the LATEST row only moves forward in time: updates older than the row written before are not sent,
+    # updates older than the row in the table fail the condition of get_update_params_for_latest
+    fresh_items = {sk: ddb_item for sk, ddb_item in latest_items.items()
+                   if ddb_item['EventTimeStamp']['S'] >= latest_event_time_stamps.get(sk, "")}
+    if len(fresh_items) < len(latest_items):
+        logger.info("Dropped {} stale LATEST updates".format(len(latest_items) - len(fresh_items)))
+    if not fresh_items:
+        return
+    with ThreadPoolExecutor(max_workers=min(MAX_WRITE_WORKERS, len(fresh_items))) as executor:
+        futures = {}
+        for sk, ddb_item in fresh_items.items():
+            update_params = get_update_params_for_latest(ddb_item)
+            futures[sk] = executor.submit(update_ddb_item, table_name_live, _keys=update_params['keys'],
+                                          _update_expressions=update_params['update_expressions'],
+                                          _expression_values=update_params['expression_values'],
+                                          _condition_expression=update_params['condition_expression'])
+    if len(latest_event_time_stamps) + len(futures) > MAX_CACHED_LATEST_ROWS:
+        latest_event_time_stamps.clear()
+    for sk, future in futures.items():
+        if future.result():
+            latest_event_time_stamps[sk] = fresh_items[sk]['EventTimeStamp']['S']
 
 
 def store_aggregates(race_details):
@@ -228,15 +286,18 @@ def get_update_params_for_latest(original_ddb_item: dict):
     '''
     Response update parameters for object_name based on our scenario
     After getting AggLiveRiders or AggLiveRidersTracking - it sets the #LATEST row in live table: pk=AGG#JOINEDLIVEDATA#LATEST#
-    :param dict original_ddb_item: it is generated schema prepared for insertion of original object
+    :param dict original_ddb_item: it is generated schema prepared for insertion of original object, or the merged
+        items of a rider, see coalesce_latest_updates
     :return: dict update parameters which are used in
     '''
     update_parameters = {
         'keys': {
             'pk': {"S": 'AGG#JOINEDLIVEDATA#LATEST#'},
-            'sk': {"S": 'RACE#RaceID=' + original_ddb_item['RaceID']['S'] + '#' + "UCIID=" + original_ddb_item['UCIID']['S'] + '#'}},
+            'sk': {"S": latest_sort_key(original_ddb_item)}},
         'update_expressions': 'SET EventTimeStamp = :newEventTimeStamp ',
-        'expression_values': {':newEventTimeStamp': original_ddb_item['EventTimeStamp']}
+        'expression_values': {':newEventTimeStamp': original_ddb_item['EventTimeStamp']},
+        # an aggregate arriving late must not overwrite a newer LATEST row
+        'condition_expression': 'attribute_not_exists(EventTimeStamp) OR EventTimeStamp <= :newEventTimeStamp'
     }
 
     logger.debug("original_ddb_item.items(): {}".format(str(original_ddb_item.items())))
@@ -270,43 +331,56 @@ def get_update_params_for_race_status(original_ddb_item: dict, new_race_status="
     return update_parameters
 
 
-def update_ddb_item(_table_name, _keys, _update_expressions, _expression_values, _retry_count=3):
+def update_ddb_item(_table_name, _keys, _update_expressions, _expression_values, _retry_count=3, _condition_expression=None):
     '''
     Updates dynamoDB item
     :param str _table_name: name of table
     :param dict _keys: keys for item to update
     :param str _update_expressions: update commands to execute on dynamodb side
-    :param str _expression_values: populated values to variables used in _update_expressions
+    :param str _expression_values: populated values to variables used in _update_expressions and _condition_expression
     :param int _retry_count: how many times shall we retry in case of failure
-    :return: nothing, just execute
+    :param str _condition_expression: condition of the update, a failed condition is not retried
+    :return: bool item was updated
     '''
+    condition = {'ConditionExpression': _condition_expression} if _condition_expression else {}
     try:
         dynamodb_client.update_item(TableName=_table_name,
                                     Key=_keys,
                                     UpdateExpression=_update_expressions,
                                     ExpressionAttributeValues=_expression_values,
-                                    ReturnValues="UPDATED_NEW"
+                                    ReturnValues="UPDATED_NEW",
+                                    **condition
                                     )
+        return True
     except Exception as ex:
+        if isinstance(ex, ClientError) and ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.debug("Skipped update of keys %s: %s" % (_keys, _condition_expression))
+            return False
         logger.error("Failed to update dynamodb fields with keys: %s try number: %s" % (_keys, _retry_count))
         logger.error(ex, exc_info=True)
-        retry_count = _retry_count - 1
-        if retry_count > 0:
-            update_ddb_item(_table_name, _keys, _update_expressions, _expression_values, retry_count)
+    retry_count = _retry_count - 1
+    if retry_count > 0:
+        return update_ddb_item(_table_name, _keys, _update_expressions, _expression_values, retry_count, _condition_expression)
+    return False
 
 
 def put_item_to_ddb(ddb_item, _table_name):
     dynamodb_client.put_item(TableName=_table_name, Item=ddb_item)
 
 
-def extract_message_details(record):
+def decode_record(record):
+    '''
+    Decodes the base64 encoded JSON payload of a Kinesis Analytics record, once per record
+    :param dict record: record of the lambda event
+    :return: dict decoded message
+    '''
     logger.debug('record: %s', record)
-    logger.debug('record[data]: %s', record['data'])
     payload = base64.b64decode(record['data'])
     logger.debug('base64 decoded payload: %s', payload)
-    data_item = loads(payload)
-    input_message = data_item['InputMessage']
-    logger.debug('Converting message %s', input_message)
+    return loads(payload)
+
+
+def extract_message_details(data_item):
     details = {
         'InputMessage': data_item.get('InputMessage', ""),
         'UCIID': str(data_item.get('UCIID', "")),
@@ -317,241 +391,109 @@ def extract_message_details(record):
     return details
 
 
-def convert_event_to_dbd_item(record):
-    logger.debug('record: %s', record)
-    logger.debug('record[data]: %s', record['data'])
-    payload = base64.b64decode(record['data'])
-    logger.debug('base64 decoded payload: %s', payload)
-    data_item = loads(payload)
+# field kinds of the item serializers:
+# RAW - {'S': value} as sent, skipped if the value is null
+# STR - {'S': str(value)}
+# NUM - {'N': str(value)}, skipped unless the value is a non negative number
+# NOW - {'S': time_now_str()} of the conversion
+RAW, STR, NUM, NOW = range(4)
+
+
+def _fields(kind, *names):
+    return tuple((name, name, kind) for name in names)
+
+
+_HEADER_FIELDS = (('Message', 'InputMessage', RAW),) + _fields(RAW, 'ApiIngestTime', 'KinesisAnalyticsIngestTime') + \
+                 (('DynamoIngestTime', None, NOW),)
+_RACE_FIELDS = _HEADER_FIELDS + _fields(RAW, 'ServerTimeStamp') + _fields(STR, 'SeasonID', 'EventID', 'RaceID')
+_RIDER_AGG_FIELDS = _HEADER_FIELDS + _fields(RAW, 'EventTimeStamp') + _fields(STR, 'SeasonID', 'EventID', 'RaceID')
+
+# per InputMessage: pk prefix, True for rider level keys (pk with RaceID, sk with UCIID and EventTimeStamp)
+# or False for race level keys (fixed pk, sk with RaceID and ServerTimeStamp), attribute fields in item order
+MESSAGE_SCHEMAS = {
+    'LiveRidersTracking': ("LIVERIDERSTRACKING#RaceID=", True,
+                           _HEADER_FIELDS + _fields(RAW, 'ServerTimeStamp', 'EventTimeStamp') +
+                           _fields(STR, 'SeasonID', 'EventID', 'RaceID', 'Bib', 'UCIID') + _fields(NUM, 'RiderRank') +
+                           _fields(STR, 'State') +
+                           _fields(NUM, 'Distance', 'DistanceProj', 'Speed', 'SpeedMax', 'SpeedAvg', 'DistanceFirst',
+                                   'DistanceNext', 'Acc', 'Lat', 'Lng')),
+    'LiveRidersData': ("LIVERIDERSDATA#RaceID=", True,
+                       _HEADER_FIELDS + _fields(RAW, 'ServerTimeStamp', 'EventTimeStamp') +
+                       _fields(STR, 'SeasonID', 'EventID', 'RaceID', 'Bib', 'UCIID') +
+                       _fields(NUM, 'RiderHeartrate', 'RiderCadency', 'RiderPower')),
+    'StartTime': ("STARTTIME#", False, _RACE_FIELDS),
+    'RaceStartLive': ("RACESTARTLIVE#", False, _RACE_FIELDS),
+    'FinishTime': ("FINISHTIME#", False, _RACE_FIELDS + _fields(STR, 'RaceTime', 'RaceSpeed')),
+    'LapCounter': ("LAPCOUNTER#", False, _RACE_FIELDS + _fields(STR, 'LapsToGo', 'DistanceToGo')),
+    'RiderEliminated': ("RIDERELIMINATED#", False,
+                        _RACE_FIELDS + _fields(STR, 'EliminatedRaceName', 'Bib', 'UCIID', 'FirstName', 'LastName',
+                                               'ShortTVName', 'Team', 'NOC')),
+    'AggRidersData': ("AGG#LIVERIDERSDATA#RaceID=", True,
+                      _RIDER_AGG_FIELDS + _fields(STR, 'Bib', 'LeagueCat', 'UCIID') +
+                      _fields(NUM, 'RiderHeartrate', 'AvgRaceRiderHeartrate', 'MaxRaceRiderHeartrate', 'MaxRaceHeartrate',
+                              'RiderCadency', 'AvgRaceRiderCadency', 'MaxRaceRiderCadency', 'MaxRaceCadency',
+                              'RiderPower', 'AvgRaceRiderPower', 'MaxRaceRiderPower', 'MaxRacePower',
+                              'IsInHeartrateRedZone', 'TimeSpentInRedZone', 'IsInHeartrateOrangeZone',
+                              'TimeSpentInOrangeZone', 'IsInHeartrateGreenZone', 'TimeSpentInGreenZone')),
+    'AggRidersTracking': ("AGG#LIVERIDERSTRACKING#RaceID=", True,
+                          _RIDER_AGG_FIELDS + _fields(STR, 'UCIID') +
+                          _fields(NUM, 'RiderSpeed', 'AvgRaceRiderSpeed', 'MaxRaceRiderSpeed', 'MaxRaceSpeed', 'RiderRank')),
+    'AggPersonalBest': ("AGG#PERSONALBEST#RaceID=", True,
+                        _RIDER_AGG_FIELDS + _fields(STR, 'Bib', 'LeagueCat', 'UCIID') +
+                        _fields(NUM, 'RiderHeartrate', 'RiderHeartrateExceeded', 'RiderPower', 'RiderPowerExceeded',
+                                *[name for field in POWER_FIELDS for name in (field, field + "Exceeded")])),
+}
+
+
+def compile_serializer(pk_prefix, rider_level, fields):
+    '''
+    Precompiles the item serializer of one message type
+    :param str pk_prefix: pk of race level items, prefix of the pk of rider level items
+    :param bool rider_level: keys of rider level items (pk with RaceID, sk with UCIID and EventTimeStamp)
+    :param tuple fields: (attribute, message field, kind) per item attribute, see RAW, STR, NUM, NOW
+    :return: function converting a decoded message into the DynamoDB item
+    '''
+    def serialize(data_item):
+        race_id = str(data_item.get('RaceID', ""))
+        if rider_level:
+            item = {'pk': {'S': pk_prefix + race_id + "#"},
+                    'sk': {'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp', "") + "#"}}
+        else:
+            item = {'pk': {'S': pk_prefix},
+                    'sk': {'S': "RaceID=" + race_id + "#EventTimeStamp=" + data_item.get('ServerTimeStamp', "") + "#"}}
+        # numeric fields without a valid value and null string fields are not stored in dynamo
+        for attribute, name, kind in fields:
+            if kind == NUM:
+                value = str(data_item.get(name))
+                if value.replace('.', '', 1).isdigit():
+                    item[attribute] = {'N': value}
+            elif kind == STR:
+                item[attribute] = {'S': str(data_item.get(name, ""))}
+            elif kind == RAW:
+                value = data_item.get(name, "")
+                if value is not None:
+                    item[attribute] = {'S': value}
+            else:
+                item[attribute] = {'S': time_now_str()}
+        return item
+    return serialize
+
+
+SERIALIZERS = {input_message: compile_serializer(*schema) for input_message, schema in MESSAGE_SCHEMAS.items()}
+
+
+def convert_event_to_dbd_item(data_item):
+    '''
+    Converts a decoded message into the DynamoDB item of its InputMessage, empty for unknown messages
+    :param dict data_item: decoded message, see decode_record
+    :return: dict DynamoDB item
+    '''
     input_message = data_item['InputMessage']
     logger.debug('Converting message %s', input_message)
-
-    output_schema = {
-        'LiveRidersTracking': {
-            'pk': {'S': "LIVERIDERSTRACKING#RaceID=" + str(data_item.get('RaceID', "")) + "#"},
-            'sk': {
-                'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp', "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'EventTimeStamp': {'S': data_item.get('EventTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'Bib': {'S': str(data_item.get('Bib', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'RiderRank': {'N': str(data_item.get('RiderRank'))},
-            'State': {'S': str(data_item.get('State', ""))},
-            'Distance': {'N': str(data_item.get('Distance'))},
-            'DistanceProj': {'N': str(data_item.get('DistanceProj'))},
-            'Speed': {'N': str(data_item.get('Speed'))},
-            'SpeedMax': {'N': str(data_item.get('SpeedMax'))},
-            'SpeedAvg': {'N': str(data_item.get('SpeedAvg'))},
-            'DistanceFirst': {'N': str(data_item.get('DistanceFirst'))},
-            'DistanceNext': {'N': str(data_item.get('DistanceNext'))},
-            'Acc': {'N': str(data_item.get('Acc'))},
-            'Lat': {'N': str(data_item.get('Lat'))},
-            'Lng': {'N': str(data_item.get('Lng'))}
-        },
-        'LiveRidersData': {
-            'pk': {'S': "LIVERIDERSDATA#RaceID=" + str(data_item.get('RaceID', "")) + "#"},
-            'sk': {
-                'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp',
-                                                                                                     "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'EventTimeStamp': {'S': data_item.get('EventTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'Bib': {'S': str(data_item.get('Bib', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'RiderHeartrate': {'N': str(data_item.get('RiderHeartrate'))},
-            'RiderCadency': {'N': str(data_item.get('RiderCadency', ""))},
-            'RiderPower': {'N': str(data_item.get('RiderPower'))}
-        },
-        'StartTime': {
-            'pk': {'S': "STARTTIME#"},
-            'sk': {'S': "RaceID=" + str(data_item.get('RaceID', "")) + "#EventTimeStamp=" + data_item.get('ServerTimeStamp',
-                                                                                                          "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-        },
-        'RaceStartLive': {
-            'pk': {'S': "RACESTARTLIVE#"},
-            'sk': {'S': "RaceID=" + str(data_item.get('RaceID', "")) + "#EventTimeStamp=" + data_item.get(
-                'ServerTimeStamp',
-                "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-        },
-        'FinishTime': {
-            'pk': {'S': "FINISHTIME#"},
-            'sk': {'S': "RaceID=" + str(data_item.get('RaceID', "")) + "#EventTimeStamp=" + data_item.get('ServerTimeStamp',
-                                                                                                          "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'RaceTime': {'S': str(data_item.get('RaceTime', ""))},
-            'RaceSpeed': {'S': str(data_item.get('RaceSpeed', ""))}
-        },
-        'LapCounter': {
-            'pk': {'S': "LAPCOUNTER#"},
-            'sk': {'S': "RaceID=" + str(data_item.get('RaceID', "")) + "#EventTimeStamp=" + data_item.get('ServerTimeStamp',
-                                                                                                          "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'LapsToGo': {'S': str(data_item.get('LapsToGo', ""))},
-            'DistanceToGo': {'S': str(data_item.get('DistanceToGo', ""))}
-        },
-        'RiderEliminated': {
-            'pk': {'S': "RIDERELIMINATED#"},
-            'sk': {'S': "RaceID=" + str(data_item.get('RaceID', "")) + "#EventTimeStamp=" + data_item.get('ServerTimeStamp',
-                                                                                                          "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'ServerTimeStamp': {'S': data_item.get('ServerTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'EliminatedRaceName': {'S': str(data_item.get('EliminatedRaceName', ""))},
-            'Bib': {'S': str(data_item.get('Bib', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'FirstName': {'S': str(data_item.get('FirstName', ""))},
-            'LastName': {'S': str(data_item.get('LastName', ""))},
-            'ShortTVName': {'S': str(data_item.get('ShortTVName', ""))},
-            'Team': {'S': str(data_item.get('Team', ""))},
-            'NOC': {'S': str(data_item.get('NOC', ""))}
-        },
-        'AggRidersData': {
-            'pk': {'S': "AGG#LIVERIDERSDATA#RaceID=" + str(data_item.get('RaceID', "")) + "#"},
-            'sk': {
-                'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp',
-                                                                                                     "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'EventTimeStamp': {'S': data_item.get('EventTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'Bib': {'S': str(data_item.get('Bib', ""))},
-            'LeagueCat': {'S': str(data_item.get('LeagueCat', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'RiderHeartrate': {'N': str(data_item.get('RiderHeartrate', ""))},
-            'AvgRaceRiderHeartrate': {'N': str(data_item.get('AvgRaceRiderHeartrate', ""))},
-            'MaxRaceRiderHeartrate': {'N': str(data_item.get('MaxRaceRiderHeartrate', ""))},
-            'MaxRaceHeartrate': {'N': str(data_item.get('MaxRaceHeartrate', ""))},
-            'RiderCadency': {'N': str(data_item.get('RiderCadency', ""))},
-            'AvgRaceRiderCadency': {'N': str(data_item.get('AvgRaceRiderCadency', ""))},
-            'MaxRaceRiderCadency': {'N': str(data_item.get('MaxRaceRiderCadency', ""))},
-            'MaxRaceCadency': {'N': str(data_item.get('MaxRaceCadency', ""))},
-            'RiderPower': {'N': str(data_item.get('RiderPower', ""))},
-            'AvgRaceRiderPower': {'N': str(data_item.get('AvgRaceRiderPower', ""))},
-            'MaxRaceRiderPower': {'N': str(data_item.get('MaxRaceRiderPower', ""))},
-            'MaxRacePower': {'N': str(data_item.get('MaxRacePower', ""))},
-            'IsInHeartrateRedZone': {'N': str(data_item.get('IsInHeartrateRedZone', ""))},
-            'TimeSpentInRedZone': {'N': str(data_item.get('TimeSpentInRedZone', ""))},
-            'IsInHeartrateOrangeZone': {'N': str(data_item.get('IsInHeartrateOrangeZone', ""))},
-            'TimeSpentInOrangeZone': {'N': str(data_item.get('TimeSpentInOrangeZone', ""))},
-            'IsInHeartrateGreenZone': {'N': str(data_item.get('IsInHeartrateGreenZone', ""))},
-            'TimeSpentInGreenZone': {'N': str(data_item.get('TimeSpentInGreenZone', ""))}
-        },
-        'AggRidersTracking': {
-            'pk': {'S': "AGG#LIVERIDERSTRACKING#RaceID=" + str(data_item.get('RaceID', "")) + "#"},
-            'sk': {
-                'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp',
-                                                                                                     "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'EventTimeStamp': {'S': data_item.get('EventTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'RiderSpeed': {'N': str(data_item.get('RiderSpeed', ""))},
-            'AvgRaceRiderSpeed': {'N': str(data_item.get('AvgRaceRiderSpeed', ""))},
-            'MaxRaceRiderSpeed': {'N': str(data_item.get('MaxRaceRiderSpeed', ""))},
-            'MaxRaceSpeed': {'N': str(data_item.get('MaxRaceSpeed', ""))},
-            'RiderRank': {'N': str(data_item.get('RiderRank', ""))}
-        },
-        'AggPersonalBest': {
-            'pk': {'S': "AGG#PERSONALBEST#RaceID=" + str(data_item.get('RaceID', "")) + "#"},
-            'sk': {
-                'S': "UCIID=" + str(data_item.get('UCIID', "")) + "#EventTimeStamp=" + data_item.get('EventTimeStamp',
-                                                                                                     "") + "#"},
-            'Message': {'S': data_item.get('InputMessage', "")},
-            'ApiIngestTime': {'S': data_item.get('ApiIngestTime', "")},
-            'KinesisAnalyticsIngestTime': {'S': data_item.get('KinesisAnalyticsIngestTime', "")},
-            'DynamoIngestTime': {'S': time_now_str()},
-            'EventTimeStamp': {'S': data_item.get('EventTimeStamp', "")},
-            'SeasonID': {'S': str(data_item.get('SeasonID', ""))},
-            'EventID': {'S': str(data_item.get('EventID', ""))},
-            'RaceID': {'S': str(data_item.get('RaceID', ""))},
-            'Bib': {'S': str(data_item.get('Bib', ""))},
-            'LeagueCat': {'S': str(data_item.get('LeagueCat', ""))},
-            'UCIID': {'S': str(data_item.get('UCIID', ""))},
-            'RiderHeartrate': {'N': str(data_item.get('RiderHeartrate', ""))},
-            'RiderHeartrateExceeded': {'N': str(data_item.get('RiderHeartrateExceeded', ""))},
-            'RiderPower': {'N': str(data_item.get('RiderPower', ""))},
-            'RiderPowerExceeded': {'N': str(data_item.get('RiderPowerExceeded', ""))},
-            'Power5s': {'N': str(data_item.get('Power5s', ""))},
-            'Power5sExceeded': {'N': str(data_item.get('Power5sExceeded', ""))},
-            'Power15s': {'N': str(data_item.get('Power15s', ""))},
-            'Power15sExceeded': {'N': str(data_item.get('Power15sExceeded', ""))},
-            'Power30s': {'N': str(data_item.get('Power30s', ""))},
-            'Power30sExceeded': {'N': str(data_item.get('Power30sExceeded', ""))},
-            'Power60s': {'N': str(data_item.get('Power60s', ""))},
-            'Power60sExceeded': {'N': str(data_item.get('Power60sExceeded', ""))},
-            'Power120s': {'N': str(data_item.get('Power120s', ""))},
-            'Power120sExceeded': {'N': str(data_item.get('Power120sExceeded', ""))},
-            'Power180s': {'N': str(data_item.get('Power180s', ""))},
-            'Power180sExceeded': {'N': str(data_item.get('Power180sExceeded', ""))},
-            'Power300s': {'N': str(data_item.get('Power300s', ""))},
-            'Power300sExceeded': {'N': str(data_item.get('Power300sExceeded', ""))},
-            'Power600s': {'N': str(data_item.get('Power600s', ""))},
-            'Power600sExceeded': {'N': str(data_item.get('Power600sExceeded', ""))},
-        }
-    }.get(input_message, {})
-
-    # removing json fields with null values in numeric columns to do not store it in dynamo.
-    cleaned_output_schema = {k: v for k, v in output_schema.items() if
-                             (v.get('S') is not None) or (v.get('N') is not None and (v.get('N', "").replace('.', '', 1).isdigit()))}
-    logger.debug('cleaned_output_schema %s', cleaned_output_schema)
-    return cleaned_output_schema
+    serializer = SERIALIZERS.get(input_message)
+    ddb_item = serializer(data_item) if serializer is not None else {}
+    logger.debug('ddb_item %s', ddb_item)
+    return ddb_item
 
 
 def create_dbd_item_from_query_results_for_race(results):
@@ -615,97 +557,82 @@ def time_now_str():
     return datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S.%f')[:-3]
 
 
-def put_timing_stats_to_cw(metrics):
-    def compute_diff_ms(time1, time2):
-        date_format_str = '%Y-%m-%d %H:%M:%S.%f'
-        diff = datetime.datetime.strptime(time2, date_format_str) - datetime.datetime.strptime(time1, date_format_str)
-        return int(diff.total_seconds() * 1000)
+def epoch_ms(timestamp):
+    '''
+    Converts a timestamp like 2021-08-11 09:52:42.244 to milliseconds since epoch, same time zone as time_now_str.
+    The fixed positions of the date and time are parsed directly, the fractional seconds can have any number of digits
+    (datetime.fromisoformat of Python 3.8 only accepts 3 or 6 digits)
+    :param str timestamp: timestamp
+    :return: float milliseconds since epoch
+    '''
+    seconds, _, fraction = timestamp.partition('.')
+    moment = datetime.datetime(int(seconds[0:4]), int(seconds[5:7]), int(seconds[8:10]),
+                               int(seconds[11:13]), int(seconds[14:16]), int(seconds[17:19]))
+    return ((moment - EPOCH).total_seconds() + (float('0.' + fraction) if fraction else 0.)) * 1000.
+
+
+def now_epoch_ms():
+    '''
+    Actual time in milliseconds since epoch, the numeric counterpart of time_now_str
+    :return: float milliseconds since epoch
+    '''
+    return (datetime.datetime.now() - EPOCH).total_seconds() * 1000.
 
 
-    logger.debug("metrics: {}".format(str(metrics)))
-    for key in metrics.keys():
+def add_latency(latency_stats, entity, metric_name, value_ms):
+    '''
+    Adds a latency to the in memory statistics of the invocation
+    :param dict latency_stats: [count, sum, min, max] per (entity, metric_name)
+    :param str entity: message type
+    :param str metric_name: name of the latency metric
+    :param float value_ms: latency in milliseconds
+    '''
+    stats = latency_stats.get((entity, metric_name))
+    if stats is None:
+        latency_stats[(entity, metric_name)] = [1, value_ms, value_ms, value_ms]
+    else:
+        stats[0] += 1
+        stats[1] += value_ms
+        stats[2] = min(stats[2], value_ms)
+        stats[3] = max(stats[3], value_ms)
+
+
+def put_latency_stats_to_cw(latency_stats):
+    '''
+    Sends the latency statistics of the invocation as statistic sets with one batched PutMetricData request
+    :param dict latency_stats: [count, sum, min, max] per (entity, metric_name), see add_latency
+    '''
+    logger.debug("latency stats: {}".format(str(latency_stats)))
+    metric_data = [
+        {
+            'MetricName': metric_name,
+            'Dimensions': [
+                {
+                    'Name': 'Env',
+                    'Value': project_env
+                },
+                {
+                    'Name': 'Entity',
+                    'Value': entity
+                },
+            ],
+            'Unit': 'Milliseconds',
+            'StatisticValues': {
+                'SampleCount': count,
+                'Sum': total,
+                'Minimum': minimum,
+                'Maximum': maximum
+            }
+        }
+        for (entity, metric_name), (count, total, minimum, maximum) in sorted(latency_stats.items())
+    ]
+    for i in range(0, len(metric_data), MAX_METRIC_DATA):
         try:
-            entity = key
-            api_ingest_time = metrics.get(key)['APIIngestTime']
-            kinesis_analytics_ingest_time = metrics.get(key)['KinesisAnalyticsIngestTime']
-            dynamo_ingest_time = metrics.get(key)['DynamoIngestTime']
-            lambda_ingest_time_start = metrics.get(key)['StoreToDynamoLambdaTimeStart']
-            lambda_ingest_time_end = metrics.get(key)['StoreToDynamoLambdaTimeEnd']
-            total_pipeline_time_ms = compute_diff_ms(api_ingest_time, dynamo_ingest_time)
-            api_to_kinesis_time_ms = compute_diff_ms(api_ingest_time, kinesis_analytics_ingest_time)
-            kinesis_to_dynamo_time_ms = compute_diff_ms(kinesis_analytics_ingest_time, dynamo_ingest_time)
-            lambda_to_dynamo_time_ms = compute_diff_ms(lambda_ingest_time_start, lambda_ingest_time_end)
-
-            cloudwatch_client.put_metric_data(
-                MetricData=[
-                    {
-                        'MetricName': 'TotalPipelineTimeMs',
-                        'Dimensions': [
-                            {
-                                'Name': 'Env',
-                                'Value': project_env
-                            },
-                            {
-                                'Name': 'Entity',
-                                'Value': entity
-                            },
-                        ],
-                        'Unit': 'Milliseconds',
-                        'Value': total_pipeline_time_ms
-                    },
-                    {
-                        'MetricName': 'APIToKinesisTimeMs',
-                        'Dimensions': [
-                            {
-                                'Name': 'Env',
-                                'Value': project_env
-                            },
-                            {
-                                'Name': 'Entity',
-                                'Value': entity
-                            },
-                        ],
-                        'Unit': 'Milliseconds',
-                        'Value': api_to_kinesis_time_ms
-                    },
-                    {
-                        'MetricName': 'KinesisToDynamoTimeMs',
-                        'Dimensions': [
-                            {
-                                'Name': 'Env',
-                                'Value': project_env
-                            },
-                            {
-                                'Name': 'Entity',
-                                'Value': entity
-                            },
-                        ],
-                        'Unit': 'Milliseconds',
-                        'Value': kinesis_to_dynamo_time_ms
-                    },
-                    {
-                        'MetricName': 'StoreToDynamoLambdaTime',
-                        'Dimensions': [
-                            {
-                                'Name': 'Env',
-                                'Value': project_env
-                            },
-                            {
-                                'Name': 'Entity',
-                                'Value': entity
-                            },
-                        ],
-                        'Unit': 'Milliseconds',
-                        'Value': lambda_to_dynamo_time_ms
-                    },
-                ],
-                Namespace='UciTcl/dataPipeline'
-            )
-            logger.debug("Sent metrics to cloudwatch: TotalPipelineTimeMs: %s ; ApiToKinesisTimeMs: %s ; KinesisToDynamoTimeMs %s" % (
-                total_pipeline_time_ms, api_to_kinesis_time_ms, kinesis_to_dynamo_time_ms))
+            cloudwatch_client.put_metric_data(MetricData=metric_data[i:i + MAX_METRIC_DATA], Namespace=METRICS_NAMESPACE)
         except Exception as ex:
             logger.error("Failed to send metrics to cloudwatch:")
             logger.error(ex, exc_info=True)
+    logger.debug("Sent %d latency statistics to cloudwatch", len(metric_data))
 
 def trigger_personal_best(table_name_live, table_name_static, race_details):
 